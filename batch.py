@@ -0,0 +1,292 @@
+"""Run schema matching headless for many relation pairs and models.
+
+Example: `python batch.py test_inputs --models gpt-4.1-mini-2025-04-14 o4-mini-2025-04-16`
+Add `--dry-run` to estimate the requests, tokens, cost and duration of the run first.
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import os
+from typing import Any, Dict, List, Optional, Set
+
+from utils.backend import schema_match_async
+from utils.config import config
+from utils.evaluation import evaluate_result, load_ground_truth
+from utils.models import Feedback, Parameters, Relation, Result
+from utils.scheduling import LatencyModel, Priority, Scheduler
+from utils.storage import store_evaluation
+
+EVALUATION_COLUMNS = [
+    "input",
+    "model",
+    "result",
+    "task_scope",
+    "precision",
+    "recall",
+    "f1-score",
+    "decisiveness",
+]
+
+
+def collect_inputs(paths: List[str]) -> List[str]:
+    """Expand the given paths into a list of input JSON files. Paths may be input files, directories (all JSON files within) or manifests (text files listing one input per line, relative to the manifest)."""
+    inputs = []
+    for path in paths:
+        if os.path.isdir(path):
+            inputs.extend(
+                sorted(
+                    os.path.join(path, f)
+                    for f in os.listdir(path)
+                    if f.endswith(".json")
+                )
+            )
+        elif path.endswith(".json"):
+            inputs.append(path)
+        else:
+            with open(path, "r") as f:
+                lines = [line.strip() for line in f]
+            inputs.extend(
+                collect_inputs(
+                    [
+                        os.path.join(os.path.dirname(path), line)
+                        for line in lines
+                        if line and not line.startswith("#")
+                    ]
+                )
+            )
+    return inputs
+
+
+def load_parameters(input_path: str, model: str) -> Parameters:
+    """Load the relations of an input file in the format of the load screen."""
+    with open(input_path, "r") as f:
+        json_dict = json.load(f)
+    return Parameters(
+        source_relation=Relation.from_dict(json_dict["source_relation"]),
+        target_relation=Relation.from_dict(json_dict["target_relation"]),
+        # the app starts with an empty general feedback, use the same to share stored results
+        feedback=Feedback.from_dict(json_dict.get("feedback", {"general": ""})),
+        llm_model=model,
+    )
+
+
+def ground_truth_path(input_path: str) -> str:
+    return input_path[: -len(".json")] + "_ground_truth.csv"
+
+
+def experiment_key(input_path: str, model: str) -> str:
+    return f"{os.path.basename(input_path)[: -len('.json')]}__{model}"
+
+
+class BatchOutput:
+    """Writes the outputs of a batch run into a directory. Completed experiments are journaled, which allows to resume an interrupted run."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, "results"), exist_ok=True)
+        self.journal_path = os.path.join(directory, "experiments.jsonl")
+        self.evaluation_path = os.path.join(directory, "evaluation.csv")
+
+    def completed(self) -> Set[str]:
+        """Return the keys of all experiments completed in earlier runs."""
+        if not os.path.exists(self.journal_path):
+            return set()
+        with open(self.journal_path, "r") as f:
+            return {
+                json.loads(line)["key"]
+                for line in f
+                if line.strip() and json.loads(line)["status"] == "done"
+            }
+
+    def write(
+        self,
+        key: str,
+        input_path: str,
+        model: str,
+        result: Optional[Result],
+        evaluation: List[Dict[str, Any]],
+        error: Optional[str] = None,
+    ) -> None:
+        if result is not None:
+            with open(os.path.join(self.directory, "results", f"{key}.json"), "w") as f:
+                f.write(result.to_json())
+        if evaluation:
+            new_file = not os.path.exists(self.evaluation_path)
+            with open(self.evaluation_path, "a", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=EVALUATION_COLUMNS)
+                if new_file:
+                    writer.writeheader()
+                for row in evaluation:
+                    writer.writerow(
+                        {
+                            "input": input_path,
+                            "model": model,
+                            "result": result.meta.get("path", ""),
+                            **row,
+                        }
+                    )
+        # the journal is written last: an experiment only counts as done once all outputs exist
+        with open(self.journal_path, "a") as f:
+            entry = {
+                "key": key,
+                "input": input_path,
+                "model": model,
+                "status": "failed" if error else "done",
+                "result": result.meta.get("path", "") if result else None,
+                "error": error,
+            }
+            f.write(json.dumps(entry) + "\n")
+
+    def summarize(self) -> None:
+        """Write all evaluation rows as a single JSON file."""
+        if not os.path.exists(self.evaluation_path):
+            return
+        with open(self.evaluation_path, "r", newline="") as f:
+            rows = list(csv.DictReader(f))
+        with open(os.path.join(self.directory, "evaluation.json"), "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+async def run_experiment(
+    input_path: str,
+    model: str,
+    budget: Scheduler,
+    output: BatchOutput,
+) -> None:
+    key = experiment_key(input_path, model)
+    try:
+        parameters = load_parameters(input_path, model)
+        # batch runs give way to interactive sessions sharing the request budget
+        result = await schema_match_async(parameters, budget, priority=Priority.BULK)
+        evaluation = []
+        if os.path.exists(ground_truth_path(input_path)):
+            ground_truth = load_ground_truth(
+                ground_truth_path(input_path),
+                result.parameters.source_relation,
+                result.parameters.target_relation,
+            )
+            evaluation = evaluate_result(result, ground_truth)
+            # the F1-scores per design guide the design selection of later runs
+            store_evaluation(result, evaluation)
+    except Exception as e:  # keep going with all other experiments
+        print(f"[failed] {key}: {e!r}")
+        output.write(key, input_path, model, None, [], error=repr(e))
+        return
+    output.write(key, input_path, model, result, evaluation)
+    print(f"[done] {key}: {result.name}")
+
+
+async def run_batch(
+    inputs: List[str],
+    models: List[str],
+    output: BatchOutput,
+    parallel_requests: int,
+) -> None:
+    """Run all experiments concurrently, sharing a single request budget."""
+    completed = output.completed()
+    budget = Scheduler(parallel_requests)
+    experiments = [
+        (input_path, model)
+        for input_path in inputs
+        for model in models
+        if experiment_key(input_path, model) not in completed
+    ]
+    print(
+        f"Running {len(experiments)} experiments "
+        f"({len(inputs) * len(models) - len(experiments)} completed before)."
+    )
+    async with asyncio.TaskGroup() as tg:
+        for input_path, model in experiments:
+            tg.create_task(run_experiment(input_path, model, budget, output))
+    output.summarize()
+    waits = budget.wait_report()[Priority.BULK]
+    print(
+        f"{waits['requests']} requests waited {waits['mean_wait']:.1f}s "
+        f"on average (max. {waits['max_wait']:.1f}s) for a request slot."
+    )
+
+
+def plan_batch(
+    inputs: List[str],
+    models: List[str],
+    completed: Set[str],
+    parallel_requests: int,
+) -> None:
+    """Print the estimated requests, tokens, cost and duration of the experiments that a run would start, without running them."""
+    from utils.planning import combined_duration, describe, estimate_run
+
+    latency_model = LatencyModel()
+    estimates = []
+    for input_path in inputs:
+        for model in models:
+            key = experiment_key(input_path, model)
+            if key in completed:
+                continue
+            estimate = estimate_run(
+                load_parameters(input_path, model), latency_model=latency_model
+            )
+            print(f"{key}: {estimate.summary()}")
+            estimates.append(estimate)
+    print(
+        f"{len(estimates)} experiments: "
+        f"{describe(estimates, combined_duration(estimates, parallel_requests))}"
+    )
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "inputs",
+        nargs="+",
+        help="input JSON files, directories containing them or manifest files listing them",
+    )
+    parser.add_argument(
+        "--models",
+        nargs="+",
+        default=[config["OPENAI_MODEL"]],
+        help="the models to run every input with",
+    )
+    parser.add_argument(
+        "--output",
+        default="batch_output",
+        help="directory to write results to; rerun with the same directory to resume",
+    )
+    parser.add_argument(
+        "--parallel-requests",
+        type=int,
+        default=config["PARALLEL_OPENAI_REQUESTS"],
+        help="maximum number of parallel requests shared by all experiments",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only print the estimated requests, tokens, cost and duration of the run",
+    )
+    args = parser.parse_args(argv)
+    if args.dry_run:
+        plan_batch(
+            collect_inputs(args.inputs),
+            args.models,
+            # without creating the output directory
+            (
+                BatchOutput(args.output).completed()
+                if os.path.isdir(args.output)
+                else set()
+            ),
+            args.parallel_requests,
+        )
+        return
+    asyncio.run(
+        run_batch(
+            collect_inputs(args.inputs),
+            args.models,
+            BatchOutput(args.output),
+            args.parallel_requests,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
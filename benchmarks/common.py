@@ -0,0 +1,128 @@
+"""Shared helpers of the benchmark suites: synthetic inputs and storing or comparing reports."""
+
+import datetime
+import json
+import os
+import subprocess
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.models import Attribute, AttributePair, Feedback, Parameters, Relation, Side
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_DIR = os.path.join(BENCHMARK_DIR, "baselines")
+REPORT_DIR = os.path.join(BENCHMARK_DIR, "reports")
+
+# metrics where a higher value is worse, compared against baselines
+COMPARED_METRICS = ["wall_time", "peak_memory", "db_size"]
+
+
+def synthetic_relation(name: str, side: Side, n_attributes: int) -> Relation:
+    return Relation(
+        name=name,
+        side=side,
+        description=f"A synthetic {side.value} relation with {n_attributes} attributes.",
+        attributes=[
+            Attribute(
+                name=f"{side.value}_attribute_{i}",
+                description=f"Attribute number {i} of {name}, which stores a synthetic value.",
+            )
+            for i in range(n_attributes)
+        ],
+    )
+
+
+def synthetic_parameters(
+    n_attributes: int, model: str = "stand-in"
+) -> Tuple[Parameters, List[AttributePair]]:
+    """Create parameters with n_attributes attributes in total, split evenly across source and target relation. The i-th source attribute matches the i-th target attribute in the returned ground truth."""
+    n_source = max(n_attributes // 2, 1)
+    n_target = max(n_attributes - n_source, 1)
+    parameters = Parameters(
+        source_relation=synthetic_relation("synthetic_source", Side.SOURCE, n_source),
+        target_relation=synthetic_relation("synthetic_target", Side.TARGET, n_target),
+        feedback=Feedback(general=""),
+        llm_model=model,
+    )
+    ground_truth = [
+        AttributePair(src, trgt)
+        for src, trgt in zip(
+            parameters.source_relation.attributes,
+            parameters.target_relation.attributes,
+        )
+    ]
+    return parameters, ground_truth
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=BENCHMARK_DIR,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def new_report(suite: str, settings: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "suite": suite,
+        "commit": current_commit(),
+        "datetime": datetime.datetime.now().isoformat(timespec="seconds"),
+        "settings": settings,
+        "cases": {},
+    }
+
+
+def save_report(report: Dict[str, Any], save_baseline: bool = False) -> str:
+    """Store a report under reports/<suite>-<commit>.json and optionally as the new baseline of the suite. Returns the report path."""
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    path = os.path.join(REPORT_DIR, f"{report['suite']}-{report['commit']}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    if save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(os.path.join(BASELINE_DIR, f"{report['suite']}.json"), "w") as f:
+            json.dump(report, f, indent=2)
+    return path
+
+
+def load_report(suite_or_path: str) -> Optional[Dict[str, Any]]:
+    """Load a report from a path, or the baseline of a suite."""
+    path = suite_or_path
+    if not os.path.exists(path):
+        path = os.path.join(BASELINE_DIR, f"{suite_or_path}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def compare_reports(
+    report: Dict[str, Any],
+    baseline: Dict[str, Any],
+    tolerance: float = 1.25,
+    metrics: List[str] = COMPARED_METRICS,
+) -> List[str]:
+    """Compare the given metrics of all stages of two reports. Prints one line per metric and returns the regressions, i.e. metrics that grew by more than the tolerance factor."""
+    regressions = []
+    print(f"Comparing against {baseline['suite']} at {baseline['commit']}:")
+    for case, measurements in report["cases"].items():
+        for stage, stage_metrics in measurements.items():
+            base_metrics = baseline["cases"].get(case, {}).get(stage, None)
+            if base_metrics is None:
+                continue
+            for metric in metrics:
+                value = stage_metrics.get(metric, None)
+                base = base_metrics.get(metric, None)
+                if value is None or not base:
+                    continue
+                ratio = value / base
+                line = f"  {case} / {stage} / {metric}: {base:.4g} -> {value:.4g} ({ratio:.2f}x)"
+                if ratio > tolerance:
+                    line += " REGRESSION"
+                    regressions.append(line.strip())
+                print(line)
+    return regressions
@@ -0,0 +1,269 @@
+"""End-to-end benchmark of the matching pipeline against a local stand-in LLM.
+
+Run it from the repository root with `python -m benchmarks.e2e`. Every stage of every case reports its wall time, throughput, peak memory (traced Python allocations) and the size of the SQLite database afterwards.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+from utils.config import config
+from utils.evaluation import evaluate_result, load_ground_truth
+from utils.models import AttributePair, Parameters
+from utils.prompt_building import PromptDesign, build_prompts
+from utils.prompt_postprocessing import postprocess_answers
+from utils.prompt_sending import send_prompts
+from utils.result_cache import result_cache
+from utils.storage import (
+    get_result_by_parameters,
+    get_usage_by_parameters,
+    store_parameters,
+    store_result,
+)
+
+from batch import collect_inputs, ground_truth_path, load_parameters
+from .common import (
+    compare_reports,
+    load_report,
+    new_report,
+    save_report,
+    synthetic_parameters,
+)
+from .stand_in_llm import StandInLLM
+
+TEMPLATES = ["oneToN", "nToOne", "nToN"]
+MODES = [PromptDesign.oneToN, PromptDesign.nToOne, PromptDesign.nToN]
+
+
+def measure(
+    func: Callable[[], Any], count: Callable[[Any], int]
+) -> Tuple[Any, Dict[str, float]]:
+    """Run func once, measuring wall time, peak memory and throughput (count of the return value per second)."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    value = func()
+    wall_time = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    items = count(value)
+    return value, {
+        "wall_time": wall_time,
+        "items": items,
+        "throughput": items / wall_time if wall_time > 0 else 0.0,
+        "peak_memory": peak,
+        "db_size": os.path.getsize(config["SQLITE_PATH"]),
+    }
+
+
+def run_case(
+    parameters: Parameters, ground_truth: List[AttributePair], max_pairs: int
+) -> Dict[str, Dict[str, Any]]:
+    stages = {}
+    parameters = store_parameters(parameters)
+    prompts, stages["build_prompts"] = measure(
+        lambda: build_prompts(parameters, TEMPLATES, MODES, parameters.llm_model),
+        len,
+    )
+    answers, stages["send_prompts"] = measure(
+        lambda: send_prompts(parameters, prompts), len
+    )
+    usage = get_usage_by_parameters([parameters])
+    prompt_tokens = sum(u["prompt_tokens"] or 0 for u in usage)
+    cached_tokens = sum(u["cached_tokens"] or 0 for u in usage)
+    stages["send_prompts"]["prompt_tokens"] = prompt_tokens
+    stages["send_prompts"]["requests"] = sum(u["requests"] for u in usage)
+    stages["send_prompts"]["cached_token_rate"] = (
+        cached_tokens / prompt_tokens if prompt_tokens > 0 else 0.0
+    )
+    n_pairs = len(parameters.source_relation.attributes) * len(
+        parameters.target_relation.attributes
+    )
+    if n_pairs > max_pairs:
+        # the size of a Result grows with pairs * votes * attributes per prompt
+        skipped = {"skipped": f"{n_pairs} pairs exceed --max-pairs"}
+        for stage in [
+            "postprocess_answers",
+            "store_result",
+            "get_result",
+            "evaluation",
+        ]:
+            stages[stage] = skipped
+        return stages
+    result, stages["postprocess_answers"] = measure(
+        lambda: postprocess_answers(parameters, answers), lambda r: len(r.pairs)
+    )
+    result.name = "benchmark"
+    result, stages["store_result"] = measure(
+        lambda: store_result(result), lambda r: len(r.pairs)
+    )
+    result_cache.clear()  # measure deserializing, not the cache
+    result, stages["get_result"] = measure(
+        lambda: get_result_by_parameters(parameters), lambda r: len(r.pairs)
+    )
+    _, stages["evaluation"] = measure(
+        lambda: evaluate_result(result, ground_truth), lambda _: n_pairs
+    )
+    return stages
+
+
+def collect_cases(
+    inputs: List[str], sizes: List[int]
+) -> Dict[str, Tuple[Parameters, List[AttributePair]]]:
+    cases = {}
+    for input_path in inputs:
+        parameters = load_parameters(input_path, "stand-in")
+        ground_truth = []
+        if os.path.exists(ground_truth_path(input_path)):
+            ground_truth = load_ground_truth(
+                ground_truth_path(input_path),
+                parameters.source_relation,
+                parameters.target_relation,
+            )
+        cases[os.path.basename(input_path)[: -len(".json")]] = (
+            parameters,
+            ground_truth,
+        )
+    for size in sizes:
+        cases[f"synthetic_{size}"] = synthetic_parameters(size)
+    return cases
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--inputs",
+        nargs="*",
+        default=["test_inputs"],
+        help="input files or directories",
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="*",
+        type=int,
+        default=[10, 100, 1000],
+        help="total number of attributes of synthetic schemas",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="stand-in latency per request (s)"
+    )
+    parser.add_argument(
+        "--latency-per-1k-tokens",
+        type=float,
+        default=0.01,
+        help="additional stand-in latency per 1000 prompt tokens (s)",
+    )
+    parser.add_argument("--parallel-requests", type=int, default=20)
+    parser.add_argument(
+        "--layout",
+        choices=["default", "cached"],
+        default=config["PROMPT_LAYOUT"],
+        help="the prompt template layout",
+    )
+    parser.add_argument(
+        "--answer-mode",
+        choices=["text", "structured"],
+        default=config["ANSWER_MODE"],
+        help="free text answers or structured outputs",
+    )
+    parser.add_argument(
+        "--invalid-rate",
+        type=float,
+        default=0.0,
+        help="share of invalid stand-in free text answers",
+    )
+    parser.add_argument(
+        "--straggler-rate",
+        type=float,
+        default=0.0,
+        help="share of stand-in requests that take --straggler-latency longer",
+    )
+    parser.add_argument("--straggler-latency", type=float, default=10.0)
+    parser.add_argument(
+        "--prompt-order",
+        choices=["longest-first", "planned"],
+        default=config["PROMPT_ORDER"],
+        help="the order in which the prompts of a case are sent",
+    )
+    parser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        default=config["HEDGE_PERCENTILE"],
+        help="hedge requests slower than this latency percentile (0 disables)",
+    )
+    parser.add_argument(
+        "--max-pairs",
+        type=int,
+        default=5000,
+        help="skip the result stages of cases with more attribute pairs",
+    )
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--compare",
+        nargs="?",
+        const="e2e",
+        default=None,
+        help="compare against the stored baseline, or a given report file",
+    )
+    parser.add_argument("--tolerance", type=float, default=1.25)
+    args = parser.parse_args(argv)
+
+    settings = {
+        k: v for k, v in vars(args).items() if k not in ("save_baseline", "compare")
+    }
+    report = new_report("e2e", settings)
+    cases = collect_cases(collect_inputs(args.inputs), args.sizes)
+    with tempfile.TemporaryDirectory() as tmp_dir, StandInLLM(
+        args.latency,
+        args.latency_per_1k_tokens,
+        invalid_rate=args.invalid_rate,
+        straggler_rate=args.straggler_rate,
+        straggler_latency=args.straggler_latency,
+    ) as llm:
+        os.environ["OPENAI_BASE_URL"] = llm.base_url
+        os.environ["OPENAI_API_KEY"] = "stand-in"
+        config["QUERY_OPENAI"] = True
+        config["PARALLEL_OPENAI_REQUESTS"] = args.parallel_requests
+        config["PROMPT_LAYOUT"] = args.layout
+        config["ANSWER_MODE"] = args.answer_mode
+        config["HEDGE_PERCENTILE"] = args.hedge_percentile
+        config["PROMPT_ORDER"] = args.prompt_order
+        for case, (parameters, ground_truth) in cases.items():
+            # a fresh database per case keeps the database sizes comparable
+            config["SQLITE_PATH"] = os.path.join(tmp_dir, f"{case}.sqlite3")
+            report["cases"][case] = run_case(parameters, ground_truth, args.max_pairs)
+            print(f"{case}:")
+            for stage, metrics in report["cases"][case].items():
+                if "skipped" in metrics:
+                    print(f"  {stage:<20} skipped ({metrics['skipped']})")
+                    continue
+                print(
+                    f"  {stage:<20} {metrics['wall_time']:8.3f}s "
+                    f"{metrics['throughput']:10.1f} items/s "
+                    f"{metrics['peak_memory'] / 2**20:8.1f} MiB "
+                    f"db {metrics['db_size'] / 2**20:8.1f} MiB"
+                    + (
+                        f" requests {metrics['requests']}"
+                        if "requests" in metrics
+                        else ""
+                    )
+                    + (
+                        f" cached tokens {metrics['cached_token_rate']:.0%}"
+                        if "cached_token_rate" in metrics
+                        else ""
+                    )
+                )
+    print(f"Report written to {save_report(report, args.save_baseline)}")
+    if args.compare:
+        baseline = load_report(args.compare)
+        if baseline is None:
+            print(f"No baseline found for {args.compare}.")
+        elif compare_reports(report, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
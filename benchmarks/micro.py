@@ -0,0 +1,206 @@
+"""Micro-benchmarks of the operations that run once per attribute pair or per answer.
+
+Run it from the repository root with `python -m benchmarks.micro`. Every case is timed with repeated runs; the median time of consecutive widths gives a scaling exponent (1 = linear, 2 = quadratic) to spot blowups early.
+"""
+
+import argparse
+import functools
+import json
+import math
+import statistics
+import sys
+import timeit
+from typing import Any, Callable, Dict, List
+
+from utils.models import (
+    Answer,
+    AttributePair,
+    Decision,
+    Parameters,
+    PromptAttributePair,
+    Result,
+    Vote,
+)
+from utils.prompt_building import render_prompt
+from utils.prompt_postprocessing import _generate_empty_result
+from utils.prompt_sending import extract_json, is_valid_answer
+
+from .common import compare_reports, load_report, new_report, save_report
+from .common import synthetic_parameters
+
+
+def time_operation(
+    func: Callable[[], Any], repeat: int, min_time: float
+) -> Dict[str, float]:
+    """Time func: calibrate the number of calls per run to take at least min_time, then repeat the runs. Reports statistics of the time per call in seconds."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    runs = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "min": min(runs),
+        "median": statistics.median(runs),
+        "mean": statistics.mean(runs),
+        "stdev": statistics.stdev(runs) if len(runs) > 1 else 0.0,
+        "calls_per_run": number,
+        "runs": repeat,
+    }
+
+
+def synthetic_result(parameters: Parameters, votes: int = 3) -> Result:
+    """A result in which every pair got votes from a 1-to-N answer."""
+    result = _generate_empty_result(parameters)
+    for source in parameters.source_relation.attributes:
+        answer = Answer(
+            PromptAttributePair([source], parameters.target_relation.attributes),
+            answer="An explanation. " * 50,
+            valid=True,
+        )
+        for target in parameters.target_relation.attributes:
+            result.pairs[AttributePair(source, target)].votes.extend(
+                Decision(vote=Vote.NO, explanation=answer.answer, answer=answer)
+                for _ in range(votes)
+            )
+    return result
+
+
+def synthetic_answer(size: int) -> Answer:
+    """An answer of about size characters that ends in a decision JSON."""
+    decisions = json.dumps(
+        {
+            "yes": ["target_attribute_0"],
+            "no": [f"target_attribute_{i}" for i in range(1, 20)],
+        }
+    )
+    explanation = ("Lets work this out step by step. " * (size // 33 + 1))[
+        : max(size - len(decisions), 0)
+    ]
+    return Answer(PromptAttributePair(), answer=explanation + decisions)
+
+
+def width_cases(width: int) -> Dict[str, Callable[[], Any]]:
+    """All cases that depend on the schema width, i.e. the number of attributes per relation."""
+    parameters, _ = synthetic_parameters(2 * width)
+    parameters_dict = parameters.to_dict()
+    pair = AttributePair(
+        parameters.source_relation.attributes[0],
+        parameters.target_relation.attributes[0],
+    )
+    # results are only created if needed, as they grow quickly with the width
+    result = functools.cache(lambda: synthetic_result(parameters))
+    result_json = functools.cache(lambda: result().to_json())
+    sources = parameters.source_relation.attributes
+    targets = parameters.target_relation.attributes
+    return {
+        "AttributePair.__hash__": lambda: hash(pair),
+        "AttributePair.digest": pair.digest,
+        "Parameters.from_dict": lambda: Parameters.from_dict(parameters_dict),
+        "Result.to_json": lambda: result().to_json(),
+        "Result.from_json": lambda: Result.from_json(result_json()),
+        "_generate_empty_result": lambda: _generate_empty_result(parameters),
+        "render_prompt[oneToN]": lambda: render_prompt(
+            (sources[0], targets), parameters, "oneToN"
+        ),
+        "render_prompt[nToN]": lambda: render_prompt(
+            (sources, targets), parameters, "nToN"
+        ),
+        # all prompts of a 1-to-N design, i.e. the throughput of building prompts
+        "render_design[oneToN]": lambda: [
+            render_prompt((source, targets), parameters, "oneToN") for source in sources
+        ],
+    }
+
+
+def answer_cases(size: int) -> Dict[str, Callable[[], Any]]:
+    """All cases that depend on the size of an answer in characters."""
+    answer = synthetic_answer(size)
+    return {
+        "extract_json": lambda: extract_json(answer),
+        "is_valid_answer": lambda: is_valid_answer(answer),
+    }
+
+
+def add_scaling(report: Dict[str, Any]) -> None:
+    """Add the scaling exponent of the median time between consecutive sizes of the same operation."""
+    by_operation = {}
+    for case, metrics in report["cases"].items():
+        operation, size = case.rsplit("@", 1)
+        by_operation.setdefault(operation, []).append((int(size), metrics))
+    for measurements in by_operation.values():
+        measurements.sort(key=lambda m: m[0])
+        for (size_a, a), (size_b, b) in zip(measurements[:-1], measurements[1:]):
+            b["time"]["scaling"] = math.log(
+                b["time"]["median"] / a["time"]["median"]
+            ) / math.log(size_b / size_a)
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--widths",
+        nargs="*",
+        type=int,
+        default=[10, 20, 40],
+        help="attributes per relation of the synthetic schemas",
+    )
+    parser.add_argument(
+        "--answer-sizes",
+        nargs="*",
+        type=int,
+        default=[1_000, 10_000, 100_000],
+        help="characters per answer",
+    )
+    parser.add_argument("--repeat", type=int, default=7, help="runs per case")
+    parser.add_argument(
+        "--min-time", type=float, default=0.2, help="minimum duration of a run (s)"
+    )
+    parser.add_argument(
+        "--filter", default="", help="only run operations containing this string"
+    )
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--compare",
+        nargs="?",
+        const="micro",
+        default=None,
+        help="compare against the stored baseline, or a given report file",
+    )
+    parser.add_argument("--tolerance", type=float, default=1.25)
+    args = parser.parse_args(argv)
+
+    settings = {
+        k: v for k, v in vars(args).items() if k not in ("save_baseline", "compare")
+    }
+    report = new_report("micro", settings)
+    cases = {}
+    for width in args.widths:
+        for operation, func in width_cases(width).items():
+            cases[f"{operation}@{width}"] = func
+    for size in args.answer_sizes:
+        for operation, func in answer_cases(size).items():
+            cases[f"{operation}@{size}"] = func
+    for case, func in cases.items():
+        if args.filter not in case:
+            continue
+        report["cases"][case] = {
+            "time": time_operation(func, args.repeat, args.min_time)
+        }
+    add_scaling(report)
+    for case, metrics in report["cases"].items():
+        timing = metrics["time"]
+        scaling = f"scaling {timing['scaling']:5.2f}" if "scaling" in timing else ""
+        print(
+            f"{case:<36} median {timing['median'] * 1e6:12.2f}us "
+            f"± {timing['stdev'] * 1e6:10.2f}us {scaling}"
+        )
+    print(f"Report written to {save_report(report, args.save_baseline)}")
+    if args.compare:
+        baseline = load_report(args.compare)
+        if baseline is None:
+            print(f"No baseline found for {args.compare}.")
+        elif compare_reports(report, baseline, args.tolerance, metrics=["median"]):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
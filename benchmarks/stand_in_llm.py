@@ -0,0 +1,173 @@
+"""A local stand-in for the OpenAI chat completions API with configurable latency.
+
+The answers list every attribute name (or question key of packed prompts) found in the prompt under a random decision, so they are valid answers for all prompt designs.
+Requests with a JSON schema response format are answered with a JSON object only, like structured outputs. Free text answers can be made invalid at a configurable rate to exercise re-asking, and requests can be made stragglers that take much longer to exercise hedging.
+Like the OpenAI API, it caches prompt prefixes of at least 1024 tokens in steps of 128 tokens: cached tokens are reported in the usage and add no latency.
+"""
+
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from typing import Optional
+
+from aiohttp import web
+
+_ATTRIBUTE_NAME = re.compile(r"Attribute name: '([^']*)'")
+_QUESTION_KEY = re.compile(r"^(Q\d+): ", re.MULTILINE)
+# a rough token estimate is sufficient for a stand-in
+_CHARS_PER_TOKEN = 4
+_MIN_CACHED_PREFIX = 1024 * _CHARS_PER_TOKEN
+_CACHED_PREFIX_STEP = 128 * _CHARS_PER_TOKEN
+
+
+class StandInLLM:
+    """Serves POST /v1/chat/completions from a background thread. Each request takes latency + latency_per_1k_tokens * prompt tokens / 1000 seconds."""
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        latency_per_1k_tokens: float = 0.0,
+        explanation_length: int = 500,
+        invalid_rate: float = 0.0,
+        straggler_rate: float = 0.0,
+        straggler_latency: float = 10.0,
+        port: int = 0,
+        seed: int = 42,
+    ):
+        self.latency = latency
+        self.latency_per_1k_tokens = latency_per_1k_tokens
+        self.explanation_length = explanation_length
+        self.invalid_rate = invalid_rate
+        self.straggler_rate = straggler_rate
+        self.straggler_latency = straggler_latency
+        self.port = port
+        self.requests = 0
+        # requests served at the same time, to check rate limits
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._prefixes = set()
+        self._random = random.Random(seed)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._started = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def _answer(self, names: list, questions: list, structured: bool) -> str:
+        if questions:
+            # packed 1-to-1 prompts are answered per question key
+            decisions = {
+                key: self._random.choice(["yes", "no", "no", "no"]) for key in questions
+            }
+        else:
+            decisions = {"yes": [], "no": []}
+            for name in names:
+                decisions[self._random.choice(["yes", "no", "no", "no"])].append(name)
+        explanation = ("The attributes are compared step by step. " * 100)[
+            : self.explanation_length
+        ]
+        if structured:
+            return json.dumps({"explanation": explanation, **decisions})
+        if self._random.random() < self.invalid_rate:
+            return explanation
+        return f"{explanation}\n{decisions}".replace("'", '"')
+
+    def _cached_tokens(self, content: str) -> int:
+        """Return the number of tokens of the longest cached prefix of content, caching all its prefixes."""
+        cached = 0
+        for end in range(_MIN_CACHED_PREFIX, len(content) + 1, _CACHED_PREFIX_STEP):
+            prefix = hash(content[:end])
+            if prefix in self._prefixes:
+                cached = end // _CHARS_PER_TOKEN
+            else:
+                self._prefixes.add(prefix)
+        return cached
+
+    async def _chat_completions(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        body = await request.json()
+        content = "\n".join(m["content"] for m in body["messages"])
+        prompt_tokens = len(content) // _CHARS_PER_TOKEN
+        cached_tokens = self._cached_tokens(content)
+        latency = (
+            self.latency
+            + self.latency_per_1k_tokens * (prompt_tokens - cached_tokens) / 1000
+        )
+        if self._random.random() < self.straggler_rate:
+            latency += self.straggler_latency
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(latency)
+        finally:
+            self.in_flight -= 1
+        names = list(dict.fromkeys(_ATTRIBUTE_NAME.findall(content)))
+        questions = _QUESTION_KEY.findall(content)
+        structured = body.get("response_format", {}).get("type") == "json_schema"
+        choices = [
+            {
+                "index": i,
+                "finish_reason": "stop",
+                "message": {
+                    "role": "assistant",
+                    "content": self._answer(names, questions, structured),
+                },
+            }
+            for i in range(body.get("n", 1))
+        ]
+        completion_tokens = sum(
+            len(c["message"]["content"]) // _CHARS_PER_TOKEN for c in choices
+        )
+        return web.json_response(
+            {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": choices,
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                    "prompt_tokens_details": {"cached_tokens": cached_tokens},
+                },
+            }
+        )
+
+    def _serve(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._chat_completions)
+        self._runner = web.AppRunner(app, access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, "127.0.0.1", self.port)
+        self._loop.run_until_complete(site.start())
+        self.port = self._runner.addresses[0][1]
+        self._started.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
+
+    def start(self) -> "StandInLLM":
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def stop(self) -> None:
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+    def __enter__(self) -> "StandInLLM":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
@@ -0,0 +1,161 @@
+"""Match all relations of a source database onto all relations of a target database.
+
+Example: `python catalog.py mimic_omop.json --model gpt-4.1-mini-2025-04-14`
+"""
+
+import argparse
+import asyncio
+import csv
+import dataclasses
+import json
+import os
+from typing import List, Tuple
+
+from batch import collect_inputs
+from utils.catalog import (
+    catalog_parameters,
+    Mapping,
+    RelationPair,
+    match_catalog_async,
+    select_relation_pairs,
+)
+from utils.config import config
+from utils.models import Relation, Side
+from utils.planning import combined_duration, describe, estimate_run
+from utils.scheduling import LatencyModel, Scheduler
+
+
+def load_relations(paths: List[str]) -> Tuple[List[Relation], List[Relation]]:
+    """Load the source and target relations of catalog files (with lists of `source_relations` and `target_relations`) and input files in the format of the load screen. Relations occurring in several files are only loaded once."""
+    relations = {Side.SOURCE: {}, Side.TARGET: {}}
+    for path in paths:
+        with open(path, "r") as f:
+            json_dict = json.load(f)
+        for key in ["source_relation", "target_relation"]:
+            if key in json_dict:
+                relation = Relation.from_dict(json_dict[key])
+                relations[relation.side][relation.digest()] = relation
+        for key in ["source_relations", "target_relations"]:
+            for data in json_dict.get(key, []):
+                relation = Relation.from_dict(data)
+                relations[relation.side][relation.digest()] = relation
+    return list(relations[Side.SOURCE].values()), list(relations[Side.TARGET].values())
+
+
+def write_pairs(path: str, pairs: List[RelationPair]) -> None:
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["source", "target", "similarity", "result", "error"])
+        for pair in pairs:
+            writer.writerow(
+                [
+                    pair.source.name,
+                    pair.target.name,
+                    f"{pair.similarity:.3f}",
+                    pair.result.meta.get("path", "") if pair.result else "",
+                    pair.error or "",
+                ]
+            )
+
+
+def write_mappings(path: str, mappings: List[Mapping]) -> None:
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(
+            f, fieldnames=[field.name for field in dataclasses.fields(Mapping)]
+        )
+        writer.writeheader()
+        for mapping in mappings:
+            writer.writerow(dataclasses.asdict(mapping))
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "inputs",
+        nargs="+",
+        help="catalog or input JSON files, directories containing them or manifest files listing them",
+    )
+    parser.add_argument(
+        "--model",
+        default=config["OPENAI_MODEL"],
+        help="the model to match the relation pairs with",
+    )
+    parser.add_argument(
+        "--output",
+        default="catalog_output",
+        help="directory to write the relation pairs and the mapping to",
+    )
+    parser.add_argument(
+        "--parallel-requests",
+        type=int,
+        default=config["PARALLEL_OPENAI_REQUESTS"],
+        help="maximum number of parallel requests shared by all relation pairs",
+    )
+    parser.add_argument(
+        "--targets-per-source",
+        type=int,
+        default=config["CATALOG_TARGETS_PER_SOURCE"],
+        help="number of most similar target relations matched with each source relation",
+    )
+    parser.add_argument(
+        "--min-similarity",
+        type=float,
+        default=config["CATALOG_MIN_SIMILARITY"],
+        help="minimum similarity of a relation pair to be matched",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only print the selected relation pairs and the estimate of matching them",
+    )
+    args = parser.parse_args(argv)
+    sources, targets = load_relations(collect_inputs(args.inputs))
+    pairs = select_relation_pairs(
+        sources, targets, args.targets_per_source, args.min_similarity
+    )
+    print(
+        f"Matching {len(pairs)} of {len(sources) * len(targets)} relation pairs "
+        f"({len(sources)} source and {len(targets)} target relations)."
+    )
+    if args.dry_run:
+        latency_model = LatencyModel()
+        estimates = []
+        for pair in pairs:
+            estimate = estimate_run(
+                catalog_parameters(pair, args.model), latency_model=latency_model
+            )
+            print(
+                f"{pair.source.name} -> {pair.target.name} "
+                f"(similarity {pair.similarity:.2f}): {estimate.summary()}"
+            )
+            estimates.append(estimate)
+        print(
+            f"Total: {describe(estimates, combined_duration(estimates, args.parallel_requests))}"
+        )
+        return
+
+    def progress(pair: RelationPair) -> None:
+        status = "failed" if pair.error else "done"
+        print(f"[{status}] {pair.source.name} -> {pair.target.name}")
+
+    catalog = asyncio.run(
+        match_catalog_async(
+            sources,
+            targets,
+            args.model,
+            Scheduler(args.parallel_requests),
+            pairs=pairs,
+            progress=progress,
+        )
+    )
+    os.makedirs(args.output, exist_ok=True)
+    write_pairs(os.path.join(args.output, "relation_pairs.csv"), catalog.pairs)
+    write_mappings(os.path.join(args.output, "mapping.csv"), catalog.mappings)
+    print(
+        f"{len(catalog.mappings)} attribute mappings written to "
+        f"{os.path.join(args.output, 'mapping.csv')}."
+    )
+
+
+if __name__ == "__main__":
+    main()
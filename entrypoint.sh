@@ -6,5 +6,10 @@ if [ -n "$SECRET_APP_PASSWORD" ]; then
 	echo "password = \"$SECRET_APP_PASSWORD\"\n" > .streamlit/secrets.toml
 fi
 
+# print the import time breakdown of the app to track cold start performance
+if [ -n "$STARTUP_REPORT" ]; then
+	python -m utils.startup_report --json > "$STARTUP_REPORT"
+fi
+
 # start the app
 python -m streamlit run --server.port 8501 --server.address 0.0.0.0 --server.enableCORS false --server.enableXsrfProtection false main.py
@@ -1,14 +1,19 @@
 from copy import deepcopy
+import dataclasses
 import hmac
 
 import streamlit as st
 
-from utils.backend import schema_match, get_available_openai_models
-from utils.models import Parameters, Relation, Vote
+from utils.backend import (
+    create_sql,
+    get_available_openai_models,
+)
+from utils.config import config
+from utils.models import Parameters, Relation
+from utils.scheduling import LatencyModel
+from utils.speculation import match, Speculator, speculation_key
 from utils.screen_feedback import create_feedback_screen
-from utils.screen_evaluation import create_evaluation_screen
 from utils.screen_load import create_load_screen
-from utils.screen_visualize import create_visualize_screen
 from utils.model_session_state import ModelSessionState
 from utils.storage import get_similar_results_by_parameters
 
@@ -61,6 +66,10 @@ if password_set() and not check_password():
 session_state_obj = st.session_state.get("session_state", None)
 if session_state_obj is None:
     st.session_state["session_state"] = session_state_obj = ModelSessionState()
+# matches the inputs in the background if SPECULATIVE_MATCHING is enabled
+speculator = st.session_state.get("speculator", None)
+if speculator is None:
+    st.session_state["speculator"] = speculator = Speculator()
 
 
 def _is_input_valid(relation: Relation) -> bool:
@@ -74,6 +83,55 @@ def _is_input_valid(relation: Relation) -> bool:
     return True
 
 
+def _current_parameters(mss: ModelSessionState) -> Parameters:
+    # create a deepcopy of all parameters to avoid changing params
+    # (e.g. descriptions) of older experiments in the visualization
+    # when changing descriptions in the input
+    return Parameters(
+        source_relation=deepcopy(mss.source_relation),
+        target_relation=deepcopy(mss.target_relation),
+        feedback=deepcopy(mss.feedback),
+        llm_model=mss.selected_llm,
+        cascade_model=mss.cascade_llm,
+    )
+
+
+def _speculate(mss: ModelSessionState) -> None:
+    """Start matching valid inputs in the background, before the user runs it."""
+    if not _is_input_valid(mss.source_relation) or not _is_input_valid(
+        mss.target_relation
+    ):
+        return
+    if not mss.source_relation.attributes or not mss.target_relation.attributes:
+        return
+    speculator.speculate(
+        _current_parameters(mss), [mss.selected_llm] + mss.compare_llms
+    )
+
+
+def _show_estimate(mss: ModelSessionState) -> None:
+    """Show the estimated requests, tokens, cost and duration of running the current inputs."""
+    # imported lazily as planning pulls in jinja2
+    from utils.planning import combined_duration, describe, estimate_run
+
+    params = _current_parameters(mss)
+    models = [mss.selected_llm] + mss.compare_llms
+    key = (speculation_key(params, models), tuple(config["PROMPT_DESIGNS"]))
+    cached = st.session_state.get("estimate", None)
+    if cached is None or cached[0] != key:
+        latency_model = LatencyModel()
+        estimates = [
+            estimate_run(
+                dataclasses.replace(params, llm_model=model),
+                latency_model=latency_model,
+            )
+            for model in models
+        ]
+        cached = (key, describe(estimates, combined_duration(estimates)))
+        st.session_state["estimate"] = cached
+    st.caption(f"Estimate: {cached[1]}")
+
+
 def _submit_button(mss: ModelSessionState):
     submittable = True
     if not _is_input_valid(mss.source_relation) or not _is_input_valid(
@@ -83,20 +141,25 @@ def _submit_button(mss: ModelSessionState):
     button_text = "Run Schema Matching Again"
     if mss.result is None:
         button_text = "Run Schema Matching"
+    if (
+        submittable
+        and mss.source_relation.attributes
+        and mss.target_relation.attributes
+    ):
+        _show_estimate(mss)
     if st.button(button_text, disabled=not submittable):
         mss.input_fixed = True
+        # the answers of the run change the estimate of running it again
+        st.session_state.pop("estimate", None)
         with st.spinner("Matching schemas..."):
-            # create a deepcopy of all parameters to avoid changing params
-            # (e.g. descriptions) of older experiments in the visualization
-            # when changing descriptions in the input
-            params = Parameters(
-                source_relation=deepcopy(mss.source_relation),
-                target_relation=deepcopy(mss.target_relation),
-                feedback=deepcopy(mss.feedback),
-                llm_model=mss.selected_llm,
-            )
-            result = schema_match(params)
-            mss.result = result
+            params = _current_parameters(mss)
+            # the run continues a speculation of the same inputs at interactive priority
+            speculator.take_over(params, [mss.selected_llm] + mss.compare_llms)
+            # all models run at once, the first additional one is compared to
+            results = match(params, [mss.selected_llm] + mss.compare_llms)
+            mss.result = results[0]
+            if mss.compare_llms:
+                mss.compare_to = results[1]
         st.rerun()
 
 
@@ -104,25 +167,7 @@ def _create_sql_button(mss: ModelSessionState) -> None:
     if mss.result is None:
         return
     if st.button("Create SQL"):
-        target_attributes = []
-        select_lines = []
-        for attr_pair, result in mss.result.pairs.items():
-            if (
-                sum([1 if d.vote == Vote.YES else 0 for d in result.votes])
-                >= st.session_state["edge_threshold_slider"]
-            ):
-                target_attributes.append(f"  {attr_pair.target.name}")
-                select_lines.append(
-                    f"  {attr_pair.source.name} AS {attr_pair.target.name}"
-                )
-        sql_string = (
-            f"INSERT INTO {mss.target_relation.name} (\n"
-            f"{',\n'.join(target_attributes)}"
-            "\n)\n"
-            "SELECT\n"
-            f"{',\n'.join(select_lines)}"
-            f"\nFROM {mss.source_relation.name};"
-        )
+        sql_string = create_sql(mss.result, st.session_state["edge_threshold_slider"])
         st.code(
             body=sql_string,
             language="sql",
@@ -134,6 +179,7 @@ def _create_sql_button(mss: ModelSessionState) -> None:
 with st.sidebar:
     # provide ability to reset the app
     if st.button("Reset App"):
+        speculator.cancel()
         # Delete all the items in streamlit session state
         for key in st.session_state.keys():
             del st.session_state[key]
@@ -149,6 +195,18 @@ with st.sidebar:
     )
     if llm_selected in valid_llms:
         session_state_obj.selected_llm = llm_selected
+    session_state_obj.compare_llms = st.multiselect(
+        "Also match with",
+        options=[llm for llm in valid_llms if llm != llm_selected],
+        help="Matches with these LLMs run at the same time as with the selected LLM.",
+    )
+    session_state_obj.cascade_llm = st.selectbox(
+        "Answer with a cheaper LLM first (cascade)",
+        options=[llm for llm in valid_llms if llm != llm_selected],
+        index=None,
+        placeholder="No cascade",
+        help="All prompts are answered by this LLM first. Only attribute pairs with split or unknown votes are asked again to the selected LLM.",
+    )
 
     # Select result version(s) to visualize
     if session_state_obj.result:
@@ -175,15 +233,20 @@ with st.sidebar:
         # only show compare-to option if at least 2 experiments exist.
         # Note that this can be None to disable comparison
         if selected is not None and len(similar_experiments) >= 2:
+            compare_options = [
+                result.name
+                for result in filter(lambda r: r.name != selected, similar_experiments)
+            ]
+            compare_index = None
+            if (
+                session_state_obj.compare_to is not None
+                and session_state_obj.compare_to.name in compare_options
+            ):
+                compare_index = compare_options.index(session_state_obj.compare_to.name)
             compare_to = st.selectbox(
                 "Compare to",
-                options=[
-                    result.name
-                    for result in filter(
-                        lambda r: r.name != selected, similar_experiments
-                    )
-                ],
-                index=None,
+                options=compare_options,
+                index=compare_index,
             )
             if compare_to is not None and (compare_to != selected):
                 session_state_obj.compare_to = next(
@@ -195,11 +258,19 @@ with st.sidebar:
 # Data loading part
 create_load_screen(session_state_obj)
 
-# Data visualization part
-create_visualize_screen(session_state_obj)
+# The result screens are imported lazily: they pull in heavy dependencies
+# (plotly, pandas, scikit-learn, ...) that are not needed to load a schema.
+if session_state_obj.result is not None:
+    # Data visualization part
+    from utils.screen_visualize import create_visualize_screen
+
+    create_visualize_screen(session_state_obj)
+
+    # Evaluation part
+    if session_state_obj.ground_truth_enabled:
+        from utils.screen_evaluation import create_evaluation_screen
 
-# Evaluation part
-create_evaluation_screen(session_state_obj)
+        create_evaluation_screen(session_state_obj)
 
 # Feedback part
 create_feedback_screen(session_state_obj)
@@ -207,5 +278,6 @@ create_feedback_screen(session_state_obj)
 st.divider()
 
 # (re)submit button
+_speculate(session_state_obj)
 _submit_button(session_state_obj)
 _create_sql_button(session_state_obj)
@@ -0,0 +1,303 @@
+"""An HTTP service that runs schema matching as asynchronous jobs.
+
+Start it with `python service.py --port 8080`. Endpoints:
+
+* `POST /jobs?deadline=30&priority=interactive`: submit a Parameters JSON object, returns the job (202, or 200 if a stored result exists; 429 if the queue is full). With a deadline (in seconds from the submission), the job returns an incomplete result once it passes. Jobs of a higher priority (interactive, default or bulk) are started and sent first
+* `GET /jobs/{id}`: the state and progress of a job
+* `GET /jobs/{id}/events`: a server-sent event stream of the job state until the job finished
+* `GET /jobs/{id}/result`: the Result JSON of a finished job
+* `GET /jobs/{id}/sql?threshold=2`: the SQL statement generated from the Result of a finished job
+* `GET /metrics`: the pipeline metrics in the Prometheus text format (if `TELEMETRY` is enabled)
+* `GET /scheduler`: the number of requests and their wait for a request slot per priority class
+"""
+
+import argparse
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from enum import StrEnum
+import itertools
+import json
+import time
+from typing import Any, Dict, List, Optional, Tuple
+import uuid
+
+from aiohttp import web
+
+from utils.backend import create_sql, schema_match_async
+from utils.config import config
+from utils.models import Parameters, Result
+from utils.scheduling import aged_rank, Priority, Scheduler
+from utils.storage import get_parameters_by_hash, get_result_by_parameters
+from utils.telemetry import telemetry
+
+
+class JobStatus(StrEnum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+@dataclass
+class Job:
+    parameters: Parameters
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: JobStatus = JobStatus.QUEUED
+    completed_prompts: int = 0
+    total_prompts: int = 0
+    result: Optional[Result] = None
+    error: Optional[str] = None
+    deadline: Optional[float] = None  # a time.monotonic() timestamp
+    priority: Priority = Priority.DEFAULT
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def finished(self) -> bool:
+        return self.status in (JobStatus.DONE, JobStatus.FAILED)
+
+    def update(self, **changes: Any) -> None:
+        """Change attributes of the job and wake up everyone waiting for a change."""
+        for k, v in changes.items():
+            setattr(self, k, v)
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "status": self.status.value,
+            "completed_prompts": self.completed_prompts,
+            "total_prompts": self.total_prompts,
+            "result": self.result.meta.get("path", None) if self.result else None,
+            "incomplete": (
+                self.result.meta.get("incomplete", False) if self.result else False
+            ),
+            "priority": self.priority.value,
+            "error": self.error,
+        }
+
+
+class _AgingQueue(asyncio.Queue):
+    """A queue of (priority, submission, job) entries that returns the job of the highest priority first, promoted by its wait like requests (see aged_rank), and the earliest submission within a priority."""
+
+    def _init(self, maxsize: int) -> None:
+        self._queue: List[Tuple[Priority, int, float, Job]] = []
+
+    def _put(self, item: Tuple[Priority, int, Job]) -> None:
+        priority, submission, job = item
+        self._queue.append((priority, submission, time.monotonic(), job))
+
+    def _get(self) -> Tuple[Priority, int, Job]:
+        now = time.monotonic()
+        # the queue is bounded by SERVICE_QUEUE_SIZE, a scan is cheap
+        i = min(
+            range(len(self._queue)),
+            key=lambda i: (
+                aged_rank(self._queue[i][0], now - self._queue[i][2]),
+                self._queue[i][1],
+            ),
+        )
+        priority, submission, _, job = self._queue.pop(i)
+        return priority, submission, job
+
+
+class JobManager:
+    """Runs jobs from a bounded queue on a fixed number of workers, which share one request budget. Jobs are started by priority, and in the order of their submission within a priority; jobs waiting for PRIORITY_AGING seconds move up one priority."""
+
+    def __init__(self, queue_size: int, workers: int, parallel_requests: int):
+        self.queue = _AgingQueue(maxsize=queue_size)
+        self._submissions = itertools.count()
+        self.jobs: OrderedDict[str, Job] = OrderedDict()
+        self.n_workers = workers
+        self.budget = Scheduler(parallel_requests)
+        self.workers: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        self.workers = [
+            asyncio.create_task(self._work()) for _ in range(self.n_workers)
+        ]
+
+    async def stop(self) -> None:
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+    def submit(
+        self,
+        parameters: Parameters,
+        deadline: Optional[float] = None,
+        priority: Priority = Priority.DEFAULT,
+    ) -> Job:
+        """Create a job for the parameters. Raises asyncio.QueueFull if no more jobs can be queued."""
+        job = Job(parameters=parameters, deadline=deadline, priority=priority)
+        stored_params = get_parameters_by_hash(parameters.digest())
+        result = None
+        if stored_params is not None:
+            result = get_result_by_parameters(stored_params)
+        # incomplete results are queued to be topped up
+        if result is not None and not result.meta.get("incomplete", False):
+            # the SQLite cache already knows the answer, no need to queue
+            job.update(status=JobStatus.DONE, result=result)
+        else:
+            self.queue.put_nowait((priority, next(self._submissions), job))
+        self._remember(job)
+        return job
+
+    def _remember(self, job: Job) -> None:
+        self.jobs[job.id] = job
+        # forget the oldest finished jobs to bound the memory usage
+        while len(self.jobs) > config["SERVICE_MAX_JOBS"]:
+            oldest = next(
+                (j for j in self.jobs.values() if j.finished()),
+                None,
+            )
+            if oldest is None:
+                break
+            del self.jobs[oldest.id]
+
+    async def _work(self) -> None:
+        while True:
+            _, _, job = await self.queue.get()
+            job.update(status=JobStatus.RUNNING)
+            try:
+                result = await schema_match_async(
+                    job.parameters,
+                    self.budget,
+                    progress=lambda done, total, job=job: job.update(
+                        completed_prompts=done, total_prompts=total
+                    ),
+                    deadline=job.deadline,
+                    priority=job.priority,
+                )
+                job.update(status=JobStatus.DONE, result=result)
+            except Exception as e:  # a failing job must not stop the worker
+                job.update(status=JobStatus.FAILED, error=repr(e))
+            finally:
+                self.queue.task_done()
+
+
+routes = web.RouteTableDef()
+
+
+def _get_job(request: web.Request) -> Job:
+    job = request.app["jobs"].jobs.get(request.match_info["job_id"], None)
+    if job is None:
+        raise web.HTTPNotFound(text="Unknown job.")
+    return job
+
+
+def _get_finished_job(request: web.Request) -> Job:
+    job = _get_job(request)
+    if job.status == JobStatus.FAILED:
+        raise web.HTTPConflict(text=f"The job failed: {job.error}")
+    if job.status != JobStatus.DONE:
+        raise web.HTTPConflict(text="The job is not done yet.")
+    return job
+
+
+@routes.post("/jobs")
+async def submit_job(request: web.Request) -> web.Response:
+    try:
+        parameters = Parameters.from_dict(await request.json())
+    except (ValueError, KeyError, TypeError) as e:
+        raise web.HTTPBadRequest(text=f"Invalid parameters: {e!r}")
+    deadline = None
+    if "deadline" in request.query:
+        try:
+            deadline = time.monotonic() + float(request.query["deadline"])
+        except ValueError:
+            raise web.HTTPBadRequest(text="The deadline must be a number of seconds.")
+    try:
+        priority = Priority(request.query.get("priority", Priority.DEFAULT))
+    except ValueError:
+        raise web.HTTPBadRequest(
+            text=f"The priority must be one of {', '.join(Priority)}."
+        )
+    try:
+        job = request.app["jobs"].submit(parameters, deadline, priority)
+    except asyncio.QueueFull:
+        raise web.HTTPTooManyRequests(
+            text="Too many queued jobs, try again later.",
+            headers={"Retry-After": "30"},
+        )
+    return web.json_response(job.to_dict(), status=200 if job.finished() else 202)
+
+
+@routes.get("/jobs/{job_id}")
+async def get_job(request: web.Request) -> web.Response:
+    return web.json_response(_get_job(request).to_dict())
+
+
+@routes.get("/jobs/{job_id}/events")
+async def stream_job(request: web.Request) -> web.StreamResponse:
+    job = _get_job(request)
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    while True:
+        changed = job.changed
+        await response.write(f"data: {json.dumps(job.to_dict())}\n\n".encode())
+        if job.finished():
+            break
+        await changed.wait()
+    await response.write_eof()
+    return response
+
+
+@routes.get("/jobs/{job_id}/result")
+async def get_job_result(request: web.Request) -> web.Response:
+    job = _get_finished_job(request)
+    return web.Response(text=job.result.to_json(), content_type="application/json")
+
+
+@routes.get("/jobs/{job_id}/sql")
+async def get_job_sql(request: web.Request) -> web.Response:
+    job = _get_finished_job(request)
+    try:
+        threshold = int(request.query.get("threshold", 2))
+    except ValueError:
+        raise web.HTTPBadRequest(text="The threshold has to be an integer.")
+    return web.Response(text=create_sql(job.result, threshold))
+
+
+@routes.get("/metrics")
+async def get_metrics(request: web.Request) -> web.Response:
+    if not telemetry.enabled:
+        raise web.HTTPNotFound(text="Telemetry is disabled.")
+    return web.Response(
+        text=telemetry.prometheus_text(), content_type="text/plain", charset="utf-8"
+    )
+
+
+@routes.get("/scheduler")
+async def get_scheduler(request: web.Request) -> web.Response:
+    return web.json_response(request.app["jobs"].budget.wait_report())
+
+
+def create_app(
+    queue_size: int = config["SERVICE_QUEUE_SIZE"],
+    workers: int = config["SERVICE_WORKERS"],
+    parallel_requests: int = config["PARALLEL_OPENAI_REQUESTS"],
+) -> web.Application:
+    app = web.Application()
+    app.add_routes(routes)
+
+    async def job_manager(app: web.Application):
+        app["jobs"] = JobManager(queue_size, workers, parallel_requests)
+        app["jobs"].start()
+        yield
+        await app["jobs"].stop()
+
+    app.cleanup_ctx.append(job_manager)
+    return app
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args(argv)
+    web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
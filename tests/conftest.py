@@ -0,0 +1,22 @@
+import pytest
+
+from benchmarks.stand_in_llm import StandInLLM
+from utils.config import config
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """An empty SQLite database for the test."""
+    path = str(tmp_path / "test.sqlite3")
+    monkeypatch.setitem(config, "SQLITE_PATH", path)
+    return path
+
+
+@pytest.fixture
+def stand_in_llm(monkeypatch):
+    """A local stand-in for the OpenAI API, which all requests of the test are sent to."""
+    with StandInLLM(latency=0.05) as llm:
+        monkeypatch.setenv("OPENAI_BASE_URL", llm.base_url)
+        monkeypatch.setenv("OPENAI_API_KEY", "stand-in")
+        monkeypatch.setitem(config, "QUERY_OPENAI", True)
+        yield llm
@@ -0,0 +1,34 @@
+import time
+
+from batch import ground_truth_path, load_parameters
+from utils.backend import schema_match
+from utils.evaluation import evaluate_result, load_ground_truth
+from utils.models import Result
+from utils.prompt_postprocessing import MISSING_ANSWER
+
+INPUT = "test_inputs/Patients_Person.json"
+
+
+def test_evaluate_result_cut_short_by_deadline(database, stand_in_llm):
+    stand_in_llm.latency = 0.5
+    parameters = load_parameters(INPUT, "stand-in")
+    result = schema_match(parameters, deadline=time.monotonic() + 0.2)
+    assert result.meta.get("incomplete", False)
+    ground_truth = load_ground_truth(
+        ground_truth_path(INPUT),
+        result.parameters.source_relation,
+        result.parameters.target_relation,
+    )
+    # stored results are evaluated as well, e.g. in the evaluation screen
+    for evaluated in [result, Result.from_json(result.to_json())]:
+        missing = [
+            decision
+            for result_pair in evaluated.pairs.values()
+            for decision in result_pair.votes
+            if decision.explanation == MISSING_ANSWER
+        ]
+        assert missing
+        assert all(decision.answer is not None for decision in missing)
+        evaluation = evaluate_result(evaluated, ground_truth)
+        assert evaluation
+        assert all(0.0 <= scope["f1-score"] <= 1.0 for scope in evaluation)
@@ -0,0 +1,42 @@
+import asyncio
+
+from batch import load_parameters
+from utils.backend import schema_match, schema_match_async
+from utils.config import config
+from utils.prompt_postprocessing import FAILED_ANSWER
+from worker import work
+
+INPUT = "test_inputs/simple_example.json"
+
+
+def _explanations(result):
+    return {
+        decision.explanation
+        for result_pair in result.pairs.values()
+        for decision in result_pair.votes
+    }
+
+
+def test_failed_prompts_in_process(database, stand_in_llm):
+    stand_in_llm.invalid_rate = 1.0
+    result = schema_match(load_parameters(INPUT, "stand-in"))
+    assert result.meta["incomplete"]
+    assert _explanations(result) == {FAILED_ANSWER}
+
+
+def test_failed_prompts_in_queue(database, stand_in_llm, monkeypatch):
+    monkeypatch.setitem(config, "PROMPT_QUEUE", True)
+    stand_in_llm.invalid_rate = 1.0
+
+    async def run():
+        match = asyncio.create_task(
+            schema_match_async(load_parameters(INPUT, "stand-in"))
+        )
+        while not match.done():
+            await work("test", 4, exit_when_empty=True)
+            await asyncio.sleep(0.1)
+        return match.result()
+
+    result = asyncio.run(run())
+    assert result.meta["incomplete"]
+    assert _explanations(result) == {FAILED_ANSWER}
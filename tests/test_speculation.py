@@ -0,0 +1,36 @@
+import asyncio
+import time
+
+from batch import load_parameters
+from utils import speculation
+from utils.config import config
+from utils.storage import get_parameters_by_hash, get_similar_results_by_parameters
+
+
+def _wait_for_background_tasks() -> None:
+    """Wait until the cancelled tasks of the background loop have stopped, as they use the database of the test until then."""
+
+    async def pending() -> int:
+        return len(asyncio.all_tasks()) - 1
+
+    loop = speculation._background_loop()
+    while asyncio.run_coroutine_threadsafe(pending(), loop).result():
+        time.sleep(0.05)
+
+
+def test_cancelled_speculation_leaves_no_results(database, stand_in_llm, monkeypatch):
+    monkeypatch.setitem(config, "SPECULATIVE_MATCHING", True)
+    stand_in_llm.latency = 1.0
+    parameters = load_parameters("test_inputs/simple_example.json", "stand-in")
+    speculator = speculation.Speculator()
+    speculator.speculate(parameters, ["stand-in"])
+    (stored,) = speculation._model_parameters(parameters, ["stand-in"])
+    # the speculation stores its parameters before sending the first prompt
+    for _ in range(100):
+        if get_parameters_by_hash(stored.digest()) is not None:
+            break
+        time.sleep(0.05)
+    assert get_parameters_by_hash(stored.digest()) is not None
+    speculator.cancel()
+    _wait_for_background_tasks()
+    assert get_similar_results_by_parameters(parameters) == []
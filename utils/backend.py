@@ -1,18 +1,38 @@
-from typing import List
+import asyncio
+import dataclasses
+import time
+from typing import TYPE_CHECKING, Callable, List, Optional
 
 from .config import config
-from .models import Answer, Feedback, Parameters, PromptAttributePair, Relation, Result
-from .prompt_sending import send_prompts
-from .prompt_building import build_prompts, PromptDesign
-from .prompt_postprocessing import postprocess_answers
+from .models import (
+    Answer,
+    AttributePair,
+    Feedback,
+    Parameters,
+    Prompt,
+    PromptAttributePair,
+    Relation,
+    Result,
+    ResultPair,
+    Vote,
+)
+from .scheduling import Priority, Scheduler
+from .telemetry import telemetry
 from .storage import (
     store_parameters,
     store_result,
+    store_run_plan,
+    update_parameters,
+    get_answers_by_prompt,
     get_parameters_by_hash,
     get_result_by_parameters,
+    get_run_plan,
     _id_from_path,
 )
 
+if TYPE_CHECKING:
+    from .prompt_building import PromptDesign
+
 
 def get_available_openai_models() -> List[str]:
     if config["OPENAI_MODEL"] in config["OPENAI_MODELS"]:
@@ -20,12 +40,125 @@ def get_available_openai_models() -> List[str]:
     return [config["OPENAI_MODEL"]] + config["OPENAI_MODELS"]
 
 
+def estimate_cost(
+    model: Optional[str],
+    prompt_tokens: Optional[int],
+    completion_tokens: Optional[int],
+    cached_tokens: Optional[int] = None,
+) -> Optional[float]:
+    """Estimate the cost (in USD) of token usage using the OPENAI_PRICES of the longest matching model name prefix. Returns None for unknown models or usage. Reasoning tokens are part of the completion tokens."""
+    prefixes = [p for p in config["OPENAI_PRICES"] if model and model.startswith(p)]
+    if not prefixes or prompt_tokens is None or completion_tokens is None:
+        return None
+    input_price, cached_price, output_price = config["OPENAI_PRICES"][
+        max(prefixes, key=len)
+    ]
+    cached_tokens = cached_tokens or 0
+    return (
+        (prompt_tokens - cached_tokens) * input_price
+        + cached_tokens * cached_price
+        + completion_tokens * output_price
+    ) / 1_000_000
+
+
+def create_sql(result: Result, vote_threshold: int) -> str:
+    """Create an SQL statement that moves the data of the source relation into the target relation, using all attribute pairs with at least vote_threshold yes-votes."""
+    target_attributes = []
+    select_lines = []
+    for attr_pair, result_pair in result.pairs.items():
+        if (
+            sum([1 if d.vote == Vote.YES else 0 for d in result_pair.votes])
+            >= vote_threshold
+        ):
+            target_attributes.append(f"  {attr_pair.target.name}")
+            select_lines.append(f"  {attr_pair.source.name} AS {attr_pair.target.name}")
+    return (
+        f"INSERT INTO {result.parameters.target_relation.name} (\n"
+        + ",\n".join(target_attributes)
+        + "\n)\n"
+        "SELECT\n"
+        + ",\n".join(select_lines)
+        + f"\nFROM {result.parameters.source_relation.name};"
+    )
+
+
 def schema_match(
     parameters: Parameters = None,
+    deadline: Optional[float] = None,
+    priority: Priority = Priority.DEFAULT,
+) -> Result:
+    """Perform schema matching on two tables. Either provide a set of parameters or two tables and a feedback object. If the deadline (a time.monotonic() timestamp) passes, an incomplete result is returned."""
+    return asyncio.run(
+        schema_match_async(parameters, deadline=deadline, priority=priority)
+    )
+
+
+def schema_match_models(
+    parameters: Parameters,
+    models: List[str],
+    deadline: Optional[float] = None,
+    priority: Priority = Priority.DEFAULT,
+) -> List[Result]:
+    """Perform schema matching with several models at once. Returns a result per model, in the order of the models."""
+    return asyncio.run(
+        schema_match_models_async(
+            parameters, models, deadline=deadline, priority=priority
+        )
+    )
+
+
+async def schema_match_models_async(
+    parameters: Parameters,
+    models: List[str],
+    budget: Optional[Scheduler] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+    deadline: Optional[float] = None,
+    priority: Priority = Priority.DEFAULT,
+) -> List[Result]:
+    """Perform schema matching with several models concurrently. The requests of all models are interleaved in one scheduler that respects the limits of each model, so this takes about as long as the slowest model. The progress callback receives the completed and total prompts of all models."""
+    if budget is None:
+        budget = Scheduler()
+    progress_by_model = {}
+
+    def model_progress(model: str) -> Callable[[int, int], None]:
+        def update(done: int, total: int) -> None:
+            progress_by_model[model] = (done, total)
+            progress(
+                sum(d for d, _ in progress_by_model.values()),
+                sum(t for _, t in progress_by_model.values()),
+            )
+
+        return update
+
+    async with asyncio.TaskGroup() as tg:
+        tasks = [
+            tg.create_task(
+                schema_match_async(
+                    # a copy per model, as storing the parameters sets their path
+                    dataclasses.replace(parameters, llm_model=model, meta={}),
+                    budget,
+                    model_progress(model) if progress is not None else None,
+                    deadline,
+                    priority,
+                )
+            )
+            for model in models
+        ]
+    return [task.result() for task in tasks]
+
+
+async def schema_match_async(
+    parameters: Parameters = None,
+    budget: Optional[Scheduler] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+    deadline: Optional[float] = None,
+    priority: Priority = Priority.DEFAULT,
 ) -> Result:
-    """Perform schema matching on two tables. Either provide a set of parameters or two tables and a feedback object."""
+    """Perform schema matching on two tables within a running event loop. Concurrent experiments may share a request budget (a Scheduler), which limits the number of parallel requests of all of them and serves their requests by priority (e.g. interactive sessions before bulk batch runs). The progress callback receives the number of completed and total prompts. Once the deadline (a time.monotonic() timestamp, MATCH_DEADLINE seconds from now by default) passes, the result is built from the answers so far and flagged as incomplete; a later call with the same parameters tops up the missing answers."""
     if parameters is None:
         raise ValueError("You need to provide parameters for this method.")
+    if deadline is None and config["MATCH_DEADLINE"] > 0:
+        deadline = time.monotonic() + config["MATCH_DEADLINE"]
 
     stored_params = get_parameters_by_hash(parameters.digest())
     if stored_params is None:
@@ -33,67 +166,223 @@ def schema_match(
     else:
         parameters = stored_params
     result = get_result_by_parameters(parameters)
-    if result is not None:
+    if result is not None and not result.meta.get("incomplete", False):
         return result
-    prompts = build_prompts(
-        parameters,
-        templates=["oneToN", "nToOne", "nToN"],
-        modes=[PromptDesign.oneToN, PromptDesign.nToOne, PromptDesign.nToN],
-        model=parameters.llm_model,
-    )
 
-    if not config["QUERY_OPENAI"]:
-        # method stub
-        from .models import AttributePair, Decision, ResultPair, Vote
-        import itertools
-        import random
+    # imported lazily as these pull in jinja2, tenacity and the OpenAI SDK
+    from .planning import design_plan
+    from .prompt_building import build_prompts, DESIGN_TEMPLATES, PromptDesign
+    from .prompt_postprocessing import postprocess_answers
 
-        attribute_pairs = [
-            AttributePair(
-                source=src,
-                target=trgt,
+    experiment = str(_id_from_path(parameters.meta["path"]))
+    with telemetry.span(
+        "schema_match", experiment=experiment, model=parameters.llm_model
+    ):
+        # the designs are chosen once per parameters, resumed and topped-up runs keep them
+        plan = design_plan(parameters)
+        if "design_plan" not in parameters.meta:
+            # a copy, as the stored parameters are shared with other sessions
+            parameters = update_parameters(
+                dataclasses.replace(
+                    parameters,
+                    meta={**parameters.meta, "design_plan": plan.to_dict()},
+                )
             )
-            for (src, trgt) in itertools.product(
-                parameters.source_relation.attributes,
-                parameters.target_relation.attributes,
+        designs = [PromptDesign(design) for design in plan.designs]
+        # an interrupted run (e.g. by a restart) is resumed with the prompts it planned
+        prompts = get_run_plan(parameters, "match")
+        if not prompts:
+            prompts = build_prompts(
+                parameters,
+                templates=[DESIGN_TEMPLATES[design] for design in designs],
+                modes=designs,
+                # in a cascade, the cheaper model answers all prompts first
+                model=parameters.cascade_model or parameters.llm_model,
+                tiles=plan.tile_list(),
             )
-        ]
-        result = Result(
-            parameters=parameters,
-            pairs={
-                ap: ResultPair(
-                    ap,
-                    votes=[
-                        Decision(
-                            vote=rs,
-                            explanation="Testing",
-                            answer=Answer(
-                                PromptAttributePair(
-                                    [ap.source],
-                                    [ap.target],
-                                ),
-                                "testing",
-                                1,
-                                True,
-                            ),
-                        )
-                        for rs in random.choices(
-                            [Vote.YES, Vote.NO, Vote.UNKNOWN], weights=[1, 5, 2], k=3
-                        )
-                    ],
-                    score=0.0,
+            store_run_plan(parameters, prompts, "match")
+
+        if not config["QUERY_OPENAI"]:
+            result = _generate_random_result(parameters)
+        else:
+            answers = await _process_planned_prompts(
+                parameters, prompts, budget, progress, deadline, priority
+            )
+            result = postprocess_answers(parameters, answers, prompts)
+            if parameters.cascade_model:
+                result = await _escalate_contested_pairs(
+                    parameters,
+                    result,
+                    designs,
+                    budget,
+                    progress,
+                    deadline,
+                    priority,
+                    tiles=plan.tile_list(),
                 )
-                for ap in attribute_pairs
-            },
+        model = result.parameters.llm_model
+        if result.parameters.cascade_model:
+            model = f"{result.parameters.cascade_model} -> {model}"
+        result.name = (
+            f"Exp. {_id_from_path(result.parameters.meta['path'])}: "
+            f"{result.parameters.source_relation.name} -> "
+            f"{result.parameters.target_relation.name} "
+            f"({model}) "
         )
-    else:
-        answers = send_prompts(parameters, prompts)
-        result = postprocess_answers(parameters, answers)
-    result.name = (
-        f"Exp. {_id_from_path(result.parameters.meta['path'])}: "
-        f"{result.parameters.source_relation.name} -> "
-        f"{result.parameters.target_relation.name} "
-        f"({result.parameters.llm_model}) "
+        result = store_result(result)
+    telemetry.export(config["TELEMETRY_DIR"], experiment)
+    return result
+
+
+async def _process_planned_prompts(
+    parameters: Parameters,
+    prompts: List[Prompt],
+    budget: Optional[Scheduler] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+    deadline: Optional[float] = None,
+    priority: Priority = Priority.DEFAULT,
+) -> List[Answer]:
+    """Process the prompts of a run that are outstanding or under-filled according to the journal. The answers of finished prompts (of an earlier, interrupted run) are loaded instead."""
+    from .prompt_sending import process_prompt_list
+
+    finished = [
+        prompt
+        for prompt in prompts
+        if prompt.meta.get("valid_answers", 0) >= config["OPENAI_N"]
+    ]
+    outstanding = [
+        prompt
+        for prompt in prompts
+        if prompt.meta.get("valid_answers", 0) < config["OPENAI_N"]
+    ]
+    telemetry.count("resumed_prompts_total", len(finished))
+    answers = [
+        answer
+        for prompt in finished
+        for answer in get_answers_by_prompt(prompt, filter_valid=True)[
+            : config["OPENAI_N"]
+        ]
+    ]
+    return answers + await process_prompt_list(
+        parameters, outstanding, budget, progress, deadline, priority
+    )
+
+
+def is_contested(result_pair: ResultPair) -> bool:
+    """A pair is contested if its votes are split, unknown or missing."""
+    votes = {decision.vote for decision in result_pair.votes}
+    return len(votes) != 1 or Vote.UNKNOWN in votes
+
+
+async def _escalate_contested_pairs(
+    parameters: Parameters,
+    result: Result,
+    designs: List["PromptDesign"],
+    budget: Optional[Scheduler] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+    deadline: Optional[float] = None,
+    priority: Priority = Priority.DEFAULT,
+    tiles: Optional[List[Optional[int]]] = None,
+) -> Result:
+    """Re-ask the contested pairs of the first stage of a cascade to llm_model, using prompts of the same designs (and tiles) that only ask about these pairs (or the prompts planned by an interrupted run, extended by prompts for the pairs it did not plan). The votes of llm_model replace the first-stage votes, which are kept as superseded. Pairs that were not fully re-asked before the deadline keep their first-stage votes."""
+    from .prompt_building import build_prompts, DESIGN_TEMPLATES
+    from .prompt_postprocessing import postprocess_answers
+
+    contested = [
+        pair
+        for pair, result_pair in result.pairs.items()
+        if pair.source.included and pair.target.included and is_contested(result_pair)
+    ]
+    result.meta["cascade_model"] = parameters.cascade_model
+    result.meta["escalated_pairs"] = len(contested)
+    telemetry.count("escalated_pairs_total", len(contested))
+    if not contested:
+        return result
+    prompts = get_run_plan(parameters, "escalate")
+    # a resumed first stage may contest pairs that the stored plan does not ask about
+    planned = {
+        AttributePair(src, trgt)
+        for prompt in prompts
+        for src, trgt in prompt.attributes.pairs()
+    }
+    unplanned = [pair for pair in contested if pair not in planned]
+    if unplanned:
+        added = build_prompts(
+            parameters,
+            templates=[DESIGN_TEMPLATES[design] for design in designs],
+            modes=designs,
+            model=parameters.llm_model,
+            pairs=unplanned,
+            tiles=tiles,
+        )
+        store_run_plan(parameters, added, "escalate")
+        prompts = prompts + added
+    answers = await _process_planned_prompts(
+        parameters, prompts, budget, progress, deadline, priority
+    )
+    escalated = postprocess_answers(parameters, answers)
+    missing = {
+        AttributePair(src, trgt)
+        for prompt in prompts
+        if prompt.meta.get("missing_answers", 0) + prompt.meta.get("failed_answers", 0)
+        > 0
+        for src, trgt in prompt.attributes.pairs()
+    }
+    if missing:
+        result.meta["incomplete"] = True
+    for pair in contested:
+        # pairs without escalated answers keep their first-stage votes
+        escalated_pair = escalated.pairs.get(pair)
+        if pair in missing or escalated_pair is None or not escalated_pair.votes:
+            continue
+        result_pair = result.pairs[pair]
+        result_pair.superseded = result_pair.votes
+        result_pair.votes = escalated_pair.votes
+    return result
+
+
+def _generate_random_result(parameters: Parameters) -> Result:
+    """Generate a random result instead of prompting the LLM (used if QUERY_OPENAI is False)."""
+    from .models import AttributePair, Decision, ResultPair, Vote
+    import itertools
+    import random
+
+    attribute_pairs = [
+        AttributePair(
+            source=src,
+            target=trgt,
+        )
+        for (src, trgt) in itertools.product(
+            parameters.source_relation.attributes,
+            parameters.target_relation.attributes,
+        )
+    ]
+    result = Result(
+        parameters=parameters,
+        pairs={
+            ap: ResultPair(
+                ap,
+                votes=[
+                    Decision(
+                        vote=rs,
+                        explanation="Testing",
+                        answer=Answer(
+                            PromptAttributePair(
+                                [ap.source],
+                                [ap.target],
+                            ),
+                            "testing",
+                            1,
+                            True,
+                        ),
+                    )
+                    for rs in random.choices(
+                        [Vote.YES, Vote.NO, Vote.UNKNOWN], weights=[1, 5, 2], k=3
+                    )
+                ],
+                score=0.0,
+            )
+            for ap in attribute_pairs
+        },
     )
-    result = store_result(result)
     return result
@@ -0,0 +1,194 @@
+"""Matching of whole databases: many source relations onto many target relations (e.g. all tables of a MIMIC-style database onto the OMOP CDM).
+
+Matching every attribute of every relation pair would be far too many requests. The relation pairs are therefore ranked by the lexical similarity of their names, descriptions and attributes first, and only the most similar targets of each source relation are matched. These matches run concurrently under one request budget, store their results like any other experiment and are consolidated into a single attribute mapping across all relations.
+"""
+
+import asyncio
+import dataclasses
+from typing import Callable, Dict, List, Optional, Set
+
+from .backend import schema_match_async
+from .config import config
+from .models import Attribute, Feedback, Parameters, Relation, Result, Vote
+from .scheduling import Priority, Scheduler
+
+
+def _ngrams(s: str, n: int = 3) -> Set[str]:
+    full_s = f"{'#' * (n - 1)}{s.lower()}{'%' * (n - 1)}"
+    return {full_s[i : i + n] for i in range(len(full_s) - n + 1)}
+
+
+def _similarity(a: Set[str], b: Set[str]) -> float:
+    """The Jaccard similarity of two sets of n-grams."""
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+
+def _attribute_ngrams(attribute: Attribute) -> Set[str]:
+    return _ngrams(f"{attribute.name} {attribute.description or ''}")
+
+
+def relation_similarity(source: Relation, target: Relation) -> float:
+    """How likely a source relation maps onto a target relation, between 0 and 1: the mean of the similarity of their names and descriptions and of the share of source attributes that have a similar target attribute (the mean of their best attribute similarities)."""
+    relation = _similarity(
+        _ngrams(f"{source.name} {source.description or ''}"),
+        _ngrams(f"{target.name} {target.description or ''}"),
+    )
+    sources = [_attribute_ngrams(a) for a in source.attributes if a.included]
+    targets = [_attribute_ngrams(a) for a in target.attributes if a.included]
+    if not sources or not targets:
+        return relation / 2
+    coverage = sum(max(_similarity(s, t) for t in targets) for s in sources) / len(
+        sources
+    )
+    return (relation + coverage) / 2
+
+
+@dataclasses.dataclass
+class RelationPair:
+    source: Relation
+    target: Relation
+    similarity: float
+    # the stored result of matching the pair, once matched
+    result: Optional[Result] = None
+    error: Optional[str] = None
+
+
+def select_relation_pairs(
+    sources: List[Relation],
+    targets: List[Relation],
+    targets_per_source: Optional[int] = None,
+    min_similarity: Optional[float] = None,
+) -> List[RelationPair]:
+    """The relation pairs worth matching: the targets_per_source (CATALOG_TARGETS_PER_SOURCE by default) most similar targets of each source relation, of at least min_similarity (CATALOG_MIN_SIMILARITY by default). Ordered by source, most similar first."""
+    if targets_per_source is None:
+        targets_per_source = config["CATALOG_TARGETS_PER_SOURCE"]
+    if min_similarity is None:
+        min_similarity = config["CATALOG_MIN_SIMILARITY"]
+    pairs = []
+    for source in sources:
+        ranked = sorted(
+            (
+                RelationPair(source, target, relation_similarity(source, target))
+                for target in targets
+            ),
+            key=lambda pair: pair.similarity,
+            reverse=True,
+        )
+        pairs.extend(
+            pair
+            for pair in ranked[:targets_per_source]
+            if pair.similarity >= min_similarity
+        )
+    return pairs
+
+
+def catalog_parameters(pair: RelationPair, model: str) -> Parameters:
+    return Parameters(
+        source_relation=pair.source,
+        target_relation=pair.target,
+        # the app starts with an empty general feedback, use the same to share stored results
+        feedback=Feedback(general=""),
+        llm_model=model,
+    )
+
+
+@dataclasses.dataclass
+class Mapping:
+    """An attribute of a source relation that maps onto an attribute of a target relation."""
+
+    source_relation: str
+    source_attribute: str
+    target_relation: str
+    target_attribute: str
+    yes_votes: int
+    votes: int
+    # whether this is the target with the most yes votes of the source attribute
+    best: bool = False
+    result: str = ""
+
+
+def consolidate(pairs: List[RelationPair]) -> List[Mapping]:
+    """The attribute pairs of all matched relation pairs with more than half of their votes yes. A source attribute may map onto attributes of several target relations, the one with the largest share of yes votes is marked as best."""
+    mappings = []
+    for pair in pairs:
+        if pair.result is None:
+            continue
+        for attribute_pair, result_pair in pair.result.pairs.items():
+            votes = [decision.vote for decision in result_pair.votes]
+            if votes.count(Vote.YES) * 2 <= len(votes):
+                continue
+            mappings.append(
+                Mapping(
+                    source_relation=pair.source.name,
+                    source_attribute=attribute_pair.source.name,
+                    target_relation=pair.target.name,
+                    target_attribute=attribute_pair.target.name,
+                    yes_votes=votes.count(Vote.YES),
+                    votes=len(votes),
+                    result=pair.result.meta.get("path", ""),
+                )
+            )
+    mappings.sort(
+        key=lambda m: (
+            m.source_relation,
+            m.source_attribute,
+            -m.yes_votes / m.votes,
+            m.target_relation,
+            m.target_attribute,
+        )
+    )
+    best: Dict[tuple, Mapping] = {}
+    for mapping in mappings:
+        best.setdefault((mapping.source_relation, mapping.source_attribute), mapping)
+    for mapping in best.values():
+        mapping.best = True
+    return mappings
+
+
+@dataclasses.dataclass
+class CatalogResult:
+    pairs: List[RelationPair]
+    mappings: List[Mapping]
+
+
+async def match_catalog_async(
+    sources: List[Relation],
+    targets: List[Relation],
+    model: Optional[str] = None,
+    budget: Optional[Scheduler] = None,
+    priority: Priority = Priority.BULK,
+    pairs: Optional[List[RelationPair]] = None,
+    progress: Optional[Callable[[RelationPair], None]] = None,
+) -> CatalogResult:
+    """Match the selected relation pairs (see select_relation_pairs) concurrently, sharing a request budget (PARALLEL_OPENAI_REQUESTS by default), and consolidate their results. A failing pair is recorded with its error and does not stop the others. The progress callback is called with each relation pair once it is matched or failed."""
+    if model is None:
+        model = config["OPENAI_MODEL"]
+    if budget is None:
+        budget = Scheduler()
+    if pairs is None:
+        pairs = select_relation_pairs(sources, targets)
+
+    async def match(pair: RelationPair) -> None:
+        try:
+            pair.result = await schema_match_async(
+                catalog_parameters(pair, model), budget, priority=priority
+            )
+        except Exception as e:  # keep going with all other pairs
+            pair.error = repr(e)
+        if progress is not None:
+            progress(pair)
+
+    async with asyncio.TaskGroup() as tg:
+        for pair in pairs:
+            tg.create_task(match(pair))
+    return CatalogResult(pairs, consolidate(pairs))
+
+
+def match_catalog(
+    sources: List[Relation],
+    targets: List[Relation],
+    model: Optional[str] = None,
+    priority: Priority = Priority.BULK,
+) -> CatalogResult:
+    """Match many source relations onto many target relations, see match_catalog_async."""
+    return asyncio.run(match_catalog_async(sources, targets, model, priority=priority))
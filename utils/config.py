@@ -1,3 +1,4 @@
+import json
 import os
 
 default_config = {
@@ -9,18 +10,70 @@ default_config = {
         "o3-2025-04-16",
         "gpt-4.1-mini-2025-04-14",
         "gpt-4.1-nano-2025-04-14",
-
     ],  # a list of alternative models choosable in LLM-matcher
     "OPENAI_N": 3,  # the number of answers to generate per prompt
     "OPENAI_TEMPERATURE": 1.0,  # the model temperature to use
     "OPENAI_TIMEOUT": 60,  # the timeout for OpenAI API calls
     "TEMPLATE_DIR": "resources/prompt_templates",  # the directory where prompt templates are stored
+    "PROMPT_DESIGNS": [
+        "1-n",
+        "n-1",
+        "n-n",
+    ],  # the prompt designs used for matching: "1-1" (packed pairs), "1-n", "n-1" and "n-n"
+    "PROMPT_DESIGN_SELECTION": "auto",  # "auto" to choose among PROMPT_DESIGNS and tile large prompts per run (see utils/planning.py), or "fixed" to always run all PROMPT_DESIGNS untiled
+    "PROMPT_MAX_TOKENS": 16000,  # with automatic design selection, the approximate maximum prompt size (in tokens) of 1-to-N, N-to-1 and N-to-M prompts; larger prompts are split into tiles of fewer attributes. Set this to 0 to never tile prompts.
+    "RUN_TOKEN_BUDGET": 0,  # with automatic design selection and if above 0, the maximum estimated tokens of a run; the designs with the best F1-score per token are run first
+    "PACKED_PROMPT_TOKENS": 2000,  # the approximate prompt size (in tokens) of packed 1-to-1 prompts, which determines the number of pairs per prompt
+    "ANSWER_MODE": "text",  # "text", or "structured" to request answers as JSON following a schema (structured outputs), which avoids invalid answers
+    "PROMPT_LAYOUT": "default",  # the prompt template layout: "default", or "cached" to start all prompts of a design with the same content, which allows providers to reuse cached prompt prefixes
+    "PROMPT_ORDER": "longest-first",  # the order in which the prompts of a run are sent: "longest-first" by their expected latency, which shortens the total time of a run, or "planned" in the order of the prompt designs
     "PARALLEL_OPENAI_REQUESTS": 5,  # the maximum number of parallel requests that will be sent to the OpenAI API (lower this to fix frequent RateLimitErrors)
+    "MODEL_PARALLEL_REQUESTS": {},  # the maximum number of parallel requests per model (by model name prefix), within PARALLEL_OPENAI_REQUESTS
+    "PRIORITY_AGING": 30,  # the seconds after which a waiting request is promoted to the next higher priority class (interactive, default, bulk), so that bulk work keeps moving. Set this to 0 to serve classes strictly by priority.
+    "SHARED_PARALLEL_REQUESTS": 0,  # if above 0, the maximum number of parallel requests of all processes that use the same SQLITE_PATH (e.g. app replicas and batch runs on a host)
+    "SHARED_TOKENS_PER_MINUTE": 0,  # if above 0, the maximum number of tokens per minute of all processes that use the same SQLITE_PATH
+    "LEASE_TIMEOUT": 300,  # the seconds after which the shared capacity leased by a request is freed, in case its process crashed. This should exceed the longest request including retries.
+    "PROMPT_QUEUE": False,  # if set to True, prompts are queued in the database and sent by worker processes (see worker.py) instead of the matching process (requires SQLITE_PATH)
+    "QUEUE_VISIBILITY_TIMEOUT": 600,  # the seconds after which a queued prompt that a worker claimed but did not finish is claimed again (e.g. if the worker crashed)
+    "QUEUE_MAX_ATTEMPTS": 3,  # the number of times a worker tries a queued prompt before it is marked as failed
+    "MATCH_DEADLINE": 0,  # if above 0, matching returns an incomplete result after this many seconds, which is topped up by matching the same parameters again
+    "HEDGE_PERCENTILE": 0.0,  # if above 0, a duplicate of a request is sent once it takes longer than this percentile (e.g. 95) of the latencies of the other requests of the experiment, and the first valid response is used
+    "HEDGE_BUDGET": 0.05,  # the maximum share of requests that may be duplicated by hedging
+    "HEDGE_PARALLEL_REQUESTS": 2,  # the maximum number of parallel duplicated requests, which take free slots within PARALLEL_OPENAI_REQUESTS and MODEL_PARALLEL_REQUESTS
+    "HEDGE_MIN_SAMPLES": 10,  # the number of completed requests of an experiment before requests are hedged
+    "SPECULATIVE_MATCHING": False,  # if set to True, the app starts matching valid inputs at bulk priority in the background, so that most answers exist once the user runs matching
+    "SPECULATIVE_PARALLEL_REQUESTS": 2,  # the maximum number of parallel requests of all speculative matching in the app process, within PARALLEL_OPENAI_REQUESTS shared with the runs of all sessions
+    "CATALOG_TARGETS_PER_SOURCE": 3,  # when matching whole databases (see catalog.py), the number of most similar target relations that each source relation is matched with
+    "CATALOG_MIN_SIMILARITY": 0.1,  # when matching whole databases, the minimum similarity (between 0 and 1) of the names, descriptions and attributes of a relation pair to be matched
     "SQLITE_PATH": "dev.sqlite3",  # the path to the SQLite database file. Set this to None to disable storage.
+    "RESULT_CACHE_MB": 256,  # the maximum size (in MB of serialized JSON) of the process-wide cache of Results and Parameters loaded from the database. Set this to 0 to disable caching.
+    "SERVICE_QUEUE_SIZE": 32,  # the maximum number of jobs waiting in the HTTP service, more submissions are rejected
+    "SERVICE_WORKERS": 4,  # the number of jobs the HTTP service runs concurrently
+    "SERVICE_MAX_JOBS": 1000,  # the number of jobs the HTTP service remembers, the oldest finished jobs are forgotten first
+    "OPENAI_PRICES": {
+        "gpt-4.1-nano": [0.10, 0.025, 0.40],
+        "gpt-4.1-mini": [0.40, 0.10, 1.60],
+        "gpt-4.1": [2.00, 0.50, 8.00],
+        "o3-mini": [1.10, 0.55, 4.40],
+        "o3": [2.00, 0.50, 8.00],
+        "o4-mini": [1.10, 0.275, 4.40],
+    },  # USD per million input, cached input and output tokens by model name prefix, used to estimate costs
+    "TELEMETRY": False,  # if set to True, spans and metrics of the matching pipeline are recorded
+    "TELEMETRY_DIR": "telemetry",  # the directory that traces and metrics are exported to after each experiment (if TELEMETRY is True)
 }
 
+
+def _typecast(value, default):
+    """Cast a value from the environment to the type of its default. Booleans are only true for "true", "1" or "yes" (as bool("False") is True), lists and dicts are given as JSON."""
+    if isinstance(default, bool) and isinstance(value, str):
+        return value.strip().lower() in ("true", "1", "yes")
+    if isinstance(default, (list, dict)) and isinstance(value, str):
+        return type(default)(json.loads(value))
+    return type(default)(value)
+
+
 config = {
     # use the environment variables if set (typecasted to the type given in default_config), other use default_config values
-    k: None if os.getenv(k, v) == "None" else type(default_config[k])(os.getenv(k, v))
+    k: None if os.getenv(k, v) == "None" else _typecast(os.getenv(k, v), v)
     for k, v in default_config.items()
 }
@@ -0,0 +1,121 @@
+"""Evaluation of Results against a ground truth, independent of the Streamlit app."""
+
+from collections import Counter
+import csv
+from typing import Dict, List, Optional
+
+from .models import Answer, AttributePair, Relation, Result, TaskScope, Vote
+
+
+def load_ground_truth(
+    path: str, source_relation: Relation, target_relation: Relation
+) -> List[AttributePair]:
+    """Read a ground truth CSV file with the columns `source` and `target`. Rows naming unknown attributes are skipped."""
+    source_attrs = {a.name: a for a in source_relation.attributes}
+    target_attrs = {a.name: a for a in target_relation.attributes}
+    ground_truth = []
+    with open(path, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            if row["source"] in source_attrs and row["target"] in target_attrs:
+                ground_truth.append(
+                    AttributePair(
+                        source_attrs[row["source"]], target_attrs[row["target"]]
+                    )
+                )
+    return ground_truth
+
+
+# the task scope of each prompt design
+DESIGN_SCOPES = {
+    "1-1": TaskScope.oneToOne,
+    "1-n": TaskScope.oneToN,
+    "n-1": TaskScope.nToOne,
+    "n-n": TaskScope.nToN,
+}
+
+
+def which_scope_is(answer: Answer) -> TaskScope:
+    # targeted prompts may ask about a single pair in any design
+    if answer.meta.get("design", None) in DESIGN_SCOPES:
+        return DESIGN_SCOPES[answer.meta["design"]]
+    if answer.attributes.paired:
+        return TaskScope.oneToOne
+    if len(answer.attributes.sources) > 1:
+        if len(answer.attributes.targets) > 1:
+            return TaskScope.nToN
+        return TaskScope.nToOne
+    if len(answer.attributes.targets) > 1:
+        return TaskScope.oneToN
+    return TaskScope.oneToOne
+
+
+def get_votes_by_scope(
+    result: Result, scope: TaskScope
+) -> Dict[AttributePair, List[Vote]]:
+    votes = {}
+    for pair, result_pair in result.pairs.items():
+        votes[pair] = []
+        for vote in result_pair.votes:
+            # missing answers of results stored before they were linked to their prompt
+            if vote.answer is not None and which_scope_is(vote.answer) == scope:
+                votes[pair].append(vote.vote)
+    return votes
+
+
+def majority_vote(votes: List[Vote]) -> Vote:
+    """Return the majority vote, which is unknown if no vote occurs at least twice (e.g. a three-way tie)."""
+    if not votes:
+        return Vote.UNKNOWN
+    vote, count = Counter(votes).most_common(1)[0]
+    if count == 1:
+        return Vote.UNKNOWN
+    return vote
+
+
+def evaluate_result(
+    result: Result,
+    ground_truth: List[AttributePair],
+    scopes: Optional[List[TaskScope]] = None,
+) -> List[Dict[str, float]]:
+    """Compute precision, recall and F1-score of the majority votes per task scope. Unknown decisions count as non-matches. By default, all task scopes with votes in the result are evaluated."""
+    if scopes is None:
+        found = {
+            which_scope_is(decision.answer)
+            for result_pair in result.pairs.values()
+            for decision in result_pair.votes
+            if decision.answer is not None
+        }
+        scopes = [scope for scope in TaskScope if scope in found]
+    truth = set(ground_truth)
+    evaluation = []
+    for scope in scopes:
+        tp = fp = fn = unknown = 0
+        votes = get_votes_by_scope(result, scope)
+        for pair, pair_votes in votes.items():
+            decision = majority_vote(pair_votes)
+            if decision == Vote.UNKNOWN:
+                unknown += 1
+            if decision == Vote.YES:
+                if pair in truth:
+                    tp += 1
+                else:
+                    fp += 1
+            elif pair in truth:
+                fn += 1
+        precision = tp / (tp + fp) if tp + fp > 0 else 0.0
+        recall = tp / (tp + fn) if tp + fn > 0 else 0.0
+        f1 = (
+            2 * precision * recall / (precision + recall)
+            if precision + recall > 0
+            else 0.0
+        )
+        evaluation.append(
+            {
+                "task_scope": scope.value,
+                "precision": precision,
+                "recall": recall,
+                "f1-score": f1,
+                "decisiveness": 1 - unknown / len(votes) if votes else 0.0,
+            }
+        )
+    return evaluation
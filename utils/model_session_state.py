@@ -18,6 +18,8 @@ class ModelSessionState:
     experiment_counter: int = 0 # used for generating unique ids for experiments
     selected_attrs: list[int] = field(default_factory=list)
     selected_llm: str = None  # llm selected by the user (will be persisted in the parameters
+    compare_llms: List[str] = field(default_factory=list)  # further llms that match at the same time, to compare to
+    cascade_llm: Optional[str] = None  # a cheaper llm that answers first in a cascade, None to disable
     ground_truth: List[AttributePair] = field(default_factory=list)  # a list of attribute pairs that represent the ground truth
     ground_truth_enabled: bool = False
 
@@ -1,10 +1,13 @@
 from dataclasses import asdict, dataclass, field
 from enum import StrEnum
 import hashlib
+import itertools
 import json
-from typing import Any, Dict, List, Optional
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
-from openai.types.completion_create_params import CompletionCreateParams
+if TYPE_CHECKING:
+    # only needed for type hints, importing the OpenAI SDK is slow
+    from openai.types.completion_create_params import CompletionCreateParams
 
 
 class Vote(StrEnum):
@@ -141,6 +144,8 @@ class Parameters:
     target_relation: Relation
     llm_model: str
     feedback: Feedback = field(default_factory=Feedback)
+    # a cheaper model that answers all prompts first, only contested pairs are re-asked to llm_model
+    cascade_model: Optional[str] = None
     meta: Dict[str, str] = field(default_factory=dict)
 
     def digest(self) -> str:
@@ -150,6 +155,8 @@ class Parameters:
                 + self.target_relation.digest()
                 + self.feedback.digest()
                 + self.llm_model
+                # only included if set to keep the digests of earlier parameters
+                + (f"cascade:{self.cascade_model}" if self.cascade_model else "")
             ).encode()
         ).hexdigest()
 
@@ -160,6 +167,7 @@ class Parameters:
             target_relation=Relation.from_dict(data["target_relation"]),
             llm_model=data.get("llm_model", ""),
             feedback=Feedback.from_dict(data.get("feedback", {})),
+            cascade_model=data.get("cascade_model", None),
             meta=data.get("meta", {}),
         )
 
@@ -177,8 +185,19 @@ class Parameters:
 class PromptAttributePair:
     sources: List[Attribute] = field(default_factory=list)
     targets: List[Attribute] = field(default_factory=list)
+    # if True, the i-th source is only paired with the i-th target (packed 1-to-1 prompts)
+    paired: bool = False
 
     def digest(self) -> str:
+        if self.paired:
+            # the order of paired attributes matters
+            return hashlib.blake2b(
+                (
+                    "paired"
+                    + "".join([a.digest() for a in self.sources])
+                    + "".join([a.digest() for a in self.targets])
+                ).encode()
+            ).hexdigest()
         return hashlib.blake2b(
             (
                 "".join([a.digest() for a in sorted(self.sources)])
@@ -186,11 +205,18 @@ class PromptAttributePair:
             ).encode()
         ).hexdigest()
 
+    def pairs(self) -> List[Tuple[Attribute, Attribute]]:
+        """All pairs of source and target attributes that the prompt asks about."""
+        if self.paired:
+            return list(zip(self.sources, self.targets))
+        return list(itertools.product(self.sources, self.targets))
+
     @staticmethod
     def from_dict(data: Dict[str, Any]) -> "PromptAttributePair":
         return PromptAttributePair(
             sources=[Attribute.from_dict(a) for a in data["sources"]],
             targets=[Attribute.from_dict(a) for a in data["targets"]],
+            paired=data.get("paired", False),
         )
 
     def to_dict(self) -> Dict[str, Any]:
@@ -201,7 +227,7 @@ class PromptAttributePair:
 class Prompt:
     parameters: Parameters
     attributes: PromptAttributePair
-    prompt: CompletionCreateParams
+    prompt: "CompletionCreateParams"
     meta: Dict[str, str] = field(default_factory=dict)
 
     def digest(self) -> str:
@@ -212,6 +238,12 @@ class Prompt:
                 + "".join([m["role"] + m["content"] for m in self.prompt["messages"]])
                 + str(self.prompt.get("n", 1))
                 + str(self.prompt.get("timeout", 60))
+                # only included if set to keep the digests of earlier prompts
+                + (
+                    json.dumps(self.prompt["response_format"])
+                    if "response_format" in self.prompt
+                    else ""
+                )
             ).encode()
         ).hexdigest()
 
@@ -307,6 +339,8 @@ class ResultPair:
     attributes: AttributePair
     votes: List[Decision] = field(default_factory=list)
     score: float = 0.0
+    # votes that were replaced, e.g. by re-asking a stronger model in a cascade
+    superseded: List[Decision] = field(default_factory=list)
 
     def digest(self) -> str:
         return hashlib.blake2s(
@@ -323,6 +357,7 @@ class ResultPair:
             attributes=AttributePair.from_dict(data["attributes"]),
             votes=[Decision.from_dict(v) for v in data["votes"]],
             score=data.get("score", 0.0),
+            superseded=[Decision.from_dict(v) for v in data.get("superseded", [])],
         )
 
 
@@ -0,0 +1,361 @@
+"""Dry-run planning: estimates the prompts, tokens, cost and wall time of a run before it is started.
+
+The prompts are rendered like a run would (without storing them), and prompts whose answers are stored already are counted as cached. Completion tokens and latency are extrapolated from the stored requests of the same model and prompt design (see LatencyModel), the wall time from the request limits of the config.
+
+The same estimates choose the prompt designs of a run (see plan_designs): prompts of large schemas are tiled, and designs are added by their F1-score per token as evaluated by earlier batch runs, within the token budget and deadline of the config.
+"""
+
+import dataclasses
+import heapq
+import math
+from typing import Any, Dict, List, Optional
+
+from .backend import estimate_cost
+from .config import config
+from .models import Parameters
+from .scheduling import LatencyModel, Scheduler
+from .storage import (
+    get_evaluation_history,
+    get_parameters_by_hash,
+    get_result_by_parameters,
+    get_valid_answers_by_hash,
+)
+
+
+@dataclasses.dataclass
+class DesignEstimate:
+    design: str
+    prompts: int = 0
+    cached_prompts: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+@dataclasses.dataclass
+class RunEstimate:
+    model: str
+    designs: List[DesignEstimate]
+    # the estimated duration (in seconds) with the configured limits
+    duration: float = 0.0
+    # whether the completion tokens and latency are extrapolated from stored requests of the model
+    from_history: bool = False
+    # whether a complete result is stored, so the run sends no requests
+    stored_result: bool = False
+    # the expected latency of each request, to estimate the duration of several runs together
+    latencies: List[float] = dataclasses.field(default_factory=list, repr=False)
+
+    @property
+    def prompts(self) -> int:
+        return sum(d.prompts for d in self.designs)
+
+    @property
+    def cached_prompts(self) -> int:
+        return sum(d.cached_prompts for d in self.designs)
+
+    @property
+    def requests(self) -> int:
+        return self.prompts - self.cached_prompts
+
+    @property
+    def prompt_tokens(self) -> int:
+        return sum(d.prompt_tokens for d in self.designs)
+
+    @property
+    def completion_tokens(self) -> int:
+        return sum(d.completion_tokens for d in self.designs)
+
+    @property
+    def cost(self) -> Optional[float]:
+        """The estimated cost (in USD), None for models without OPENAI_PRICES."""
+        return estimate_cost(self.model, self.prompt_tokens, self.completion_tokens)
+
+    def summary(self) -> str:
+        return describe([self], self.duration)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "prompts": self.prompts,
+            "cached_prompts": self.cached_prompts,
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost": self.cost,
+            "duration": self.duration,
+            "from_history": self.from_history,
+            "stored_result": self.stored_result,
+            "designs": [dataclasses.asdict(d) for d in self.designs],
+        }
+
+
+def describe(estimates: List[RunEstimate], duration: float) -> str:
+    """A one-line description of the estimates of runs that take the given duration together."""
+    if all(estimate.stored_result for estimate in estimates):
+        return "Stored result, no requests"
+    prompts = sum(estimate.prompts for estimate in estimates)
+    cached = sum(estimate.cached_prompts for estimate in estimates)
+    tokens = sum(e.prompt_tokens + e.completion_tokens for e in estimates)
+    costs = [estimate.cost for estimate in estimates]
+    cost = "unknown cost" if None in costs else f"${sum(costs):.2f}"
+    guess = ""
+    if not all(estimate.from_history for estimate in estimates):
+        guess = " (without history of the model)"
+    return (
+        f"{prompts - cached} requests ({cached} of {prompts} prompts answered before), "
+        f"{tokens:,} tokens, {cost}, about {format_duration(duration)}{guess}"
+    )
+
+
+def format_duration(seconds: float) -> str:
+    if seconds < 90:
+        return f"{seconds:.0f} s"
+    if seconds < 90 * 60:
+        return f"{seconds / 60:.0f} min"
+    return f"{seconds / 3600:.1f} h"
+
+
+def makespan(latencies: List[float], slots: int) -> float:
+    """The time to finish requests of the given latencies on a number of parallel slots, sending the longest first (see PROMPT_ORDER)."""
+    finish = [0.0] * max(slots, 1)
+    for latency in sorted(latencies, reverse=True):
+        heapq.heappush(finish, heapq.heappop(finish) + latency)
+    return max(finish)
+
+
+def model_slots(model: str) -> int:
+    """The number of requests of the model that may run in parallel with the configured limits."""
+    return Scheduler().slots(model)
+
+
+def estimated_duration(latencies: List[float], tokens: int, slots: int) -> float:
+    """The estimated duration of requests on a number of parallel slots, within the shared limits of the config. Retries and rate limit errors are not included."""
+    if config["SHARED_PARALLEL_REQUESTS"] > 0:
+        slots = min(slots, config["SHARED_PARALLEL_REQUESTS"])
+    duration = makespan(latencies, slots)
+    if config["SHARED_TOKENS_PER_MINUTE"] > 0:
+        duration = max(duration, 60 * tokens / config["SHARED_TOKENS_PER_MINUTE"])
+    return duration
+
+
+def combined_duration(
+    estimates: List[RunEstimate], parallel_requests: Optional[int] = None
+) -> float:
+    """The estimated duration of runs that share a request budget of parallel_requests (PARALLEL_OPENAI_REQUESTS by default), e.g. of several models or a batch."""
+    if parallel_requests is None:
+        parallel_requests = config["PARALLEL_OPENAI_REQUESTS"]
+    duration = estimated_duration(
+        [latency for estimate in estimates for latency in estimate.latencies],
+        sum(e.prompt_tokens + e.completion_tokens for e in estimates),
+        parallel_requests,
+    )
+    # no run is faster than on its own
+    return max([duration] + [estimate.duration for estimate in estimates])
+
+
+@dataclasses.dataclass
+class DesignPlan:
+    """The prompt designs of a run and how their prompts are tiled, recorded in Parameters.meta["design_plan"]."""
+
+    designs: List[str]
+    # the maximum number of attributes per side of the prompts of tiled designs
+    tiles: Dict[str, int] = dataclasses.field(default_factory=dict)
+    # why a design of PROMPT_DESIGNS is not part of the plan
+    skipped: Dict[str, str] = dataclasses.field(default_factory=dict)
+
+    def tile_list(self) -> List[Optional[int]]:
+        return [self.tiles.get(design) for design in self.designs]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dataclasses.asdict(self)
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any]) -> "DesignPlan":
+        return DesignPlan(
+            designs=data["designs"],
+            tiles=data.get("tiles", {}),
+            skipped=data.get("skipped", {}),
+        )
+
+
+def design_tile(parameters: Parameters, design: str) -> Optional[int]:
+    """The number of attributes per side that keeps the prompts of a design at about PROMPT_MAX_TOKENS, None if its prompts are small enough untiled. Packed 1-to-1 prompts are sized by PACKED_PROMPT_TOKENS instead."""
+    from .prompt_building import (
+        estimate_tokens,
+        layout_template,
+        render_prompt,
+        DESIGN_TEMPLATES,
+        PromptDesign,
+    )
+
+    if config["PROMPT_MAX_TOKENS"] <= 0 or design == PromptDesign.oneToOne:
+        return None
+    sources = [a for a in parameters.source_relation.attributes if a.included]
+    targets = [a for a in parameters.target_relation.attributes if a.included]
+    if not sources or not targets:
+        return None
+    source_card, target_card = design.split("-")
+    # the largest prompt of the design
+    tokens = estimate_tokens(
+        render_prompt(
+            (
+                sources if source_card == "n" else sources[:1],
+                targets if target_card == "n" else targets[:1],
+            ),
+            parameters,
+            layout_template(DESIGN_TEMPLATES[PromptDesign(design)]),
+        )
+    )
+    splits = math.ceil(tokens / config["PROMPT_MAX_TOKENS"])
+    if splits <= 1:
+        return None
+    longest = max(
+        len(sources) if source_card == "n" else 0,
+        len(targets) if target_card == "n" else 0,
+    )
+    return max(1, math.ceil(longest / splits))
+
+
+def design_quality(model: str, designs: List[str]) -> Dict[str, float]:
+    """The mean F1-score of the stored evaluations of each design with the model. Designs without evaluations get the mean of the others, or 1.0 if none are evaluated."""
+    from .evaluation import DESIGN_SCOPES
+
+    f1 = {
+        row["task_scope"]: row["f1"]
+        for row in get_evaluation_history()
+        if row["model"] == model and row["f1"] is not None
+    }
+    known = {d: f1[DESIGN_SCOPES[d]] for d in designs if DESIGN_SCOPES[d] in f1}
+    default = sum(known.values()) / len(known) if known else 1.0
+    return {design: known.get(design, default) for design in designs}
+
+
+def plan_designs(
+    parameters: Parameters,
+    candidates: Optional[List[str]] = None,
+    latency_model: Optional[LatencyModel] = None,
+) -> DesignPlan:
+    """Choose the prompt designs of a run among the candidates (PROMPT_DESIGNS by default) and tile the prompts that would exceed PROMPT_MAX_TOKENS. Designs are added by their historical F1-score per token, as long as the run stays within RUN_TOKEN_BUDGET and MATCH_DEADLINE. At least one design is always run. With PROMPT_DESIGN_SELECTION set to "fixed", all candidates run untiled."""
+    if candidates is None:
+        candidates = list(config["PROMPT_DESIGNS"])
+    if config["PROMPT_DESIGN_SELECTION"] == "fixed":
+        return DesignPlan(list(candidates))
+    if latency_model is None:
+        latency_model = LatencyModel()
+    model = parameters.cascade_model or parameters.llm_model
+    tiles = {d: t for d in candidates if (t := design_tile(parameters, d))}
+    if config["RUN_TOKEN_BUDGET"] <= 0 and config["MATCH_DEADLINE"] <= 0:
+        # nothing to choose, all designs run
+        return DesignPlan(list(candidates), tiles)
+    estimates = {
+        d: estimate_run(parameters, [d], latency_model, tiles) for d in candidates
+    }
+    tokens = {d: e.prompt_tokens + e.completion_tokens for d, e in estimates.items()}
+    quality = design_quality(parameters.llm_model, candidates)
+    chosen, skipped = [], {}
+    spent, latencies = 0, []
+    for design in sorted(
+        candidates, key=lambda d: quality[d] / max(tokens[d], 1), reverse=True
+    ):
+        if chosen and 0 < config["RUN_TOKEN_BUDGET"] < spent + tokens[design]:
+            skipped[design] = "RUN_TOKEN_BUDGET"
+            continue
+        duration = estimated_duration(
+            latencies + estimates[design].latencies,
+            spent + tokens[design],
+            model_slots(model),
+        )
+        if chosen and 0 < config["MATCH_DEADLINE"] < duration:
+            skipped[design] = "MATCH_DEADLINE"
+            continue
+        chosen.append(design)
+        spent += tokens[design]
+        latencies += estimates[design].latencies
+    return DesignPlan(
+        designs=[d for d in candidates if d in chosen],
+        tiles={d: t for d, t in tiles.items() if d in chosen},
+        skipped=skipped,
+    )
+
+
+def design_plan(
+    parameters: Parameters, latency_model: Optional[LatencyModel] = None
+) -> DesignPlan:
+    """The design plan recorded in the parameters (e.g. by an earlier, interrupted run), or a new one."""
+    if "design_plan" in parameters.meta:
+        return DesignPlan.from_dict(parameters.meta["design_plan"])
+    return plan_designs(parameters, latency_model=latency_model)
+
+
+def estimate_run(
+    parameters: Parameters,
+    designs: Optional[List[str]] = None,
+    latency_model: Optional[LatencyModel] = None,
+    tiles: Optional[Dict[str, int]] = None,
+) -> RunEstimate:
+    """Estimate a run of the parameters with the given prompt designs and tiles (by default those of its design_plan), without sending or storing anything. For a cascade, only the first stage is estimated, as the contested pairs are only known after it."""
+    # imported lazily as this pulls in jinja2
+    from .prompt_building import (
+        build_prompts,
+        estimate_tokens,
+        DESIGN_TEMPLATES,
+        PromptDesign,
+    )
+
+    if latency_model is None:
+        latency_model = LatencyModel()
+    model = parameters.cascade_model or parameters.llm_model
+    stored = get_parameters_by_hash(parameters.digest())
+    if stored is not None:
+        result = get_result_by_parameters(stored)
+        if result is not None and not result.meta.get("incomplete", False):
+            return RunEstimate(
+                model=model,
+                designs=[],
+                from_history=latency_model.known(model),
+                stored_result=True,
+            )
+    if designs is None:
+        plan = design_plan(stored or parameters, latency_model)
+        designs, tiles = plan.designs, plan.tiles
+    if tiles is None:
+        tiles = {}
+    estimate = RunEstimate(
+        model=model,
+        designs=[DesignEstimate(design) for design in designs],
+        from_history=latency_model.known(model),
+    )
+
+    modes = [PromptDesign(design) for design in designs]
+    prompts = build_prompts(
+        parameters,
+        templates=[DESIGN_TEMPLATES[mode] for mode in modes],
+        modes=modes,
+        model=model,
+        store=False,
+        tiles=[tiles.get(design) for design in designs],
+    )
+    valid_answers = get_valid_answers_by_hash([p.digest() for p in prompts])
+    by_design = {d.design: d for d in estimate.designs}
+    for prompt in prompts:
+        design = prompt.meta["design"]
+        design_estimate = by_design[design]
+        design_estimate.prompts += 1
+        missing = config["OPENAI_N"] - valid_answers.get(prompt.digest(), 0)
+        if missing <= 0:
+            design_estimate.cached_prompts += 1
+            continue
+        tokens = estimate_tokens(prompt.prompt["messages"])
+        design_estimate.prompt_tokens += tokens
+        # a prompt with some stored answers only asks for the missing ones
+        design_estimate.completion_tokens += round(
+            latency_model.expected_completion_tokens(model, design, tokens)
+            * missing
+            / config["OPENAI_N"]
+        )
+        estimate.latencies.append(latency_model.expected(model, design, tokens))
+    estimate.duration = estimated_duration(
+        estimate.latencies,
+        estimate.prompt_tokens + estimate.completion_tokens,
+        model_slots(model),
+    )
+    return estimate
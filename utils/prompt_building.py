@@ -1,82 +1,280 @@
 from collections.abc import Iterable
 from enum import StrEnum
 import functools
+import itertools
 import json
 import os
-from typing import Any, Dict, List, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
-from jinja2 import Environment
+from jinja2 import Environment, Template
 from openai.types.chat.completion_create_params import (
     CompletionCreateParamsNonStreaming,
 )
 
 from .config import config
-from .models import Attribute, Parameters, Prompt, PromptAttributePair
+from .models import Attribute, AttributePair, Parameters, Prompt, PromptAttributePair
 from .storage import store_prompt
+from .telemetry import telemetry
 
 
 class PromptDesign(StrEnum):
     """An enum of prompt designs."""
 
-    oneToOne = "1-1"
+    oneToOne = "1-1"  # packed, i.e. several independent pairs per prompt
     oneToN = "1-n"
     nToOne = "n-1"
     nToN = "n-n"
 
 
+# the prompt template of each design
+DESIGN_TEMPLATES = {
+    PromptDesign.oneToOne: "oneToOnePacked",
+    PromptDesign.oneToN: "oneToN",
+    PromptDesign.nToOne: "nToOne",
+    PromptDesign.nToN: "nToN",
+}
+
+
+@telemetry.traced("build_prompts")
 def build_prompts(
     parameters: Parameters,
     templates: List[str] = ["oneToN", "nToOne"],
     modes: List[PromptDesign] = [PromptDesign.oneToN, PromptDesign.nToOne],
     model: str = config["OPENAI_MODEL"],
+    pairs: Optional[List[AttributePair]] = None,
+    store: bool = True,
+    tiles: Optional[List[Optional[int]]] = None,
 ) -> List[Prompt]:
-    """Generate OpenAI Chat Completion prompts from parameters."""
+    """Generate OpenAI Chat Completion prompts from parameters. If pairs are given, the prompts of each design only ask about these pairs. The tiles give the maximum number of attributes per side that a prompt of each design lists (None for all), see tile_attributes. Unless store is False (e.g. to plan a run), the prompts are stored."""
     rendered = []
     if model is None:
         model = config["OPENAI_MODEL"],
-    for template, mode in zip(templates, modes):
+    if tiles is None:
+        tiles = [None] * len(modes)
+    for template, mode, tile in zip(templates, modes, tiles):
+        template = layout_template(template)
         source_card, target_card = mode.split("-")
         sources = [
             attr for attr in parameters.source_relation.attributes if attr.included
         ]
         if source_card == "n":
-            sources = [sources]
+            sources = tile_attributes(sources, tile)
 
         targets = [
             attr for attr in parameters.target_relation.attributes if attr.included
         ]
         if target_card == "n":
-            targets = [targets]
-
-        for source in sources:
-            for target in targets:
-                rendered.append(
-                    Prompt(
-                        parameters=parameters,
-                        attributes=PromptAttributePair(
-                            source if source_card == "n" else [source],
-                            target if target_card == "n" else [target],
-                        ),
-                        prompt=CompletionCreateParamsNonStreaming(
-                            {
-                                "model": model,
-                                "temperature": config["OPENAI_TEMPERATURE"],
-                                "messages": render_prompt(
-                                    (source, target),
-                                    parameters,
-                                    template,
-                                ),
-                                "n": config["OPENAI_N"],
-                                "timeout": config["OPENAI_TIMEOUT"],
-                            }
-                        ),
-                    )
+            targets = tile_attributes(targets, tile)
+
+        if pairs is not None:
+            attribute_pairs = targeted_attribute_pairs(
+                mode, pairs, parameters, template, tile
+            )
+        elif mode == PromptDesign.oneToOne:
+            attribute_pairs = packed_attribute_pairs(
+                list(itertools.product(sources, targets)), parameters, template
+            )
+        else:
+            attribute_pairs = [
+                PromptAttributePair(
+                    source if source_card == "n" else [source],
+                    target if target_card == "n" else [target],
                 )
+                for source in sources
+                for target in targets
+            ]
 
-    rendered = [store_prompt(prompt) for prompt in rendered]
+        for attributes in attribute_pairs:
+            prompt = CompletionCreateParamsNonStreaming(
+                {
+                    "model": model,
+                    "temperature": config["OPENAI_TEMPERATURE"],
+                    "messages": render_prompt(
+                        (attributes.sources, attributes.targets),
+                        parameters,
+                        template,
+                        attributes.paired,
+                    ),
+                    "n": config["OPENAI_N"],
+                    "timeout": config["OPENAI_TIMEOUT"],
+                }
+            )
+            if config["ANSWER_MODE"] == "structured":
+                prompt["response_format"] = response_format(mode, attributes)
+            rendered.append(
+                Prompt(
+                    parameters=parameters,
+                    attributes=attributes,
+                    prompt=prompt,
+                    meta={"design": str(mode), "template": template},
+                )
+            )
+
+    if store:
+        rendered = [store_prompt(prompt) for prompt in rendered]
     return rendered
 
 
+def tile_attributes(attributes: List[Attribute], tile: Optional[int]) -> List[List[Attribute]]:
+    """Split the attributes of the "n" side of a design into tiles of at most tile attributes, so that each prompt of a large schema stays small. A design with two "n" sides asks about every pair of tiles."""
+    if not tile:
+        return [attributes]
+    return [attributes[i : i + tile] for i in range(0, len(attributes), tile)]
+
+
+# structured outputs only allow a limited number of enum values, larger prompts allow any string
+MAX_ENUM_VALUES = 500
+
+
+def response_format(
+    mode: PromptDesign, attributes: PromptAttributePair
+) -> Dict[str, Any]:
+    """The structured output format of the answers of a prompt: an explanation followed by the decisions, which are constrained to the attribute names (or question keys) of the prompt."""
+    if attributes.paired:
+        decisions = {
+            f"Q{i + 1}": {"type": "string", "enum": ["yes", "no", "unknown"]}
+            for i in range(len(attributes.sources))
+        }
+    else:
+        if mode == PromptDesign.nToOne:
+            names = [a.name for a in attributes.sources]
+        elif mode == PromptDesign.nToN:
+            names = [f"{src.name},{trgt.name}" for src, trgt in attributes.pairs()]
+        else:
+            names = [a.name for a in attributes.targets]
+        item = {"type": "string"}
+        if len(names) <= MAX_ENUM_VALUES:
+            item["enum"] = names
+        decisions = {key: {"type": "array", "items": item} for key in ["yes", "no"]}
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "decision",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {"explanation": {"type": "string"}, **decisions},
+                "required": ["explanation", *decisions],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+def packed_attribute_pairs(
+    pairs: List[Tuple[Attribute, Attribute]], parameters: Parameters, template: str
+) -> List[PromptAttributePair]:
+    """Pack attribute pairs into paired prompt attributes, as a prompt per pair would be too many requests."""
+    return [
+        PromptAttributePair(
+            [src for src, _ in pack], [trgt for _, trgt in pack], paired=True
+        )
+        for pack in pack_pairs(pairs, parameters, template)
+    ]
+
+
+def targeted_attribute_pairs(
+    mode: PromptDesign,
+    pairs: List[AttributePair],
+    parameters: Parameters,
+    template: str,
+    tile: Optional[int] = None,
+) -> List[PromptAttributePair]:
+    """The prompt attributes of a design that only ask about the given pairs: 1-to-N prompts ask about the paired targets of each source, N-to-1 prompts the other way around and a single N-to-M prompt asks about all attributes of the pairs. With a tile, the "n" sides are split like in build_prompts, and tiles of an N-to-M prompt without any of the pairs are skipped."""
+    if mode == PromptDesign.oneToOne:
+        return packed_attribute_pairs(
+            [(pair.source, pair.target) for pair in pairs], parameters, template
+        )
+    if mode == PromptDesign.nToN:
+        asked = {pair.digest() for pair in pairs}
+        return [
+            PromptAttributePair(sources, targets)
+            for sources in tile_attributes(
+                list({p.source.digest(): p.source for p in pairs}.values()), tile
+            )
+            for targets in tile_attributes(
+                list({p.target.digest(): p.target for p in pairs}.values()), tile
+            )
+            if any(
+                AttributePair(src, trgt).digest() in asked
+                for src in sources
+                for trgt in targets
+            )
+        ]
+    # attributes are not hashable, so they are grouped by their digest
+    groups = {}
+    for pair in pairs:
+        if mode == PromptDesign.oneToN:
+            groups.setdefault(pair.source.digest(), ([pair.source], []))[1].append(
+                pair.target
+            )
+        else:
+            groups.setdefault(pair.target.digest(), ([], [pair.target]))[0].append(
+                pair.source
+            )
+    if mode == PromptDesign.oneToN:
+        return [
+            PromptAttributePair(sources, tiled)
+            for sources, targets in groups.values()
+            for tiled in tile_attributes(targets, tile)
+        ]
+    return [
+        PromptAttributePair(tiled, targets)
+        for sources, targets in groups.values()
+        for tiled in tile_attributes(sources, tile)
+    ]
+
+
+def estimate_tokens(messages: List[Dict[str, str]]) -> int:
+    """A rough estimate of the number of tokens of messages (about four characters per token)."""
+    return sum(len(m["content"]) for m in messages) // 4
+
+
+def pack_pairs(
+    pairs: List[Tuple[Attribute, Attribute]],
+    parameters: Parameters,
+    template: str,
+    budget: int = None,
+) -> List[List[Tuple[Attribute, Attribute]]]:
+    """Split attribute pairs into packs of k pairs, choosing k such that a rendered prompt of a pack takes about budget tokens (PACKED_PROMPT_TOKENS by default)."""
+    if budget is None:
+        budget = config["PACKED_PROMPT_TOKENS"]
+    if not pairs:
+        return []
+    # estimate the tokens per pair from a sample of the pairs
+    sample = pairs[:10]
+    single = estimate_tokens(
+        render_prompt(([sample[0][0]], [sample[0][1]]), parameters, template, True)
+    )
+    per_pair = 1
+    if len(sample) > 1:
+        total = estimate_tokens(
+            render_prompt(
+                ([src for src, _ in sample], [trgt for _, trgt in sample]),
+                parameters,
+                template,
+                True,
+            )
+        )
+        per_pair = max(1, (total - single) // (len(sample) - 1))
+    k = max(1, (budget - single) // per_pair + 1)
+    return [pairs[i : i + k] for i in range(0, len(pairs), k)]
+
+
+def layout_template(template: str) -> str:
+    """Return the variant of a template for the configured PROMPT_LAYOUT, or the template itself if there is no such variant."""
+    if config["PROMPT_LAYOUT"] == "default":
+        return template
+    variant = f"{template}_{config['PROMPT_LAYOUT']}"
+    if os.path.exists(os.path.join(config["TEMPLATE_DIR"], f"{variant}.json")):
+        return variant
+    return template
+
+
+# a single environment for all prompt templates of the process
+_environment = Environment()
+
+
 @functools.cache
 def read_prompt_template(template: str) -> List[Dict[str, str]]:
     """Read a prompt template from a file."""
@@ -85,52 +283,71 @@ def read_prompt_template(template: str) -> List[Dict[str, str]]:
     return tpl
 
 
+@functools.cache
+def compile_prompt_template(template: str) -> List[Dict[str, Union[str, Template]]]:
+    """Read a prompt template and compile each of its parts once. The compiled template of a part is stored under the key "compiled"."""
+    return [
+        {**part, "compiled": _environment.from_string(part["content"])}
+        for part in read_prompt_template(template)
+    ]
+
+
 def template_iterator(
     template: List[Dict[str, str]],
     sources: List[Attribute],
     targets: List[Attribute],
+    paired: bool = False,
 ) -> Iterable:
-    """An iterator that allows to detect which parts of a prompt template need to be repeated in order to facilitate 1-to-N, N-to-1 or N-to-N prompt templates."""
+    """An iterator that allows to detect which parts of a prompt template need to be repeated in order to facilitate 1-to-N, N-to-1 or N-to-N prompt templates. For paired attributes, parts with a question are repeated for each pair. Yields the part, source, target and question key."""
     for part in template:
-        if "{{source_attribute.name}}" in part["content"]:
+        if paired and "{{question}}" in part["content"]:
+            for i, (s, t) in enumerate(zip(sources, targets)):
+                yield part, s, t, f"Q{i + 1}"
+        elif "{{source_attribute.name}}" in part["content"]:
             for s in sources:
-                yield part, s, targets[0]
+                yield part, s, targets[0], None
         elif "{{target_attribute.name}}" in part["content"]:
             for t in targets:
-                yield part, sources[0], t
+                yield part, sources[0], t, None
         else:
-            yield part, sources[0], targets[0]
+            yield part, sources[0], targets[0], None
 
 
+@telemetry.traced("render_prompt")
 def render_prompt(
     prompt_data: Tuple[
         Union[List[Attribute], Attribute], Union[List[Attribute], Attribute]
     ],
     parameters: Parameters,
     template: str,
+    paired: bool = False,
 ) -> List[Dict[str, str]]:
-    """Render a single prompt from a tuple of source and target attributes."""
+    """Render a single prompt from a tuple of source and target attributes. If paired, the i-th source is asked about together with the i-th target only."""
     sources = prompt_data[0]
     if not isinstance(sources, list):
         sources = [sources]
     targets = prompt_data[1]
     if not isinstance(targets, list):
         targets = [targets]
-    template = read_prompt_template(template)
-    env = Environment()
+    template = compile_prompt_template(template)
+    # the context shared by all parts, only the attributes change between them
+    context = {
+        "source_relation": parameters.source_relation,
+        "target_relation": parameters.target_relation,
+        "feedback": parameters.feedback,
+    }
     messages = [
         {
             "role": part["role"],
-            "content": env.from_string(part["content"]).render(
-                **{
-                    "source_relation": parameters.source_relation,
-                    "source_attribute": source,
-                    "target_relation": parameters.target_relation,
-                    "target_attribute": target,
-                    "feedback": parameters.feedback,
-                }
+            "content": part["compiled"].render(
+                context,
+                source_attribute=source,
+                target_attribute=target,
+                question=question,
             ),
         }
-        for part, source, target in template_iterator(template, sources, targets)
+        for part, source, target, question in template_iterator(
+            template, sources, targets, paired
+        )
     ]
     return [m for m in messages if len(m["content"]) > 0]
@@ -1,32 +1,62 @@
 import itertools
-from typing import List
+from typing import List, Optional
 
 from .models import (
     Answer,
     AttributePair,
     Decision,
     Parameters,
+    Prompt,
     Result,
     ResultPair,
     Vote,
 )
 from .prompt_sending import extract_json
+from .telemetry import telemetry
 
+# the explanation of the UNKNOWN votes of answers that did not arrive in time
+MISSING_ANSWER = "No answer before the deadline."
+# the explanation of the UNKNOWN votes of answers that failed after all retries
+FAILED_ANSWER = "No valid answer after all retries."
+# the explanation of the votes of each kind of missing answers, by prompt.meta key
+MISSING_EXPLANATIONS = {
+    "missing_answers": MISSING_ANSWER,
+    "failed_answers": FAILED_ANSWER,
+}
 
-def postprocess_answers(parameters: Parameters, answers: List[Answer]) -> Result:
-    """Postprocess all answers into structured Results. At this point, we will assume that the answers are validated."""
+
+@telemetry.traced("postprocess_answers")
+def postprocess_answers(
+    parameters: Parameters,
+    answers: List[Answer],
+    prompts: Optional[List[Prompt]] = None,
+) -> Result:
+    """Postprocess all answers into structured Results. At this point, we will assume that the answers are validated. Prompts that missed answers (at a deadline or after all retries) add UNKNOWN votes for them and flag the result as incomplete."""
     result = _generate_empty_result(parameters)
+    _add_missing_votes(result, prompts or [])
     for answer in answers:
+        if answer.attributes.paired:
+            _add_paired_votes(result, answer)
+            continue
         reversed_json = {
             str(attribute): decision
             for decision, attribute_list in extract_json(answer).items()
+            # skips the explanation of structured outputs
+            if isinstance(attribute_list, list)
             for attribute in attribute_list
         }
         for src, trgt in itertools.product(
             answer.attributes.sources,
             answer.attributes.targets,
         ):
-            if len(answer.attributes.sources) == len(answer.attributes.targets) == 1:
+            design = answer.meta.get("design", None)
+            if design == "1-n":
+                look_for = trgt.name
+            elif design == "n-1":
+                look_for = src.name
+            elif design == "n-n":
+                look_for = f"{src.name},{trgt.name}"
+            elif len(answer.attributes.sources) == len(answer.attributes.targets) == 1:
                 # by convention, I use the target attribute name for 1 to 1
                 look_for = trgt.name
             elif len(answer.attributes.sources) == 1:
@@ -49,6 +79,45 @@ def postprocess_answers(parameters: Parameters, answers: List[Answer]) -> Result
     return result
 
 
+def _add_missing_votes(result: Result, prompts: List[Prompt]):
+    """Add an UNKNOWN vote per missing answer to the pairs of each prompt, explained by the kind of missing answer (see MISSING_EXPLANATIONS), and flag the result as incomplete if any answer is missing. The votes link an empty answer of the prompt, which tells the task scope of the vote."""
+    missing_pairs = set()
+    for prompt in prompts:
+        meta = {"design": prompt.meta["design"]} if "design" in prompt.meta else {}
+        for key, explanation in MISSING_EXPLANATIONS.items():
+            missing = prompt.meta.get(key, 0)
+            if missing <= 0:
+                continue
+            for src, trgt in prompt.attributes.pairs():
+                pair = AttributePair(src, trgt)
+                missing_pairs.add(pair)
+                result.pairs[pair].votes.extend(
+                    Decision(
+                        vote=Vote.UNKNOWN,
+                        explanation=explanation,
+                        answer=Answer(prompt.attributes, answer="", meta=dict(meta)),
+                    )
+                    for _ in range(missing)
+                )
+    if missing_pairs:
+        result.meta["incomplete"] = True
+        result.meta["missing_pairs"] = len(missing_pairs)
+
+
+def _add_paired_votes(result: Result, answer: Answer):
+    """Add the votes of a packed 1-to-1 answer, which decides on each pair under its question key (Q1, Q2, ...)."""
+    decisions = extract_json(answer)
+    for i, (src, trgt) in enumerate(answer.attributes.pairs()):
+        try:
+            vote = Vote[str(decisions.get(f"Q{i + 1}", "unknown")).upper()]
+        except KeyError:
+            # the JSON is malformed at this point.
+            vote = Vote.UNKNOWN
+        result.pairs[AttributePair(src, trgt)].votes.append(
+            Decision(vote=vote, explanation=answer.answer, answer=answer)
+        )
+
+
 def _generate_empty_result(parameters: Parameters) -> Result:
     """Helper method that generates an empty, yet structured (i.e. filled with all attribute combinations) Result object."""
     attribute_combinations = list(
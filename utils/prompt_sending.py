@@ -1,7 +1,8 @@
 import asyncio
 import copy
 import json
-from typing import Any, Dict, List
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 from openai import AsyncOpenAI, APITimeoutError, InternalServerError, RateLimitError
 from openai.types.chat import ChatCompletion, CompletionCreateParams
@@ -10,12 +11,38 @@ import tenacity
 from .config import config
 from .errors import NotDoneException
 from .models import Answer, Parameters, Prompt
-from .storage import store_answer, store_chatcompletion, get_answers_by_prompt
+from .prompt_building import estimate_tokens
+from .scheduling import Flow, Hedger, LatencyModel, Priority, Scheduler
+from .storage import (
+    enqueue_prompts,
+    store_answer,
+    store_chatcompletion,
+    get_answers_by_prompt,
+    get_queue_status,
+    update_run_journal,
+    _id_from_path,
+)
+from .telemetry import telemetry
+
 
+# seconds between checks whether a request should be hedged
+HEDGE_CHECK_INTERVAL = 1.0
+# seconds between checks whether the workers finished the queued prompts
+QUEUE_POLL_INTERVAL = 0.5
 
-def send_prompts(parameters: Parameters, prompts: List[Prompt]) -> List[Answer]:
+
+def send_prompts(
+    parameters: Parameters, prompts: List[Prompt], deadline: Optional[float] = None
+) -> List[Answer]:
     """Generate a result from parameters and prompts."""
-    return asyncio.run(process_prompt_list(parameters, prompts))
+    return asyncio.run(process_prompt_list(parameters, prompts, deadline=deadline))
+
+
+def _record_backoff(retry_state: tenacity.RetryCallState) -> None:
+    """Count the retries of ask_gpt and the time spent waiting for them."""
+    error = type(retry_state.outcome.exception()).__name__
+    telemetry.count("backoffs_total", error=error)
+    telemetry.observe("backoff_seconds", retry_state.next_action.sleep, error=error)
 
 
 @tenacity.retry(
@@ -28,30 +55,134 @@ def send_prompts(parameters: Parameters, prompts: List[Prompt]) -> List[Answer]:
         | tenacity.retry_if_exception_type(RateLimitError)
         | tenacity.retry_if_exception_type(InternalServerError)
     ),
+    before_sleep=_record_backoff,
 )
-async def ask_gpt(params: CompletionCreateParams) -> ChatCompletion:
-    """Perform a reqeust using the OpenAI Python SDK. The method itself is a very thin wrapper and is mainly used to use retrying using tenacity."""
+async def ask_gpt(params: CompletionCreateParams) -> Tuple[ChatCompletion, float]:
+    """Perform a reqeust using the OpenAI Python SDK. The method itself is a very thin wrapper and is mainly used to use retrying using tenacity. Returns the completion and the latency of the successful attempt, without the backoff of earlier attempts."""
     client = AsyncOpenAI()
-    return await client.chat.completions.create(**params)
+    with telemetry.span("ask_gpt", model=params["model"], n=params["n"]):
+        telemetry.count("requests_total", model=params["model"])
+        start = time.perf_counter()
+        result = await client.chat.completions.create(**params)
+        return result, time.perf_counter() - start
 
 
 def result_into_answers(result: ChatCompletion, prompt: Prompt) -> List[Answer]:
+    # the model and design the answer originates from
+    meta = {"model": result.model}
+    if "design" in prompt.meta:
+        meta["design"] = prompt.meta["design"]
     return [
         Answer(
             prompt.attributes,
             index=choice.index,
-            answer=choice.message.content,
+            # refusals have no content
+            answer=choice.message.content or "",
+            meta=dict(meta),
         )
         for choice in result.choices
     ]
 
 
+async def _scheduled_request(
+    params: CompletionCreateParams,
+    scheduler: Union[Scheduler, Flow, Hedger],
+    hedger: Optional[Hedger] = None,
+    started: Optional[asyncio.Event] = None,
+) -> Tuple[ChatCompletion, float]:
+    """Send a request once the scheduler (or the hedger, for duplicates) has a free slot. Returns the completion and its latency, see ask_gpt."""
+    tokens = estimate_tokens(params["messages"])
+    async with scheduler.request(params["model"], tokens) as lease:
+        if started is not None:
+            started.set()
+        result, latency = await ask_gpt(params)
+        if result.usage is not None:
+            lease.tokens = result.usage.total_tokens
+    if hedger is not None:
+        hedger.observe(latency)
+    return result, latency
+
+
+async def _hedged_request(
+    params: CompletionCreateParams,
+    prompt: Prompt,
+    scheduler: Union[Scheduler, Flow],
+    hedger: Hedger,
+) -> Tuple[ChatCompletion, float]:
+    """Send a request and a duplicate of it if it is slower than its peers (and the hedging budget allows). The first response with a valid answer wins, the other request is cancelled. A response of the other request that arrived as well is stored, as it is billed; cancelled requests are counted in hedge_cancelled_requests_total."""
+    hedger.requests += 1
+    started = asyncio.Event()
+    tasks = [
+        asyncio.create_task(_scheduled_request(params, scheduler, hedger, started))
+    ]
+    # the delay only starts once the request is sent, not while it is queued
+    waiting = asyncio.create_task(started.wait())
+    try:
+        await asyncio.wait([tasks[0], waiting], return_when=asyncio.FIRST_COMPLETED)
+        sent = time.perf_counter()
+        # the delay and the budget change while peers complete, so they are checked again
+        while not tasks[0].done():
+            delay = hedger.delay()
+            elapsed = time.perf_counter() - sent
+            if (
+                delay is not None
+                and elapsed >= delay
+                and hedger.try_hedge(params["model"])
+            ):
+                telemetry.count("hedged_requests_total", model=params["model"])
+                tasks.append(
+                    asyncio.create_task(_scheduled_request(params, hedger, hedger))
+                )
+                break
+            timeout = HEDGE_CHECK_INTERVAL
+            if delay is not None and elapsed < delay:
+                timeout = min(delay - elapsed, timeout)
+            await asyncio.wait(tasks, timeout=timeout)
+        # without any valid answer, the last response is used to re-ask
+        fallback, error, used = None, None, None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                result, latency = task.result()
+                if any(is_valid_answer(a) for a in result_into_answers(result, prompt)):
+                    if task is not tasks[0]:
+                        telemetry.count("hedge_wins_total", model=params["model"])
+                    used = task
+                    return result, latency
+                fallback, used = (result, latency), task
+        if fallback is not None:
+            return fallback
+        raise error
+    finally:
+        waiting.cancel()
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+                if len(tasks) > 1:
+                    # its tokens may be billed without ever being reported
+                    telemetry.count(
+                        "hedge_cancelled_requests_total", model=params["model"]
+                    )
+            elif task is not used and not task.cancelled() and not task.exception():
+                loser, loser_latency = task.result()
+                store_chatcompletion(loser, prompt.meta["path"], loser_latency)
+
+
 async def process_and_store_prompt(
     parameters: Parameters,
     prompt: Prompt,
-    semaphore: asyncio.Semaphore = asyncio.Semaphore(1),
+    scheduler: Optional[Union[Scheduler, Flow]] = None,
+    hedger: Optional[Hedger] = None,
 ) -> List[Answer]:
-    """Process a prompt and store the result. This method features a semaphore to avoid running into RateLimitErrors. Return the Answers in a list."""
+    """Process a prompt and store the result. This method features a scheduler (or a flow of it) to avoid running into RateLimitErrors and an optional hedger to duplicate slow requests. Return the Answers in a list."""
+    if scheduler is None:
+        scheduler = Scheduler(1)
     valid_answers = get_answers_by_prompt(prompt, filter_valid=True)
     _completion_prompt = copy.deepcopy(prompt.prompt)
     _completion_prompt["n"] -= len(valid_answers)
@@ -62,41 +193,174 @@ async def process_and_store_prompt(
                 retry=(tenacity.retry_if_exception_type(NotDoneException)),
             ):
                 with attempt:
-                    async with semaphore:
-                        result = await ask_gpt(_completion_prompt)
+                    if hedger is not None and hedger.enabled:
+                        result, latency = await _hedged_request(
+                            _completion_prompt, prompt, scheduler, hedger
+                        )
+                    else:
+                        result, latency = await _scheduled_request(
+                            _completion_prompt, scheduler
+                        )
+                    if result.usage is not None:
+                        telemetry.count(
+                            "prompt_tokens_total", result.usage.prompt_tokens
+                        )
+                        details = result.usage.prompt_tokens_details
+                        if details is not None and details.cached_tokens:
+                            telemetry.count(
+                                "cached_tokens_total", details.cached_tokens
+                            )
                     # TODO: evaluate the choice to check the answers validity here
-                    store_chatcompletion(result, prompt.meta["path"])
+                    store_chatcompletion(result, prompt.meta["path"], latency)
                     answers = result_into_answers(result, prompt)
                     for answer in answers:
                         if is_valid_answer(answer):
                             _completion_prompt["n"] -= 1
                             answer.valid = True
                             valid_answers.append(answer)
+                        else:
+                            telemetry.count(
+                                "invalid_answers_total", mode=config["ANSWER_MODE"]
+                            )
                         store_answer(answer, prompt.meta["path"], result.id)
                     if _completion_prompt["n"] > 0:
+                        telemetry.count("reasks_total", mode=config["ANSWER_MODE"])
                         raise NotDoneException("Not enough valid answers provided.")
         except tenacity.RetryError:
             pass
+        update_run_journal(prompt, len(valid_answers))
     # NOTE: I am restricting the return to OPENAI_N elements here, unsure whether this will be really necessary though
     return valid_answers[0:config["OPENAI_N"]]
 
 
+async def _traced_prompt(
+    parameters: Parameters, prompt: Prompt, flow: Flow, hedger: Hedger
+) -> List[Answer]:
+    """Process a prompt like a worker process would. A prompt that fails (or runs out of re-asks) is marked with the number of its missing answers in prompt.meta["failed_answers"] instead of failing the whole prompt list."""
+    with telemetry.span("process_and_store_prompt", prompt=prompt.meta["path"]):
+        try:
+            answers = await process_and_store_prompt(parameters, prompt, flow, hedger)
+        except Exception:
+            telemetry.count("failed_prompts_total")
+            answers = get_answers_by_prompt(prompt, filter_valid=True)
+            answers = answers[: config["OPENAI_N"]]
+    if len(answers) < config["OPENAI_N"]:
+        prompt.meta["failed_answers"] = config["OPENAI_N"] - len(answers)
+    return answers
+
+
+def order_longest_first(prompts: List[Prompt]) -> List[Prompt]:
+    """Order prompts by their expected latency, longest first. Starting the slowest requests first keeps a single slow request from extending the run at its end."""
+    latency_model = LatencyModel()
+    expected = {
+        id(prompt): latency_model.expected(
+            prompt.prompt["model"],
+            prompt.meta.get("design"),
+            estimate_tokens(prompt.prompt["messages"]),
+        )
+        for prompt in prompts
+    }
+    return sorted(prompts, key=lambda p: expected[id(p)], reverse=True)
+
+
 async def process_prompt_list(
-    parameters: Parameters, prompts: List[Prompt]
+    parameters: Parameters,
+    prompts: List[Prompt],
+    scheduler: Optional[Scheduler] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+    deadline: Optional[float] = None,
+    priority: Priority = Priority.DEFAULT,
 ) -> List[Answer]:
-    """Process a list of prompts. Returns the chained lists of all answers provided from the LLM."""
-    semaphore = asyncio.Semaphore(config["PARALLEL_OPENAI_REQUESTS"])
+    """Process a list of prompts. Returns the chained lists of all answers provided from the LLM. Pass a scheduler to share the request budget with other prompt lists, which are served by priority and fairly across experiments of the same priority. The prompts are sent in the order given by PROMPT_ORDER. The progress callback is called with the number of completed and total prompts whenever a prompt completes. If the deadline (a time.monotonic() timestamp) passes, all outstanding requests are cancelled and the valid answers that arrived until then are returned. Prompts with fewer than OPENAI_N valid answers are marked with the number of missing answers in prompt.meta["missing_answers"] (unfinished at the deadline) or prompt.meta["failed_answers"] (failed after all retries)."""
+    if config["PROMPT_ORDER"] == "longest-first":
+        prompts = order_longest_first(prompts)
+    # without a database there is no queue for workers to claim from
+    if config["PROMPT_QUEUE"] and config["SQLITE_PATH"] is not None:
+        return await _process_queued_prompts(prompts, progress, deadline, priority)
+    if scheduler is None:
+        scheduler = Scheduler()
+    flow = scheduler.flow(parameters.meta.get("path", ""), priority)
+    # the requests of a prompt list are the peers that slow requests are hedged against
+    hedger = Hedger(flow, priority=priority)
     tasks = []
-    async with asyncio.TaskGroup() as tg:
-        for prompt in prompts:
-            tasks.append(
-                tg.create_task(process_and_store_prompt(parameters, prompt, semaphore))
-            )
+    try:
+        async with asyncio.timeout_at(deadline), asyncio.TaskGroup() as tg:
+            for prompt in prompts:
+                task = tg.create_task(
+                    _traced_prompt(parameters, prompt, flow, hedger),
+                )
+                if progress is not None:
+                    task.add_done_callback(
+                        lambda _: progress(sum(t.done() for t in tasks), len(prompts))
+                    )
+                tasks.append(task)
+    except TimeoutError:
+        telemetry.count("deadlines_exceeded_total")
+        answers = []
+        for prompt, task in zip(prompts, tasks):
+            if task.cancelled():
+                # the answers of a cancelled prompt are stored as they arrive
+                prompt_answers = get_answers_by_prompt(prompt, filter_valid=True)
+                prompt_answers = prompt_answers[: config["OPENAI_N"]]
+                prompt.meta["missing_answers"] = config["OPENAI_N"] - len(
+                    prompt_answers
+                )
+                answers.extend(prompt_answers)
+            else:
+                answers.extend(task.result())
+        # prompts that were not even started before the deadline
+        for prompt in prompts[len(tasks) :]:
+            prompt.meta["missing_answers"] = config["OPENAI_N"]
+        return answers
     return [result for task in tasks for result in task.result()]
 
 
+async def _process_queued_prompts(
+    prompts: List[Prompt],
+    progress: Optional[Callable[[int, int], None]] = None,
+    deadline: Optional[float] = None,
+    priority: Priority = Priority.DEFAULT,
+) -> List[Answer]:
+    """Queue the prompts for the worker processes and wait until they finished all of them (or the deadline passes). Returns the valid answers stored by the workers. Prompts with fewer than OPENAI_N valid answers are marked like those processed in-process, see process_prompt_list."""
+    enqueue_prompts(prompts, requeue=True, priority=priority.rank)
+    while True:
+        status = get_queue_status(prompts)
+        finished = sum(s in ("done", "failed") for s in status.values())
+        if progress is not None:
+            progress(finished, len(prompts))
+        if finished == len(prompts):
+            break
+        if deadline is not None and time.monotonic() >= deadline:
+            telemetry.count("deadlines_exceeded_total")
+            break
+        await asyncio.sleep(QUEUE_POLL_INTERVAL)
+    answers = []
+    for prompt in prompts:
+        prompt_answers = get_answers_by_prompt(prompt, filter_valid=True)
+        prompt_answers = prompt_answers[: config["OPENAI_N"]]
+        # prompts that the workers did not finish before the deadline, or that failed,
+        # are topped up by a later run
+        if len(prompt_answers) < config["OPENAI_N"]:
+            finished = status.get(_id_from_path(prompt.meta["path"])) in (
+                "done",
+                "failed",
+            )
+            key = "failed_answers" if finished else "missing_answers"
+            prompt.meta[key] = config["OPENAI_N"] - len(prompt_answers)
+        answers.extend(prompt_answers)
+    return answers
+
+
 def extract_json(answer: Answer) -> Dict[str, Any]:
     """Extract the JSON formatted summary from an Answer retrieved from GPT."""
+    # structured outputs are a JSON object as a whole
+    if answer.answer.startswith("{"):
+        try:
+            decision = json.loads(answer.answer)
+            if isinstance(decision, dict):
+                return decision
+        except json.JSONDecodeError:
+            pass
     # checks whether there is a proper JSON structure in the response
     start_decision = answer.answer.rindex("{")
     end_decision = answer.answer.index("}", start_decision)
@@ -0,0 +1,104 @@
+"""A process-wide cache of deserialized Results and Parameters that is shared by all Streamlit sessions."""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+import threading
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+from .config import config
+
+
+@dataclass
+class CacheStats:
+    """A snapshot of the metrics of a SharedObjectCache."""
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    entries: int = 0
+    size: int = 0
+    max_size: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+
+class SharedObjectCache:
+    """A thread-safe LRU cache that evicts the least recently used entries once the summed size of all entries exceeds max_size bytes.
+
+    Cached objects are shared between all callers (and thus all sessions), treat them as read-only and create a copy before changing them.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: OrderedDict[Hashable, Tuple[Any, int]] = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached object for key or None if it is not cached."""
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int) -> Any:
+        """Cache value under key. Objects larger than the cache itself are not cached. Returns the value."""
+        if size > self.max_size:
+            return value
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self._evictions += 1
+        return value
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Tuple[Any, int]]) -> Any:
+        """Return the cached object for key, calling loader to create (and cache) it on a miss. The loader returns the object and its size."""
+        value = self.get(key)
+        if value is None:
+            value, size = loader()
+            if value is not None:
+                self.put(key, value, size)
+        return value
+
+    def invalidate(self, key: Hashable) -> None:
+        """Remove a single entry from the cache."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry[1]
+
+    def clear(self) -> None:
+        """Remove all entries, keeping the metrics."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                entries=len(self._entries),
+                size=self._size,
+                max_size=self.max_size,
+            )
+
+
+# a single cache per process, the size is approximated by the length of the serialized JSON data
+result_cache = SharedObjectCache(config["RESULT_CACHE_MB"] * 1024 * 1024)
@@ -0,0 +1,499 @@
+"""Scheduling of the requests to the OpenAI API across all prompts that are processed concurrently."""
+
+import asyncio
+import bisect
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from enum import StrEnum
+import heapq
+import itertools
+import os
+import random
+import socket
+import time
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple, Union
+import uuid
+import weakref
+
+from .config import config
+from .storage import acquire_lease, get_latency_history, release_lease
+from .telemetry import telemetry
+
+# seconds between attempts to lease shared capacity, doubled up to the maximum while waiting
+LEASE_POLL_INTERVAL = 0.05
+LEASE_MAX_POLL_INTERVAL = 1.0
+# the latency per prompt token assumed without any history, which only has to be of the right order
+DEFAULT_SECONDS_PER_TOKEN = 0.002
+# the number of stored requests of a model and design before their latency is trusted
+MIN_LATENCY_SAMPLES = 5
+# the completion tokens per prompt token assumed without any history
+DEFAULT_COMPLETION_RATIO = 0.5
+
+
+class Priority(StrEnum):
+    """Classes of requests. Waiting requests of a class listed first are sent before those of the classes after it."""
+
+    INTERACTIVE = "interactive"
+    DEFAULT = "default"
+    BULK = "bulk"
+
+    @property
+    def rank(self) -> int:
+        return list(Priority).index(self)
+
+    @staticmethod
+    def from_rank(rank: int) -> "Priority":
+        return list(Priority)[rank]
+
+
+def aged_rank(priority: Priority, waited: float) -> int:
+    """The rank a request competes with after waiting: one class higher per PRIORITY_AGING seconds, so that lower classes are never starved."""
+    if config["PRIORITY_AGING"] <= 0:
+        return priority.rank
+    return max(priority.rank - int(waited / config["PRIORITY_AGING"]), 0)
+
+
+@dataclass
+class Lease:
+    """Request capacity held by a request. Set tokens to the actual usage once known."""
+
+    id: Optional[int] = None
+    tokens: int = 0
+
+
+class SharedLimiter:
+    """Leases request slots and tokens from the SQLite database, so all processes using the same database (e.g. several app replicas and batch runs on a host) stay within SHARED_PARALLEL_REQUESTS and SHARED_TOKENS_PER_MINUTE together. Waiting processes get a fair share of the slots, and the leases of crashed processes expire after LEASE_TIMEOUT."""
+
+    def __init__(
+        self,
+        parallel_requests: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        lease_timeout: Optional[float] = None,
+    ):
+        if parallel_requests is None:
+            parallel_requests = config["SHARED_PARALLEL_REQUESTS"]
+        if tokens_per_minute is None:
+            tokens_per_minute = config["SHARED_TOKENS_PER_MINUTE"]
+        if lease_timeout is None:
+            lease_timeout = config["LEASE_TIMEOUT"]
+        self.parallel_requests = parallel_requests
+        self.tokens_per_minute = tokens_per_minute
+        self.lease_timeout = lease_timeout
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+    @property
+    def enabled(self) -> bool:
+        return config["SQLITE_PATH"] is not None and (
+            self.parallel_requests > 0 or self.tokens_per_minute > 0
+        )
+
+    @asynccontextmanager
+    async def lease(
+        self, tokens: int = 0, priority: Priority = Priority.DEFAULT
+    ) -> AsyncIterator[Lease]:
+        """Wait for a lease of a request slot and tokens. Processes waiting with requests of a higher priority class are served first."""
+        if not self.enabled:
+            yield Lease(tokens=tokens)
+            return
+        interval = LEASE_POLL_INTERVAL
+        with telemetry.span("lease_wait", tokens=tokens, priority=priority):
+            while True:
+                # the database may be locked for a while, which must not block the event loop
+                acquiring = asyncio.ensure_future(
+                    asyncio.to_thread(
+                        acquire_lease,
+                        self.owner,
+                        self.parallel_requests,
+                        self.tokens_per_minute,
+                        tokens,
+                        self.lease_timeout,
+                        # waiting owners poll at least this often
+                        waiter_timeout=4 * LEASE_MAX_POLL_INTERVAL,
+                        priority=priority.rank,
+                        aging=config["PRIORITY_AGING"],
+                    )
+                )
+                try:
+                    lease_id = await asyncio.shield(acquiring)
+                except asyncio.CancelledError:
+                    acquiring.add_done_callback(_release_acquired)
+                    raise
+                if lease_id is not None:
+                    break
+                # jitter keeps waiting processes from polling in lockstep
+                await asyncio.sleep(interval * random.uniform(0.5, 1.5))
+                interval = min(2 * interval, LEASE_MAX_POLL_INTERVAL)
+        lease = Lease(lease_id, tokens)
+        try:
+            yield lease
+        finally:
+            await asyncio.to_thread(release_lease, lease.id, lease.tokens)
+
+
+def _release_acquired(acquiring: asyncio.Future) -> None:
+    """Release a lease acquired after its request was cancelled, instead of holding it until it expires."""
+    if acquiring.cancelled() or acquiring.exception() is not None:
+        return
+    if acquiring.result() is not None:
+        asyncio.get_running_loop().run_in_executor(
+            None, release_lease, acquiring.result(), 0
+        )
+
+
+# one owner per process, so that fair sharing is between processes
+shared_limiter = SharedLimiter()
+
+
+@dataclass(eq=False)
+class Flow:
+    """The requests of one experiment in a priority class. Waiting requests of the same class are sent in weighted fair order across flows (start-time fair queuing), so a large experiment does not hold up the ones started after it."""
+
+    scheduler: "Scheduler"
+    name: str
+    priority: Priority = Priority.DEFAULT
+    weight: float = 1.0
+    # the virtual time at which the last request of the flow finishes
+    finish: float = 0.0
+
+    def request(self, model: str, tokens: int = 0):
+        return self.scheduler.request(model, tokens, self)
+
+
+@dataclass(eq=False)
+class _Waiter:
+    start: float  # virtual start time
+    seq: int
+    since: float
+    future: asyncio.Future
+    done: bool = False
+
+    def finished(self) -> bool:
+        """Whether the waiter was granted a slot or cancelled, possibly before its request noticed."""
+        return self.done or self.future.done()
+
+
+@dataclass
+class _WaitQueue:
+    """The waiting requests of a priority class and model, in fair order and in arrival order."""
+
+    fair: List[Tuple[float, int, _Waiter]] = field(default_factory=list)  # heap
+    arrived: Deque[_Waiter] = field(default_factory=deque)
+
+    def prune(self) -> None:
+        while self.fair and self.fair[0][2].finished():
+            heapq.heappop(self.fair)
+        while self.arrived and self.arrived[0].finished():
+            self.arrived.popleft()
+
+
+@dataclass
+class WaitStats:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def observe(self, wait: float) -> None:
+        self.count += 1
+        self.total += wait
+        self.max = max(self.max, wait)
+
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            "requests": self.count,
+            "mean_wait": self.total / self.count if self.count else 0.0,
+            "max_wait": self.max,
+        }
+
+
+class Scheduler:
+    """Limits the number of parallel requests, in total, per model and optionally per priority class. Experiments that share a scheduler share its limits, so the requests of several models are interleaved without any model exceeding its own limit. Free slots go to the waiting requests of the highest priority class, in fair order across the flows (experiments) of that class; requests waiting for long are promoted (see aged_rank)."""
+
+    def __init__(
+        self,
+        parallel_requests: Optional[int] = None,
+        model_limits: Optional[Dict[str, int]] = None,
+        priority_limits: Optional[Dict[Priority, int]] = None,
+    ):
+        if parallel_requests is None:
+            parallel_requests = config["PARALLEL_OPENAI_REQUESTS"]
+        if model_limits is None:
+            model_limits = config["MODEL_PARALLEL_REQUESTS"]
+        self.parallel_requests = parallel_requests
+        self.model_limits = model_limits
+        # e.g. to keep bulk requests from taking all slots from interactive ones
+        self.priority_limits = priority_limits or {}
+        self.waits = {priority: WaitStats() for priority in Priority}
+        self._running = 0
+        self._running_per_model: Dict[str, int] = {}
+        self._running_per_priority: Dict[Priority, int] = {}
+        self._queues: Dict[Tuple[Priority, Optional[str]], _WaitQueue] = {}
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+        self._flows: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+    def flow(
+        self, name: str, priority: Priority = Priority.DEFAULT, weight: float = 1.0
+    ) -> Flow:
+        """The flow of an experiment in a priority class. Its requests are sent with flow.request()."""
+        key = (name, priority)
+        flow = self._flows.get(key)
+        if flow is None:
+            flow = Flow(self, name, priority, weight)
+            self._flows[key] = flow
+        return flow
+
+    def _model_prefix(self, model: str) -> Optional[str]:
+        """The longest model name prefix with a limit, None if the model has no limit of its own."""
+        prefixes = [p for p in self.model_limits if model.startswith(p)]
+        if not prefixes:
+            return None
+        return max(prefixes, key=len)
+
+    def slots(self, model: str) -> int:
+        """The number of requests of the model that may run in parallel."""
+        prefix = self._model_prefix(model)
+        if prefix is None:
+            return self.parallel_requests
+        return min(self.parallel_requests, self.model_limits[prefix])
+
+    def free(self, model: str, priority: Priority = Priority.DEFAULT) -> bool:
+        """Whether a request of the model and priority class would be sent right away. Free slots are granted to waiting requests at once, so a free slot means that no request waits for it."""
+        return (
+            self._running < self.parallel_requests
+            and self._model_free(self._model_prefix(model))
+            and self._priority_free(priority)
+        )
+
+    def _model_free(self, prefix: Optional[str]) -> bool:
+        return (
+            prefix is None
+            or self._running_per_model.get(prefix, 0) < self.model_limits[prefix]
+        )
+
+    def _priority_free(self, priority: Priority) -> bool:
+        return (
+            priority not in self.priority_limits
+            or self._running_per_priority.get(priority, 0)
+            < self.priority_limits[priority]
+        )
+
+    def _take(self, prefix: Optional[str], priority: Priority) -> None:
+        self._running += 1
+        if prefix is not None:
+            self._running_per_model[prefix] = self._running_per_model.get(prefix, 0) + 1
+        self._running_per_priority[priority] = (
+            self._running_per_priority.get(priority, 0) + 1
+        )
+
+    def _release(self, prefix: Optional[str], priority: Priority) -> None:
+        self._running -= 1
+        if prefix is not None:
+            self._running_per_model[prefix] -= 1
+        self._running_per_priority[priority] -= 1
+        self._dispatch()
+
+    def _next_waiter(self) -> Optional[Tuple[_Waiter, Optional[str], Priority]]:
+        """The waiter to send next among those whose model and priority class have a free slot. Skipping busy models keeps them from blocking the slots of the others."""
+        now = time.monotonic()
+        best, best_key = None, None
+        for (priority, prefix), queue in self._queues.items():
+            if not self._model_free(prefix) or not self._priority_free(priority):
+                continue
+            queue.prune()
+            if not queue.arrived:
+                continue
+            # the fairest waiter competes with its class, the oldest may be promoted
+            candidates = [queue.fair[0][2], queue.arrived[0]]
+            for waiter in candidates:
+                key = (
+                    aged_rank(priority, now - waiter.since),
+                    waiter.start,
+                    waiter.seq,
+                )
+                if best_key is None or key < best_key:
+                    best, best_key = (waiter, prefix, priority), key
+        return best
+
+    def _dispatch(self) -> None:
+        while self._running < self.parallel_requests:
+            next_waiter = self._next_waiter()
+            if next_waiter is None:
+                return
+            waiter, prefix, priority = next_waiter
+            waiter.done = True
+            self._take(prefix, priority)
+            self._virtual_time = max(self._virtual_time, waiter.start)
+            waiter.future.set_result(None)
+
+    async def _acquire(self, prefix: Optional[str], flow: Flow) -> None:
+        start = max(self._virtual_time, flow.finish)
+        flow.finish = start + 1 / flow.weight
+        waiter = _Waiter(
+            start,
+            next(self._seq),
+            time.monotonic(),
+            asyncio.get_running_loop().create_future(),
+        )
+        queue = self._queues.setdefault((flow.priority, prefix), _WaitQueue())
+        heapq.heappush(queue.fair, (waiter.start, waiter.seq, waiter))
+        queue.arrived.append(waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # the slot was granted just before the cancellation
+                self._release(prefix, flow.priority)
+            waiter.done = True
+            raise
+
+    @asynccontextmanager
+    async def request(
+        self, model: str, tokens: int = 0, flow: Optional[Flow] = None
+    ) -> AsyncIterator[Lease]:
+        """Wait for a free request slot of the model and in total, then for a lease of the capacity shared with other processes (if enabled). Requests without a flow belong to the default flow."""
+        if flow is None:
+            flow = self.flow("")
+        prefix = self._model_prefix(model)
+        start = time.monotonic()
+        with telemetry.span("scheduler_wait", model=model, priority=flow.priority):
+            await self._acquire(prefix, flow)
+        wait = time.monotonic() - start
+        self.waits[flow.priority].observe(wait)
+        telemetry.observe("scheduler_wait_seconds", wait, priority=flow.priority)
+        try:
+            async with shared_limiter.lease(tokens, flow.priority) as lease:
+                yield lease
+        finally:
+            self._release(prefix, flow.priority)
+
+    def wait_report(self) -> Dict[str, Dict[str, float]]:
+        """The number of requests and their mean and maximum wait for a slot (in seconds) per priority class."""
+        return {
+            priority.value: stats.to_dict() for priority, stats in self.waits.items()
+        }
+
+
+class LatencyModel:
+    """Expected latency (and completion tokens) of requests, as their prompt tokens times the mean latency (completion tokens) per prompt token of the stored requests of the same model and prompt design. Without enough history, the mean of all designs of the model is used, and DEFAULT_SECONDS_PER_TOKEN (DEFAULT_COMPLETION_RATIO) without any."""
+
+    def __init__(self, history: Optional[List[Dict[str, Any]]] = None):
+        if history is None:
+            history = get_latency_history()
+        self.history = history
+        self._rates: Dict[Tuple[str, str, Optional[str]], float] = {}
+
+    def _rate(self, column: str, model: str, design: Optional[str]) -> Optional[float]:
+        # responses name the model version, e.g. gpt-4.1-2025-04-14 for gpt-4.1
+        rows = [
+            row
+            for row in self.history
+            if row["model"] is not None
+            and row["model"].startswith(model)
+            and (design is None or row["design"] == design)
+        ]
+        requests = sum(row["requests"] for row in rows)
+        if requests < MIN_LATENCY_SAMPLES:
+            return None
+        return sum(row[column] or 0 for row in rows) / sum(
+            row["prompt_tokens"] for row in rows
+        )
+
+    def rate(self, column: str, model: str, design: Optional[str] = None) -> float:
+        """The mean of a column of the history (latency or completion_tokens) per prompt token."""
+        key = (column, model, design)
+        if key not in self._rates:
+            rate = self._rate(column, model, design)
+            if rate is None and design is not None:
+                rate = self.rate(column, model)
+            if rate is None:
+                rate = {
+                    "latency": DEFAULT_SECONDS_PER_TOKEN,
+                    "completion_tokens": DEFAULT_COMPLETION_RATIO,
+                }[column]
+            self._rates[key] = rate
+        return self._rates[key]
+
+    def known(self, model: str) -> bool:
+        """Whether there is enough history of the model."""
+        return self._rate("latency", model, None) is not None
+
+    def expected(self, model: str, design: Optional[str], tokens: int) -> float:
+        """The expected latency (in seconds) of a request."""
+        return tokens * self.rate("latency", model, design)
+
+    def expected_completion_tokens(
+        self, model: str, design: Optional[str], tokens: int
+    ) -> int:
+        """The expected completion tokens of a request (of all its answers)."""
+        return round(tokens * self.rate("completion_tokens", model, design))
+
+
+class Hedger:
+    """Decides when to send a duplicate of a slow request: once it takes longer than a percentile of the latencies of the other requests of the same run. Duplicates are capped by a budget (their share of all requests) and by a number of parallel duplicates. They take a slot of the scheduler (or flow) like any request, but are only sent while a slot of their model is free, as they would be useless if queued behind the other prompts."""
+
+    def __init__(
+        self,
+        scheduler: Optional[Union[Scheduler, Flow]] = None,
+        percentile: Optional[float] = None,
+        budget: Optional[float] = None,
+        parallel_requests: Optional[int] = None,
+        min_samples: Optional[int] = None,
+        priority: Priority = Priority.DEFAULT,
+    ):
+        if percentile is None:
+            percentile = config["HEDGE_PERCENTILE"]
+        if budget is None:
+            budget = config["HEDGE_BUDGET"]
+        if parallel_requests is None:
+            parallel_requests = config["HEDGE_PARALLEL_REQUESTS"]
+        if min_samples is None:
+            min_samples = config["HEDGE_MIN_SAMPLES"]
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = max(min_samples, 1)
+        self.scheduler = scheduler
+        self.priority = priority
+        self.requests = 0
+        self.hedges = 0
+        self._latencies: List[float] = []  # sorted
+        self._slots = asyncio.Semaphore(max(parallel_requests, 1))
+
+    @property
+    def enabled(self) -> bool:
+        return self.percentile > 0 and self.budget > 0
+
+    def observe(self, latency: float) -> None:
+        """Add the latency of a completed request."""
+        bisect.insort(self._latencies, latency)
+
+    def delay(self) -> Optional[float]:
+        """The time after which a request is hedged, None until enough requests completed."""
+        n = len(self._latencies)
+        if n < self.min_samples:
+            return None
+        return self._latencies[min(int(self.percentile / 100 * n), n - 1)]
+
+    def try_hedge(self, model: str) -> bool:
+        """Take a duplicate from the budget, False if the budget is used up or no slot for a duplicate of the model is free."""
+        if self.hedges + 1 > self.budget * self.requests or self._slots.locked():
+            return False
+        scheduler, priority = self.scheduler, Priority.DEFAULT
+        if isinstance(scheduler, Flow):
+            scheduler, priority = scheduler.scheduler, scheduler.priority
+        if scheduler is not None and not scheduler.free(model, priority):
+            return False
+        self.hedges += 1
+        return True
+
+    @asynccontextmanager
+    async def request(self, model: str, tokens: int = 0) -> AsyncIterator[Lease]:
+        """Wait for a slot for a duplicate request, which also needs a slot of the scheduler (if any) and a lease of the shared capacity."""
+        async with self._slots:
+            if self.scheduler is None:
+                async with shared_limiter.lease(tokens, self.priority) as lease:
+                    yield lease
+            else:
+                async with self.scheduler.request(model, tokens) as lease:
+                    yield lease
@@ -7,8 +7,11 @@ from sklearn.metrics import precision_recall_fscore_support, f1_score
 import streamlit as st
 import textdistance as td
 
-from utils.models import Answer, Attribute, AttributePair, Result, TaskScope, Vote
+from utils.backend import estimate_cost
+from utils.evaluation import DESIGN_SCOPES, get_votes_by_scope
+from utils.models import Attribute, AttributePair, Result
 from utils.model_session_state import ModelSessionState
+from utils.storage import _id_from_path, get_usage_by_parameters
 
 
 def get_ngrams(s: str, n: int = 3) -> Set[str]:
@@ -49,7 +52,7 @@ def create_evaluation_screen(mss: ModelSessionState):
     with left:
         scopes_to_show = st.pills(
             "Select task scopes for comparison:",
-            ["1-to-N", "N-to-1", "N-to-M"],
+            ["1-to-1", "1-to-N", "N-to-1", "N-to-M"],
             selection_mode="multi",
             default=["1-to-N", "N-to-1"],
         )
@@ -97,7 +100,7 @@ def create_evaluation_screen(mss: ModelSessionState):
             ]
         )
         for scope in scopes_to_show:
-            for attribute_pair, votes in _get_votes_by_scope(result, scope).items():
+            for attribute_pair, votes in get_votes_by_scope(result, scope).items():
                 if votes:
                     vote_count = pd.Series(votes).value_counts()
                     # majority vote (unknown if three-way tie)
@@ -177,6 +180,7 @@ def create_evaluation_screen(mss: ModelSessionState):
         },
     )
     st.plotly_chart(fig, use_container_width=True)
+    _show_usage(results_to_show, evaluation)
     decisiveness = (
         evaluation.groupby(["experiment", "task_scope"])
         .apply(
@@ -267,6 +271,87 @@ def create_evaluation_screen(mss: ModelSessionState):
             st.table(baseline_evaluation.query("~match and ~ground_truth"))
 
 
+def _show_usage(results: List[Result], evaluation: pd.DataFrame):
+    """Show the cost and latency of the prompt designs of each experiment."""
+    usage = get_usage_by_parameters([r.parameters for r in results])
+    if not usage:
+        return
+    names = {_id_from_path(r.parameters.meta["path"]): r.name for r in results}
+    usage = pd.DataFrame(usage)
+    usage["experiment"] = usage["parameters_id"].map(names)
+    usage["task_scope"] = (
+        usage["design"].map(DESIGN_SCOPES).fillna("unknown").astype(str)
+    )
+    usage[["reasoning_tokens", "cached_tokens"]] = usage[
+        ["reasoning_tokens", "cached_tokens"]
+    ].fillna(0)
+    # every request beyond the first of a prompt re-asks after invalid answers
+    usage["reasks"] = usage["requests"] - usage["prompts"]
+    usage["cost"] = usage.apply(
+        lambda row: estimate_cost(
+            row["model"],
+            row["prompt_tokens"],
+            row["completion_tokens"],
+            row["cached_tokens"],
+        ),
+        axis=1,
+    )
+    correct_matches = (
+        evaluation[(evaluation["decision"] == "yes") & evaluation["ground_truth"]]
+        .groupby(["experiment", "task_scope"])
+        .size()
+        .rename("correct_matches")
+    )
+    usage = usage.join(correct_matches, on=["experiment", "task_scope"])
+    usage["cost_per_correct_match"] = usage["cost"] / usage["correct_matches"].where(
+        usage["correct_matches"] > 0
+    )
+
+    st.subheader("Cost and latency")
+    left, right = st.columns(2)
+    for column, metric, title in [
+        (left, "cost_per_correct_match", "Estimated cost per correct match (USD)"),
+        (right, "mean_latency", "Mean request latency (s)"),
+    ]:
+        fig = go.Figure(
+            data=[
+                go.Bar(
+                    name=experiment,
+                    x=group["task_scope"],
+                    y=group[metric],
+                )
+                for experiment, group in usage.groupby("experiment", sort=False)
+            ],
+            layout={"title": title, "barmode": "group", "height": 400},
+        )
+        with column:
+            st.plotly_chart(fig, use_container_width=True)
+    with st.expander("Token usage by prompt design"):
+        st.dataframe(
+            usage[
+                [
+                    "experiment",
+                    "model",
+                    "task_scope",
+                    "requests",
+                    "valid_answers",
+                    "invalid_answers",
+                    "reasks",
+                    "prompt_tokens",
+                    "cached_tokens",
+                    "completion_tokens",
+                    "reasoning_tokens",
+                    "cost",
+                    "correct_matches",
+                    "cost_per_correct_match",
+                    "mean_latency",
+                    "max_latency",
+                ]
+            ],
+            hide_index=True,
+        )
+
+
 def _get_attributes_baseline(
     attribute: Attribute, others: List[Attribute], metric: Callable[[str, str], float]
 ) -> Dict[Attribute, float]:
@@ -276,28 +361,6 @@ def _get_attributes_baseline(
     }
 
 
-def _which_scope_is(answer: Answer) -> TaskScope:
-    if len(answer.attributes.sources) > 1:
-        if len(answer.attributes.targets) > 1:
-            return TaskScope.nToN
-        return TaskScope.nToOne
-    if len(answer.attributes.targets) > 1:
-        return TaskScope.oneToN
-    return TaskScope.oneToOne
-
-
-def _get_votes_by_scope(
-    result: Result, scope: TaskScope
-) -> Dict[AttributePair, List[Vote]]:
-    votes = {}
-    for pair, result_pair in result.pairs.items():
-        votes[pair] = []
-        for vote in result_pair.votes:
-            if _which_scope_is(vote.answer) == scope:
-                votes[pair].append(vote.vote)
-    return votes
-
-
 def _get_best_threshold(
     mss: ModelSessionState, baseline_values: Dict[AttributePair, float]
 ) -> float:
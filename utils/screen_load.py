@@ -2,7 +2,6 @@ import os
 import json
 from typing import Dict, Optional
 
-import pandas as pd
 import streamlit as st
 
 from utils.model_session_state import ModelSessionState
@@ -72,6 +71,9 @@ def create_load_screen(mss: ModelSessionState):
             if (len(ground_truth_filename) > 1) and os.path.exists(
                 os.path.join("test_inputs", ground_truth_filename)
             ):
+                # imported lazily, pandas is only needed for the examples
+                import pandas as pd
+
                 gt_csv = pd.read_csv(os.path.join("test_inputs", ground_truth_filename))
                 for _, row in gt_csv.iterrows():
                     ap = AttributePair(
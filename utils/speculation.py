@@ -0,0 +1,153 @@
+"""Speculative matching of the inputs of the app before the user runs it (with SPECULATIVE_MATCHING enabled).
+
+While a user looks at a loaded schema, its prompts are built and sent at bulk priority in the background. Their answers are stored like any other, so the run started by the user reuses them and only sends what is still missing. A speculation is cancelled as soon as the inputs change.
+
+Speculations and the runs of all sessions of the process share one event loop and one scheduler, so they stay within PARALLEL_OPENAI_REQUESTS together and speculative requests wait for interactive ones.
+"""
+
+import asyncio
+from concurrent.futures import Future
+import dataclasses
+import threading
+from typing import List, Optional, Tuple
+
+from .backend import schema_match_models, schema_match_models_async
+from .config import config
+from .models import Parameters, Result
+from .scheduling import Priority, Scheduler
+from .storage import get_parameters_by_hash, get_usage_by_parameters
+from .telemetry import telemetry
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+_budget: Optional[Scheduler] = None
+
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    """The event loop that runs the speculations and runs of all sessions, in a thread of its own."""
+    global _loop, _budget
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            # speculations never take more than their share of the slots of the process
+            _budget = Scheduler(
+                priority_limits={Priority.BULK: config["SPECULATIVE_PARALLEL_REQUESTS"]}
+            )
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return _loop
+
+
+def _model_parameters(parameters: Parameters, models: List[str]) -> List[Parameters]:
+    """The parameters that matching with each of the models stores, see schema_match_models_async."""
+    return [
+        dataclasses.replace(parameters, llm_model=model, meta={}) for model in models
+    ]
+
+
+def _stored_requests(parameters: List[Parameters]) -> int:
+    """The number of requests stored for the parameters, 0 for parameters that were never stored."""
+    stored = [get_parameters_by_hash(p.digest()) for p in parameters]
+    usage = get_usage_by_parameters([p for p in stored if p is not None])
+    return sum(u["requests"] for u in usage)
+
+
+@dataclasses.dataclass
+class SpeculationStats:
+    requests: int = 0
+    wasted_requests: int = 0
+
+    @property
+    def waste_rate(self) -> float:
+        """The share of speculative requests whose answers were not used by a run."""
+        return self.wasted_requests / self.requests if self.requests else 0.0
+
+
+# the speculations of all sessions of the process
+stats = SpeculationStats()
+
+
+class Speculation:
+    """Matching of parameters with some models at bulk priority, running in the background."""
+
+    def __init__(self, parameters: Parameters, models: List[str]):
+        self.key = speculation_key(parameters, models)
+        self.parameters = _model_parameters(parameters, models)
+        self.requests_before = _stored_requests(self.parameters)
+        loop = _background_loop()
+        self.future: Future = asyncio.run_coroutine_threadsafe(
+            schema_match_models_async(
+                parameters, models, budget=_budget, priority=Priority.BULK
+            ),
+            loop,
+        )
+        telemetry.count("speculations_total")
+
+    def finish(self, used: bool) -> int:
+        """Cancel the speculation if it is still running, and count its requests as used or wasted. Returns the number of its requests. Requests that were in flight when it was cancelled are not counted."""
+        self.future.cancel()
+        requests = _stored_requests(self.parameters) - self.requests_before
+        stats.requests += requests
+        if not used:
+            stats.wasted_requests += requests
+        telemetry.count(
+            "speculative_requests_total",
+            requests,
+            outcome="used" if used else "wasted",
+        )
+        return requests
+
+
+def match(parameters: Parameters, models: List[str]) -> List[Result]:
+    """Run matching of the app at interactive priority, see schema_match_models. With SPECULATIVE_MATCHING enabled, the run shares the scheduler of the speculations, whose requests wait for its own."""
+    if not config["SPECULATIVE_MATCHING"]:
+        return schema_match_models(parameters, models, priority=Priority.INTERACTIVE)
+    loop = _background_loop()
+    return asyncio.run_coroutine_threadsafe(
+        schema_match_models_async(
+            parameters, models, budget=_budget, priority=Priority.INTERACTIVE
+        ),
+        loop,
+    ).result()
+
+
+def speculation_key(parameters: Parameters, models: List[str]) -> Tuple[str, ...]:
+    return tuple(p.digest() for p in _model_parameters(parameters, models))
+
+
+class Speculator:
+    """Runs at most one speculation per app session, the one of the current inputs."""
+
+    def __init__(self):
+        self.current: Optional[Speculation] = None
+
+    def speculate(self, parameters: Parameters, models: List[str]) -> None:
+        """Start matching the inputs in the background, unless their speculation runs already. A speculation of other (i.e. earlier) inputs is cancelled and wasted."""
+        # without storage, the answers of a speculation could not be reused
+        if (
+            not config["SPECULATIVE_MATCHING"]
+            or not config["QUERY_OPENAI"]
+            or config["SQLITE_PATH"] is None
+        ):
+            return
+        if (
+            self.current is not None
+            and self.current.key == speculation_key(parameters, models)
+            and not self.current.future.cancelled()
+        ):
+            return
+        self.cancel()
+        self.current = Speculation(parameters, models)
+
+    def take_over(self, parameters: Parameters, models: List[str]) -> None:
+        """Called when the user runs matching: the speculation of the same inputs is stopped, as the run resumes it from its run journal at interactive priority. Any other speculation is wasted."""
+        if self.current is None:
+            return
+        used = self.current.key == speculation_key(parameters, models)
+        self.current.finish(used)
+        self.current = None
+
+    def cancel(self) -> None:
+        """Cancel the current speculation, whose requests are wasted."""
+        if self.current is not None:
+            self.current.finish(used=False)
+            self.current = None
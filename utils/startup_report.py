@@ -0,0 +1,103 @@
+"""Report the import time of LLM-Matcher, broken down by app phase and package.
+
+Run it with `python -m utils.startup_report` (add `--json` for machine-readable output).
+"""
+
+import argparse
+from collections import defaultdict
+import json
+import subprocess
+import sys
+from typing import Any, Dict, List
+
+# modules imported per phase of the app, in the order the phases are usually reached.
+# Only the first phase is needed before the first widget renders, all others are imported lazily.
+PHASES = {
+    "first paint": [
+        "streamlit",
+        "utils.backend",
+        "utils.model_session_state",
+        "utils.screen_feedback",
+        "utils.screen_load",
+        "utils.scheduling",
+        "utils.speculation",
+    ],
+    "prompt sending": [
+        "utils.prompt_building",
+        "utils.prompt_sending",
+        "utils.prompt_postprocessing",
+    ],
+    "visualization": ["utils.screen_visualize"],
+    "evaluation": ["utils.screen_evaluation"],
+}
+
+_PHASE_MARKER = "startup_report.phase:"
+
+_PROBE = f"""
+import importlib, sys, time
+for phase, modules in {PHASES!r}.items():
+    print("{_PHASE_MARKER}" + phase, file=sys.stderr, flush=True)
+    start = time.perf_counter()
+    for module in modules:
+        importlib.import_module(module)
+    print("{_PHASE_MARKER}" + phase + ":" + str(time.perf_counter() - start), file=sys.stderr, flush=True)
+"""
+
+
+def measure_import_times() -> Dict[str, Dict[str, Any]]:
+    """Import all phases in a fresh interpreter and return the wall time and the import time per top-level package of each phase (in seconds)."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _PROBE],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    report = {}
+    phase = None
+    for line in proc.stderr.splitlines():
+        if line.startswith(_PHASE_MARKER):
+            parts = line[len(_PHASE_MARKER) :].split(":")
+            phase = parts[0]
+            if len(parts) == 1:
+                report[phase] = {"wall_time": 0.0, "packages": defaultdict(float)}
+            else:
+                report[phase]["wall_time"] = float(parts[1])
+        elif line.startswith("import time:") and phase is not None:
+            # format: `import time: self [us] | cumulative | imported package`
+            self_us, _, name = line[len("import time:") :].split("|")
+            if not self_us.strip().isdigit():
+                continue  # the header line
+            package = name.strip().split(".")[0]
+            report[phase]["packages"][package] += int(self_us) / 1_000_000
+    for phase_report in report.values():
+        phase_report["packages"] = dict(
+            sorted(phase_report["packages"].items(), key=lambda kv: -kv[1])
+        )
+    return report
+
+
+def format_report(report: Dict[str, Dict[str, Any]], top: int = 8) -> str:
+    lines = []
+    for phase, phase_report in report.items():
+        lines.append(f"{phase}: {phase_report['wall_time']:.3f}s")
+        for package, seconds in list(phase_report["packages"].items())[:top]:
+            lines.append(f"  {package:<24} {seconds:.3f}s")
+    return "\n".join(lines)
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument(
+        "--top", type=int, default=8, help="number of packages shown per phase"
+    )
+    args = parser.parse_args(argv)
+    report = measure_import_times()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report, args.top))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,17 @@ import datetime
 import functools
 import json
 import sqlite3
-from typing import List, Optional
-
-from openai.types.chat import ChatCompletion
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
 from .config import config
 from .models import Answer, Parameters, Prompt, Result
+from .result_cache import result_cache
+from .telemetry import telemetry
+
+if TYPE_CHECKING:
+    # only needed for type hints, importing the OpenAI SDK is slow
+    from openai.types.chat import ChatCompletion
 
 
 @contextmanager
@@ -52,6 +57,7 @@ def _is_initialized(db_path: str) -> bool:
 def _initialize_database(db_path: str) -> bool:
     """Initializes an SQLite3 database to store parameters, results and ChatCompletions."""
     if _is_initialized(db_path):
+        _migrate_database(db_path)
         return True
     con = sqlite3.connect(db_path)
     with con:
@@ -75,11 +81,13 @@ def _initialize_database(db_path: str) -> bool:
                 "parameters_id INTEGER NOT NULL REFERENCES parameters (id) ON DELETE CASCADE ON UPDATE CASCADE",
                 "hash TEXT NOT NULL",
                 "data JSON NOT NULL",
+                "design TEXT",
             ],
             "chatcompletions": [
                 "openai_id TEXT PRIMARY KEY",
                 "prompt_id INTEGER NOT NULL REFERENCES prompts (id) ON DELETE CASCADE ON UPDATE CASCADE",
                 "data JSON NOT NULL",
+                *USAGE_COLUMNS,
             ],
             "answers": [
                 "chatcompletions_id TEXT REFERENCES chatcompletions (openai_id) ON DELETE CASCADE ON UPDATE CASCADE",
@@ -88,6 +96,11 @@ def _initialize_database(db_path: str) -> bool:
                 "hash TEXT NOT NULL",
                 "data JSON NOT NULL",
             ],
+            "journal": JOURNAL_COLUMNS,
+            "leases": LEASE_COLUMNS,
+            "lease_waiters": LEASE_WAITER_COLUMNS,
+            "queue": QUEUE_COLUMNS,
+            "evaluations": EVALUATION_COLUMNS,
         }
         for table, columns in create_stmt.items():
             try:
@@ -95,10 +108,136 @@ def _initialize_database(db_path: str) -> bool:
             except sqlite3.Error as err:
                 # TODO: do proper logging here
                 print(err)
+        _create_indices(con)
     con.close()
     return True
 
 
+# usage and latency of a ChatCompletion, extracted into columns to allow aggregating them
+USAGE_COLUMNS = [
+    "model TEXT",
+    "prompt_tokens INTEGER",
+    "completion_tokens INTEGER",
+    "reasoning_tokens INTEGER",
+    "cached_tokens INTEGER",
+    "latency REAL",
+]
+
+
+# the planned prompts of each run and their progress, to resume interrupted runs
+JOURNAL_COLUMNS = [
+    "parameters_id INTEGER NOT NULL REFERENCES parameters (id) ON DELETE CASCADE ON UPDATE CASCADE",
+    "prompt_id INTEGER NOT NULL REFERENCES prompts (id) ON DELETE CASCADE ON UPDATE CASCADE",
+    "stage TEXT NOT NULL",
+    "valid_answers INTEGER NOT NULL DEFAULT 0",
+    "datetime INTEGER",
+    "PRIMARY KEY (parameters_id, prompt_id)",
+]
+
+
+# request capacity leased by the processes that share the database, see SharedLimiter
+LEASE_COLUMNS = [
+    "id INTEGER PRIMARY KEY",
+    "owner TEXT NOT NULL",
+    "tokens INTEGER NOT NULL",
+    "acquired REAL NOT NULL",
+    "expires REAL NOT NULL",
+    "released REAL",
+]
+LEASE_WAITER_COLUMNS = [
+    "owner TEXT PRIMARY KEY",
+    "heartbeat REAL NOT NULL",
+    "priority INTEGER NOT NULL DEFAULT 1",  # the rank of the highest waiting class
+    "since REAL",
+]
+# prompts waiting for worker processes, see worker.py
+QUEUE_COLUMNS = [
+    "prompt_id INTEGER PRIMARY KEY REFERENCES prompts (id) ON DELETE CASCADE ON UPDATE CASCADE",
+    "status TEXT NOT NULL",  # queued, running, done or failed
+    "attempts INTEGER NOT NULL DEFAULT 0",
+    "worker TEXT",
+    "enqueued REAL NOT NULL",
+    "visible REAL NOT NULL",  # running prompts are claimed again after this time
+    "error TEXT",
+    "priority INTEGER NOT NULL DEFAULT 1",  # the rank of a scheduling.Priority
+]
+# the evaluation of results against a ground truth per task scope, e.g. by batch runs
+EVALUATION_COLUMNS = [
+    "result_id INTEGER NOT NULL REFERENCES results (id) ON DELETE CASCADE ON UPDATE CASCADE",
+    "task_scope TEXT NOT NULL",
+    "precision REAL",
+    "recall REAL",
+    "f1 REAL",
+    "decisiveness REAL",
+    "datetime INTEGER",
+    "PRIMARY KEY (result_id, task_scope)",
+]
+# the window of the tokens per minute limit (in seconds)
+TOKEN_WINDOW = 60
+# the number of most recent ChatCompletions that latency estimates are based on
+LATENCY_HISTORY = 10_000
+
+
+def _create_indices(con: sqlite3.Connection) -> None:
+    for table, column in [
+        ("prompts", "parameters_id"),
+        ("prompts", "design"),
+        ("prompts", "hash"),
+        ("chatcompletions", "prompt_id"),
+        ("chatcompletions", "model"),
+        ("answers", "prompt_id"),
+        ("answers", "chatcompletions_id"),
+        ("queue", "status"),
+    ]:
+        con.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_{column} ON {table} ({column});"
+        )
+    # storing the answers of a ChatCompletion again (e.g. by a second worker) is a no-op
+    try:
+        con.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS answers_chatcompletions_id_hash "
+            "ON answers (chatcompletions_id, hash);"
+        )
+    except sqlite3.Error as err:
+        # TODO: do proper logging here
+        print(err)
+
+
+def _migrate_database(db_path: str) -> None:
+    """Adds the tables and columns introduced after a database was created. The token usage of stored ChatCompletions is extracted from their data, their latency is unknown."""
+    con = sqlite3.connect(db_path)
+    with con:
+        for table, columns in [
+            ("journal", JOURNAL_COLUMNS),
+            ("leases", LEASE_COLUMNS),
+            ("lease_waiters", LEASE_WAITER_COLUMNS),
+            ("queue", QUEUE_COLUMNS),
+            ("evaluations", EVALUATION_COLUMNS),
+        ]:
+            con.execute(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(columns)});")
+        for table, columns in [
+            ("prompts", ["design TEXT"]),
+            ("chatcompletions", USAGE_COLUMNS),
+            ("lease_waiters", LEASE_WAITER_COLUMNS[2:]),
+            ("queue", QUEUE_COLUMNS[-1:]),
+        ]:
+            existing = {row[1] for row in con.execute(f"PRAGMA table_info({table});")}
+            for column in columns:
+                if column.split()[0] not in existing:
+                    con.execute(f"ALTER TABLE {table} ADD COLUMN {column};")
+        con.execute(
+            "UPDATE chatcompletions SET "
+            "model = json_extract(data, '$.model'), "
+            "prompt_tokens = json_extract(data, '$.usage.prompt_tokens'), "
+            "completion_tokens = json_extract(data, '$.usage.completion_tokens'), "
+            "reasoning_tokens = json_extract(data, '$.usage.completion_tokens_details.reasoning_tokens'), "
+            "cached_tokens = json_extract(data, '$.usage.prompt_tokens_details.cached_tokens') "
+            "WHERE model IS NULL;"
+        )
+        _create_indices(con)
+    con.close()
+
+
 def _to_path(db_path: str, table: str, the_id: int) -> str:
     """Converts a database path to a path that can be used to retrieve the data."""
     return f"{db_path}/{table}/{the_id}"
@@ -109,6 +248,7 @@ def _id_from_path(path: str) -> int:
     return int(path.split("/")[-1])
 
 
+@telemetry.traced("store_parameters")
 def store_parameters(parameters: Parameters) -> Parameters:
     """Stores the parameters. It will add a path to the Parameter's meta information that is needed to retrieve the parameters later."""
     if config["SQLITE_PATH"] is None:
@@ -126,6 +266,20 @@ def store_parameters(parameters: Parameters) -> Parameters:
     return parameters
 
 
+def update_parameters(parameters: Parameters) -> Parameters:
+    """Stores changes of the meta information of stored parameters (e.g. the design plan of a run). Their digest, and thus the other fields, must not change."""
+    if config["SQLITE_PATH"] is None:
+        return parameters
+    path = parameters.meta["path"]
+    data = json.dumps(parameters.to_dict())
+    with get_connection(config["SQLITE_PATH"]) as con:
+        con.execute(
+            "UPDATE parameters SET data=? WHERE id=?;", (data, _id_from_path(path))
+        )
+    return result_cache.put(path, parameters, len(data))
+
+
+@telemetry.traced("store_result")
 def store_result(result: Result) -> Result:
     """Stores a result. It will add a path to the Result's meta information that is needed to retrieve the result later."""
     if config["SQLITE_PATH"] is None:
@@ -133,6 +287,7 @@ def store_result(result: Result) -> Result:
         return result
     now = datetime.datetime.now()
     db_path = config["SQLITE_PATH"]
+    data = result.to_json()
     with get_connection(db_path) as con:
         sql_result = con.execute(
             "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?) RETURNING id;",
@@ -142,28 +297,41 @@ def store_result(result: Result) -> Result:
                 "dunno",
                 now,
                 result.digest(),
-                result.to_json(),
+                data,
             ),
         )
         new_id = sql_result.fetchone()[0]
     result.meta["path"] = _to_path(db_path, "results", new_id)
-    return result
+    # share the fresh result with all other sessions right away
+    return result_cache.put(result.meta["path"], result, len(data))
 
 
+@telemetry.traced("store_prompt")
 def store_prompt(prompt: Prompt) -> Prompt:
-    """Stores a prompt. It will add a path to the Prompt's meta information that is needed to retrieve the prompt later."""
+    """Stores a prompt. It will add a path to the Prompt's meta information that is needed to retrieve the prompt later. An identical prompt of the same parameters is stored only once, so its answers are reused (e.g. to top up an incomplete result)."""
     if config["SQLITE_PATH"] is None:
         prompt.meta["path"] = _to_path("nostore", "prompts", "1")
         return prompt
     db_path = config["SQLITE_PATH"]
+    parameters_id = _id_from_path(prompt.parameters.meta["path"])
+    digest = prompt.digest()
     with get_connection(db_path) as con:
+        stored = con.execute(
+            "SELECT id FROM prompts WHERE parameters_id=? AND hash=?;",
+            (parameters_id, digest),
+        ).fetchone()
+        if stored is not None:
+            prompt.meta["path"] = _to_path(db_path, "prompts", stored[0])
+            return prompt
         result = con.execute(
-            "INSERT INTO prompts VALUES (?, ?, ?, ?) RETURNING id;",
+            "INSERT INTO prompts (id, parameters_id, hash, data, design) "
+            "VALUES (?, ?, ?, ?, ?) RETURNING id;",
             (
                 None,
-                _id_from_path(prompt.parameters.meta["path"]),
-                prompt.digest(),
+                parameters_id,
+                digest,
                 json.dumps(prompt.to_dict()),
+                prompt.meta.get("design", None),
             ),
         )
         new_id = result.fetchone()[0]
@@ -171,25 +339,36 @@ def store_prompt(prompt: Prompt) -> Prompt:
     return prompt
 
 
+@telemetry.traced("store_chatcompletion")
 def store_chatcompletion(
-    chatcompletion: ChatCompletion, prompt_path: str
-) -> ChatCompletion:
-    """Stores a ChatCompletion as received from the OpenAI API."""
+    chatcompletion: "ChatCompletion", prompt_path: str, latency: Optional[float] = None
+) -> "ChatCompletion":
+    """Stores a ChatCompletion as received from the OpenAI API, along with its token usage and the latency of the request (in seconds)."""
     if config["SQLITE_PATH"] is None:
         return chatcompletion
     db_path = config["SQLITE_PATH"]
+    usage = chatcompletion.usage
+    prompt_details = getattr(usage, "prompt_tokens_details", None)
+    completion_details = getattr(usage, "completion_tokens_details", None)
     with get_connection(db_path) as con:
         con.execute(
-            "INSERT INTO chatcompletions VALUES (?, ?, ?);",
+            "INSERT OR IGNORE INTO chatcompletions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);",
             (
                 chatcompletion.id,
                 _id_from_path(prompt_path),
                 chatcompletion.model_dump_json(),  # remember that ChatCompletion is a pydantic object
+                chatcompletion.model,
+                getattr(usage, "prompt_tokens", None),
+                getattr(usage, "completion_tokens", None),
+                getattr(completion_details, "reasoning_tokens", None),
+                getattr(prompt_details, "cached_tokens", None),
+                latency,
             ),
         )
     return chatcompletion
 
 
+@telemetry.traced("store_answer")
 def store_answer(
     answer: Answer, prompt_path: str, chatcompletion_id: Optional[str]
 ) -> Answer:
@@ -200,7 +379,7 @@ def store_answer(
     db_path = config["SQLITE_PATH"]
     with get_connection(db_path) as con:
         con.execute(
-            "INSERT INTO answers VALUES (?, ?, ?, ?, ?);",
+            "INSERT OR IGNORE INTO answers VALUES (?, ?, ?, ?, ?);",
             (
                 chatcompletion_id,
                 _id_from_path(prompt_path),
@@ -219,15 +398,29 @@ def get_parameters_by_hash(the_hash: str) -> Optional[Parameters]:
     db_path = config["SQLITE_PATH"]
     with get_connection(db_path) as con:
         result = con.execute(
-            "SELECT id, datetime, data FROM parameters WHERE hash=?;", (the_hash,)
+            "SELECT id FROM parameters WHERE hash=?;", (the_hash,)
         ).fetchone()
         if result is None:
             return None
-        parameters = Parameters.from_dict(json.loads(result[2]))
-        parameters.meta["path"] = _to_path(db_path, "parameters", result[0])
+        path = _to_path(db_path, "parameters", result[0])
+        parameters = result_cache.get_or_load(
+            path, lambda: _load_parameters(con, result[0], path)
+        )
     return parameters
 
 
+def _load_parameters(
+    con: sqlite3.Connection, the_id: int, path: str
+) -> Tuple[Parameters, int]:
+    """Deserialize the parameters with the given id. Returns the parameters and the size of their serialized data."""
+    data = con.execute("SELECT data FROM parameters WHERE id=?;", (the_id,)).fetchone()[
+        0
+    ]
+    parameters = Parameters.from_dict(json.loads(data))
+    parameters.meta["path"] = path
+    return parameters, len(data)
+
+
 def get_all_parameters() -> List[Parameters]:
     if config["SQLITE_PATH"] is None:
         return None
@@ -243,22 +436,32 @@ def get_all_parameters() -> List[Parameters]:
 
 
 def get_result_by_parameters(parameters: Parameters) -> Optional[Result]:
-    """Returns the result for the given parameters. If the result is not stored, returns None."""
+    """Returns the latest result for the given parameters (incomplete results are replaced once topped up). If the result is not stored, returns None."""
     if config["SQLITE_PATH"] is None:
         return None
     db_path = config["SQLITE_PATH"]
     with get_connection(db_path) as con:
         sql_result = con.execute(
-            "SELECT id, datetime, data FROM results WHERE parameters_id=?;",
+            "SELECT id FROM results WHERE parameters_id=? ORDER BY id DESC LIMIT 1;",
             (_id_from_path(parameters.meta["path"]),),
         ).fetchone()
         if sql_result is None:
             return None
-        result = Result.from_json(sql_result[2])
-        result.meta["path"] = _to_path(db_path, "results", sql_result[0])
+        path = _to_path(db_path, "results", sql_result[0])
+        result = result_cache.get_or_load(
+            path, lambda: _load_result(con, sql_result[0], path)
+        )
     return result
 
 
+def _load_result(con: sqlite3.Connection, the_id: int, path: str) -> Tuple[Result, int]:
+    """Deserialize the result with the given id. Returns the result and the size of its serialized data."""
+    data = con.execute("SELECT data FROM results WHERE id=?;", (the_id,)).fetchone()[0]
+    result = Result.from_json(data)
+    result.meta["path"] = path
+    return result, len(data)
+
+
 def get_prompt_by_parameters(parameters: Parameters) -> List[Prompt]:
     """Returns all prompts for the given parameters. Returns an empty list if none are stored."""
     if config["SQLITE_PATH"] is None:
@@ -277,6 +480,277 @@ def get_prompt_by_parameters(parameters: Parameters) -> List[Prompt]:
     return prompts
 
 
+def store_run_plan(parameters: Parameters, prompts: List[Prompt], stage: str) -> None:
+    """Records the prompts that a stage of a run (e.g. "match" or "escalate") plans to process in the journal."""
+    if config["SQLITE_PATH"] is None:
+        return
+    now = datetime.datetime.now()
+    parameters_id = _id_from_path(parameters.meta["path"])
+    with get_connection(config["SQLITE_PATH"]) as con:
+        con.executemany(
+            "INSERT OR IGNORE INTO journal (parameters_id, prompt_id, stage, datetime) "
+            "VALUES (?, ?, ?, ?);",
+            [
+                (parameters_id, _id_from_path(prompt.meta["path"]), stage, now)
+                for prompt in prompts
+            ],
+        )
+
+
+def get_run_plan(parameters: Parameters, stage: str) -> List[Prompt]:
+    """Returns the planned prompts of a stage of a run, with their number of valid answers so far in prompt.meta["valid_answers"]. Returns an empty list if the stage was not planned yet."""
+    if config["SQLITE_PATH"] is None:
+        return []
+    db_path = config["SQLITE_PATH"]
+    prompts = []
+    with get_connection(db_path) as con:
+        sql_result = con.execute(
+            "SELECT p.id, p.data, j.valid_answers "
+            "FROM journal j JOIN prompts p ON j.prompt_id = p.id "
+            "WHERE j.parameters_id=? AND j.stage=? ORDER BY p.id;",
+            (_id_from_path(parameters.meta["path"]), stage),
+        ).fetchall()
+        for the_id, data, valid_answers in sql_result:
+            prompt = Prompt.from_dict(json.loads(data))
+            prompt.meta["path"] = _to_path(db_path, "prompts", the_id)
+            prompt.meta["valid_answers"] = valid_answers
+            prompts.append(prompt)
+    return prompts
+
+
+def update_run_journal(prompt: Prompt, valid_answers: int) -> None:
+    """Records the number of valid answers of a planned prompt."""
+    if config["SQLITE_PATH"] is None:
+        return
+    with get_connection(config["SQLITE_PATH"]) as con:
+        con.execute(
+            "UPDATE journal SET valid_answers=?, datetime=? WHERE prompt_id=?;",
+            (
+                valid_answers,
+                datetime.datetime.now(),
+                _id_from_path(prompt.meta["path"]),
+            ),
+        )
+
+
+def acquire_lease(
+    owner: str,
+    parallel_requests: int,
+    tokens_per_minute: int,
+    tokens: int,
+    lease_timeout: float,
+    waiter_timeout: float,
+    priority: int = 1,
+    aging: float = 0,
+) -> Optional[int]:
+    """Try to lease a request slot and tokens for an owner (a process). A slot is free if fewer than parallel_requests leases are active, no other owner waits with a request of a higher priority (a lower rank) and the owner holds less than its fair share while others wait; tokens are free if the leases of the last minute stay within tokens_per_minute (a limit of 0 disables the check). Waiting owners move up one rank per aging seconds (0 disables this). Returns the lease id, or None if the owner has to wait, which registers it as waiting."""
+    db_path = config["SQLITE_PATH"]
+    if not _initialize_database(db_path):
+        raise RuntimeError("The database could not be initialized.")
+    now = time.time()
+    # an immediate transaction, as checking and taking capacity must be atomic across processes
+    con = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        con.execute("BEGIN IMMEDIATE;")
+        # the leases of crashed processes expire
+        con.execute(
+            "UPDATE leases SET released = expires WHERE released IS NULL AND expires < ?;",
+            (now,),
+        )
+        con.execute("DELETE FROM leases WHERE released < ?;", (now - TOKEN_WINDOW,))
+        active = dict(
+            con.execute(
+                "SELECT owner, COUNT(*) FROM leases WHERE released IS NULL GROUP BY owner;"
+            ).fetchall()
+        )
+        waiting = {}
+        for waiter, rank, since in con.execute(
+            "SELECT owner, priority, since FROM lease_waiters WHERE heartbeat >= ?;",
+            (now - waiter_timeout,),
+        ):
+            if aging > 0 and since is not None:
+                rank = max(rank - int((now - since) / aging), 0)
+            waiting[waiter] = rank
+        own_rank = priority
+        if aging > 0 and owner in waiting:
+            since = con.execute(
+                "SELECT since FROM lease_waiters WHERE owner=?;", (owner,)
+            ).fetchone()[0]
+            own_rank = max(priority - int((now - (since or now)) / aging), 0)
+        granted = all(
+            rank >= own_rank for other, rank in waiting.items() if other != owner
+        )
+        if granted and parallel_requests > 0:
+            owners = set(active) | set(waiting) | {owner}
+            fair_share = -(-parallel_requests // len(owners))
+            granted = sum(active.values()) < parallel_requests and (
+                active.get(owner, 0) < fair_share or not set(waiting) - {owner}
+            )
+        if granted and tokens_per_minute > 0:
+            used_tokens = con.execute(
+                "SELECT COALESCE(SUM(tokens), 0) FROM leases WHERE acquired >= ?;",
+                (now - TOKEN_WINDOW,),
+            ).fetchone()[0]
+            # a single request larger than the limit still gets through eventually
+            granted = used_tokens == 0 or used_tokens + tokens <= tokens_per_minute
+        lease_id = None
+        if granted:
+            lease_id = con.execute(
+                "INSERT INTO leases (owner, tokens, acquired, expires) "
+                "VALUES (?, ?, ?, ?) RETURNING id;",
+                (owner, tokens, now, now + lease_timeout),
+            ).fetchone()[0]
+            con.execute("DELETE FROM lease_waiters WHERE owner=?;", (owner,))
+        else:
+            # a stale registration starts over, an active one keeps its highest class
+            con.execute(
+                "INSERT INTO lease_waiters (owner, heartbeat, priority, since) "
+                "VALUES (?1, ?2, ?3, ?2) ON CONFLICT (owner) DO UPDATE SET "
+                "priority=IIF(heartbeat < ?4, excluded.priority, MIN(priority, excluded.priority)), "
+                "since=IIF(heartbeat < ?4, excluded.since, since), "
+                "heartbeat=excluded.heartbeat;",
+                (owner, now, priority, now - waiter_timeout),
+            )
+        con.execute("COMMIT;")
+        return lease_id
+    except BaseException:
+        if con.in_transaction:
+            con.execute("ROLLBACK;")
+        raise
+    finally:
+        con.close()
+
+
+def release_lease(lease_id: int, tokens: Optional[int] = None) -> None:
+    """Release a lease, optionally correcting its tokens to the actual usage. Released leases count towards the tokens per minute until they leave the window."""
+    with get_connection(config["SQLITE_PATH"]) as con:
+        con.execute(
+            "UPDATE leases SET released=?, tokens=COALESCE(?, tokens) WHERE id=?;",
+            (time.time(), tokens, lease_id),
+        )
+
+
+def enqueue_prompts(
+    prompts: List[Prompt], requeue: bool = False, priority: int = 1
+) -> None:
+    """Adds prompts to the queue of the worker processes, with the rank of a scheduling.Priority. Prompts of the same priority are claimed in the given order. Prompts that are queued already are skipped but keep the higher of both priorities, finished (done or failed) prompts are queued again if requeue is set."""
+    if config["SQLITE_PATH"] is None:
+        return
+    now = time.time()
+    conflict = "DO UPDATE SET priority=MIN(priority, excluded.priority)"
+    if requeue:
+        conflict = (
+            "DO UPDATE SET "
+            "priority=IIF(status IN ('done', 'failed'), excluded.priority, MIN(priority, excluded.priority)), "
+            "attempts=IIF(status IN ('done', 'failed'), 0, attempts), "
+            "visible=IIF(status IN ('done', 'failed'), excluded.visible, visible), "
+            "error=IIF(status IN ('done', 'failed'), NULL, error), "
+            "status=IIF(status IN ('done', 'failed'), 'queued', status)"
+        )
+    with get_connection(config["SQLITE_PATH"]) as con:
+        con.executemany(
+            "INSERT INTO queue (prompt_id, status, enqueued, visible, priority) "
+            f"VALUES (?, 'queued', ?, ?, ?) ON CONFLICT (prompt_id) {conflict};",
+            [
+                # distinct times keep the order of the prompts
+                (_id_from_path(prompt.meta["path"]), now + i * 1e-6, now, priority)
+                for i, prompt in enumerate(prompts)
+            ],
+        )
+
+
+def claim_prompts(
+    worker: str, limit: int, visibility_timeout: float, aging: float = 0
+) -> List[Prompt]:
+    """Claims up to limit queued prompts for a worker, those of the highest priority (the lowest rank) first and oldest first within a priority. Queued prompts move up one rank per aging seconds (0 disables this). Prompts whose worker did not finish them within the visibility timeout (e.g. as it crashed) are claimed again."""
+    db_path = config["SQLITE_PATH"]
+    now = time.time()
+    rank = "priority"
+    if aging > 0:
+        rank = f"MAX(priority - CAST((:now - enqueued) / {float(aging)} AS INTEGER), 0)"
+    prompts = []
+    with get_connection(db_path) as con:
+        sql_result = con.execute(
+            "UPDATE queue SET status='running', attempts=attempts + 1, worker=:worker, "
+            "visible=:visible "
+            "WHERE prompt_id IN ("
+            "SELECT prompt_id FROM queue "
+            "WHERE status='queued' OR (status='running' AND visible < :now) "
+            f"ORDER BY {rank}, enqueued LIMIT :limit"
+            ") RETURNING prompt_id, attempts, priority;",
+            {
+                "worker": worker,
+                "visible": now + visibility_timeout,
+                "now": now,
+                "limit": limit,
+            },
+        ).fetchall()
+        for the_id, attempts, priority in sql_result:
+            parameters_id, data = con.execute(
+                "SELECT parameters_id, data FROM prompts WHERE id=?;", (the_id,)
+            ).fetchone()
+            prompt = Prompt.from_dict(json.loads(data))
+            prompt.parameters.meta["path"] = _to_path(
+                db_path, "parameters", parameters_id
+            )
+            prompt.meta["path"] = _to_path(db_path, "prompts", the_id)
+            prompt.meta["attempts"] = attempts
+            prompt.meta["priority"] = priority
+            prompts.append(prompt)
+    return prompts
+
+
+def finish_prompt(prompt: Prompt, status: str, error: Optional[str] = None) -> None:
+    """Sets the queue status of a claimed prompt: done, failed, or queued to try again."""
+    with get_connection(config["SQLITE_PATH"]) as con:
+        con.execute(
+            "UPDATE queue SET status=?, error=?, visible=? WHERE prompt_id=?;",
+            (status, error, time.time(), _id_from_path(prompt.meta["path"])),
+        )
+
+
+def get_queue_status(prompts: List[Prompt]) -> Dict[int, str]:
+    """Returns the queue status of the given prompts by prompt id."""
+    if config["SQLITE_PATH"] is None or len(prompts) == 0:
+        return {}
+    ids = [_id_from_path(prompt.meta["path"]) for prompt in prompts]
+    status = {}
+    with get_connection(config["SQLITE_PATH"]) as con:
+        # in chunks, as the number of SQL variables is limited
+        for i in range(0, len(ids), 500):
+            chunk = ids[i : i + 500]
+            status.update(
+                con.execute(
+                    "SELECT prompt_id, status FROM queue "
+                    f"WHERE prompt_id IN ({', '.join('?' * len(chunk))});",
+                    chunk,
+                ).fetchall()
+            )
+    return status
+
+
+def get_valid_answers_by_hash(hashes: List[str]) -> Dict[str, int]:
+    """Returns the number of stored valid answers of the prompts with the given hashes (digests), by hash. Prompts that were never stored are missing."""
+    if config["SQLITE_PATH"] is None or len(hashes) == 0:
+        return {}
+    counts = {}
+    with get_connection(config["SQLITE_PATH"]) as con:
+        # in chunks, as the number of SQL variables is limited
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i : i + 500]
+            counts.update(
+                con.execute(
+                    "SELECT hash, MAX(valid_answers) FROM ("
+                    "SELECT p.hash, COUNT(a.prompt_id) AS valid_answers FROM prompts p "
+                    "LEFT JOIN answers a ON a.prompt_id = p.id AND a.valid = 1 "
+                    f"WHERE p.hash IN ({', '.join('?' * len(chunk))}) GROUP BY p.id"
+                    ") GROUP BY hash;",
+                    chunk,
+                ).fetchall()
+            )
+    return counts
+
+
 def get_answers_by_prompt(prompt: Prompt, filter_valid: bool = False) -> List[Answer]:
     """Returns all answers for the given prompt. Returns an empty list if none are stored."""
     if config["SQLITE_PATH"] is None:
@@ -296,11 +770,126 @@ def get_answers_by_prompt(prompt: Prompt, filter_valid: bool = False) -> List[An
 
 
 def get_similar_results_by_parameters(parameters: Parameters) -> List[Result]:
+    """Returns the results of all stored parameters that are about the same. Parameters without a result (e.g. of a cancelled speculation) are skipped."""
     if config["SQLITE_PATH"] is None:
         return []
-    return [
+    results = [
         get_result_by_parameters(param)
         for param in filter(
             lambda p: p.about_the_same(parameters), get_all_parameters()
         )
     ]
+    return [result for result in results if result is not None]
+
+
+def get_latency_history() -> List[Dict[str, Any]]:
+    """Returns the number of requests, their summed latency, prompt tokens and completion tokens per model and prompt design, over the LATENCY_HISTORY most recent ChatCompletions with a known latency. Returns an empty list if nothing is stored."""
+    if config["SQLITE_PATH"] is None:
+        return []
+    with get_connection(config["SQLITE_PATH"]) as con:
+        sql_result = con.execute(
+            "SELECT c.model, p.design, COUNT(*), SUM(c.latency), SUM(c.prompt_tokens), "
+            "SUM(c.completion_tokens) "
+            "FROM ("
+            "SELECT prompt_id, model, latency, prompt_tokens, completion_tokens "
+            "FROM chatcompletions "
+            "WHERE latency IS NOT NULL AND prompt_tokens > 0 "
+            "ORDER BY rowid DESC LIMIT ?"
+            ") c JOIN prompts p ON c.prompt_id = p.id "
+            "GROUP BY c.model, p.design;",
+            (LATENCY_HISTORY,),
+        ).fetchall()
+    columns = [
+        "model",
+        "design",
+        "requests",
+        "latency",
+        "prompt_tokens",
+        "completion_tokens",
+    ]
+    return [dict(zip(columns, row)) for row in sql_result]
+
+
+def store_evaluation(result: Result, evaluation: List[Dict[str, Any]]) -> None:
+    """Stores the evaluation of a stored result, as returned by evaluation.evaluate_result. An earlier evaluation of the same task scope is replaced."""
+    if config["SQLITE_PATH"] is None or not evaluation:
+        return
+    now = datetime.datetime.now()
+    result_id = _id_from_path(result.meta["path"])
+    with get_connection(config["SQLITE_PATH"]) as con:
+        con.executemany(
+            "INSERT OR REPLACE INTO evaluations VALUES (?, ?, ?, ?, ?, ?, ?);",
+            [
+                (
+                    result_id,
+                    row["task_scope"],
+                    row["precision"],
+                    row["recall"],
+                    row["f1-score"],
+                    row["decisiveness"],
+                    now,
+                )
+                for row in evaluation
+            ],
+        )
+
+
+def get_evaluation_history() -> List[Dict[str, Any]]:
+    """Returns the number of evaluated results and their mean F1-score per model and task scope. Returns an empty list if nothing is stored."""
+    if config["SQLITE_PATH"] is None:
+        return []
+    with get_connection(config["SQLITE_PATH"]) as con:
+        sql_result = con.execute(
+            "SELECT json_extract(p.data, '$.llm_model'), e.task_scope, COUNT(*), AVG(e.f1) "
+            "FROM evaluations e JOIN results r ON e.result_id = r.id "
+            "JOIN parameters p ON r.parameters_id = p.id "
+            "GROUP BY 1, 2;"
+        ).fetchall()
+    columns = ["model", "task_scope", "results", "f1"]
+    return [dict(zip(columns, row)) for row in sql_result]
+
+
+def get_usage_by_parameters(parameters: List[Parameters]) -> List[Dict[str, Any]]:
+    """Returns the token usage and request latency of the given experiments, aggregated per experiment, model and prompt design. Returns an empty list if nothing is stored."""
+    if config["SQLITE_PATH"] is None or len(parameters) == 0:
+        return []
+    db_path = config["SQLITE_PATH"]
+    ids = [_id_from_path(p.meta["path"]) for p in parameters]
+    with get_connection(db_path) as con:
+        sql_result = con.execute(
+            "SELECT p.parameters_id, c.model, p.design, "
+            "COUNT(*), "
+            "SUM(c.prompt_tokens), "
+            "SUM(c.completion_tokens), "
+            "SUM(c.reasoning_tokens), "
+            "SUM(c.cached_tokens), "
+            "AVG(c.latency), "
+            "MAX(c.latency), "
+            "SUM(a.valid_answers), "
+            "SUM(a.invalid_answers), "
+            "COUNT(DISTINCT c.prompt_id) "
+            "FROM chatcompletions c JOIN prompts p ON c.prompt_id = p.id "
+            "LEFT JOIN ("
+            "SELECT chatcompletions_id, SUM(valid) AS valid_answers, SUM(1 - valid) AS invalid_answers FROM answers GROUP BY chatcompletions_id"
+            ") a ON a.chatcompletions_id = c.openai_id "
+            f"WHERE p.parameters_id IN ({', '.join('?' * len(ids))}) "
+            "GROUP BY p.parameters_id, c.model, p.design "
+            "ORDER BY p.parameters_id, c.model, p.design;",
+            ids,
+        ).fetchall()
+    columns = [
+        "parameters_id",
+        "model",
+        "design",
+        "requests",
+        "prompt_tokens",
+        "completion_tokens",
+        "reasoning_tokens",
+        "cached_tokens",
+        "mean_latency",
+        "max_latency",
+        "valid_answers",
+        "invalid_answers",
+        "prompts",
+    ]
+    return [dict(zip(columns, row)) for row in sql_result]
@@ -0,0 +1,240 @@
+"""Lightweight tracing and metrics of the matching pipeline.
+
+Spans, counters and histograms are only recorded if `TELEMETRY` is enabled, otherwise all calls return right away.
+Metrics are exported in the Prometheus text format, spans as OpenTelemetry (OTLP/JSON) trace files.
+"""
+
+from collections import deque
+from contextlib import contextmanager, nullcontext
+import contextvars
+from dataclasses import dataclass, field
+import functools
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from .config import config
+
+# bucket boundaries of all histograms (in seconds)
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+METRIC_PREFIX = "llm_matcher_"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str] = None
+    start_ns: int = 0
+    end_ns: int = 0
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+    def to_otlp(self) -> Dict[str, Any]:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [
+                {"key": k, "value": {"stringValue": str(v)}}
+                for k, v in self.attributes.items()
+            ],
+        }
+
+
+@dataclass
+class Histogram:
+    buckets: List[int] = field(default_factory=lambda: [0] * len(BUCKETS))
+    sum: float = 0.0
+    count: int = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels] + ([extra] if extra else [])
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Telemetry:
+    """Records spans, counters and histograms of the current process."""
+
+    def __init__(self, enabled: bool, max_spans: int = 100_000):
+        self.enabled = enabled
+        self.spans: Deque[Span] = deque(maxlen=max_spans)
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._lock = threading.Lock()
+
+    def span(self, name: str, **attributes: Any):
+        """A context manager that records a span and its duration. Spans started within the context become its children, also across asyncio tasks."""
+        if not self.enabled:
+            return nullcontext()
+        return self._span(name, attributes)
+
+    @contextmanager
+    def _span(self, name: str, attributes: Dict[str, Any]) -> Iterator[Span]:
+        parent = _current_span.get()
+        if parent is None:
+            trace_id = os.urandom(16).hex()
+        else:
+            trace_id = parent.trace_id
+            # the experiment of a root span applies to all of its children
+            if "experiment" in parent.attributes:
+                attributes.setdefault("experiment", parent.attributes["experiment"])
+        span = Span(
+            name=name,
+            trace_id=trace_id,
+            span_id=os.urandom(8).hex(),
+            parent_id=parent.span_id if parent else None,
+            start_ns=time.time_ns(),
+            attributes=attributes,
+        )
+        token = _current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.attributes["error"] = repr(e)
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            span.end_ns = span.start_ns + int(duration * 1e9)
+            _current_span.reset(token)
+            self.spans.append(span)
+            labels = {"span": name}
+            if "experiment" in span.attributes:
+                labels["experiment"] = span.attributes["experiment"]
+            self.observe("span_duration_seconds", duration, **labels)
+
+    def traced(self, name: str) -> Callable:
+        """A decorator that records a span around every call of a (synchronous) function."""
+
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self._span(name, {}):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def count(self, name: str, value: float = 1, **labels: Any) -> None:
+        """Increase a counter."""
+        if not self.enabled:
+            return
+        labels = self._with_experiment(labels)
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        """Add a value (in seconds) to a histogram."""
+        if not self.enabled:
+            return
+        labels = self._with_experiment(labels)
+        with self._lock:
+            self.histograms.setdefault(name, {}).setdefault(
+                labels, Histogram()
+            ).observe(value)
+
+    def _with_experiment(self, labels: Dict[str, Any]) -> Labels:
+        span = _current_span.get()
+        if span is not None and "experiment" in span.attributes:
+            labels.setdefault("experiment", span.attributes["experiment"])
+        return _labels(labels)
+
+    def prometheus_text(self) -> str:
+        """Export all counters and histograms in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} counter")
+                for labels, value in series.items():
+                    lines.append(
+                        f"{METRIC_PREFIX}{name}{_format_labels(labels)} {value}"
+                    )
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} histogram")
+                for labels, histogram in series.items():
+                    for bound, bucket in zip(BUCKETS, histogram.buckets):
+                        le = _format_labels(labels, f'le="{bound}"')
+                        lines.append(f"{METRIC_PREFIX}{name}_bucket{le} {bucket}")
+                    le = _format_labels(labels, 'le="+Inf"')
+                    lines.append(f"{METRIC_PREFIX}{name}_bucket{le} {histogram.count}")
+                    lines.append(
+                        f"{METRIC_PREFIX}{name}_sum{_format_labels(labels)} {histogram.sum}"
+                    )
+                    lines.append(
+                        f"{METRIC_PREFIX}{name}_count{_format_labels(labels)} {histogram.count}"
+                    )
+        return "\n".join(lines) + "\n"
+
+    def trace_json(self, experiment: Optional[str] = None) -> str:
+        """Export the recorded spans (optionally only those of one experiment) as OTLP/JSON."""
+        spans = [
+            s
+            for s in list(self.spans)
+            if experiment is None or s.attributes.get("experiment") == experiment
+        ]
+        return json.dumps(
+            {
+                "resourceSpans": [
+                    {
+                        "resource": {
+                            "attributes": [
+                                {
+                                    "key": "service.name",
+                                    "value": {"stringValue": "llm-matcher"},
+                                }
+                            ]
+                        },
+                        "scopeSpans": [
+                            {
+                                "scope": {"name": "utils.telemetry"},
+                                "spans": [s.to_otlp() for s in spans],
+                            }
+                        ],
+                    }
+                ]
+            }
+        )
+
+    def export(self, directory: str, experiment: Optional[str] = None) -> None:
+        """Write the metrics to <directory>/metrics.prom and the spans to <directory>/trace-<experiment>.json."""
+        if not self.enabled:
+            return
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "metrics.prom"), "w") as f:
+            f.write(self.prometheus_text())
+        trace_name = f"trace-{experiment}.json" if experiment else "trace.json"
+        with open(os.path.join(directory, trace_name), "w") as f:
+            f.write(self.trace_json(experiment))
+
+
+telemetry = Telemetry(config["TELEMETRY"])
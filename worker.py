@@ -0,0 +1,104 @@
+"""Worker processes that send the prompts queued in the database (with `PROMPT_QUEUE` enabled).
+
+Start them with `python worker.py --workers 4`. Each worker process runs its own event loop and claims batches of queued prompts. A prompt that a worker claimed but did not finish (e.g. as the worker crashed) is claimed again after `QUEUE_VISIBILITY_TIMEOUT`, so every prompt is processed at least once. Processing a prompt again only requests its missing answers.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+from typing import List, Set
+
+from utils.config import config
+from utils.models import Prompt
+from utils.prompt_sending import process_and_store_prompt
+from utils.scheduling import Priority, Scheduler
+from utils.storage import claim_prompts, finish_prompt
+
+# seconds between polls of an empty queue
+POLL_INTERVAL = 0.5
+
+
+async def process_claimed_prompt(prompt: Prompt, scheduler: Scheduler) -> None:
+    # the prompts of an experiment share a flow, which is served by its priority
+    flow = scheduler.flow(
+        prompt.parameters.meta["path"], Priority.from_rank(prompt.meta["priority"])
+    )
+    try:
+        await process_and_store_prompt(prompt.parameters, prompt, flow)
+    except Exception as e:  # a failing prompt must not stop the worker
+        attempts = prompt.meta.get("attempts", 1)
+        status = "failed" if attempts >= config["QUEUE_MAX_ATTEMPTS"] else "queued"
+        finish_prompt(prompt, status, repr(e))
+        print(f"[{status}] prompt {prompt.meta['path']}: {e!r}")
+        return
+    finish_prompt(prompt, "done")
+
+
+async def work(name: str, parallel_requests: int, exit_when_empty: bool) -> None:
+    """Claim and process queued prompts, keeping about twice as many prompts claimed as requests may run in parallel."""
+    scheduler = Scheduler(parallel_requests)
+    running: Set[asyncio.Task] = set()
+    while True:
+        free = 2 * parallel_requests - len(running)
+        if free > 0:
+            for prompt in claim_prompts(
+                name,
+                free,
+                config["QUEUE_VISIBILITY_TIMEOUT"],
+                config["PRIORITY_AGING"],
+            ):
+                running.add(
+                    asyncio.create_task(process_claimed_prompt(prompt, scheduler))
+                )
+        if not running:
+            if exit_when_empty:
+                return
+            await asyncio.sleep(POLL_INTERVAL)
+            continue
+        _, running = await asyncio.wait(
+            running, timeout=POLL_INTERVAL, return_when=asyncio.FIRST_COMPLETED
+        )
+
+
+def run_worker(index: int, parallel_requests: int, exit_when_empty: bool) -> None:
+    name = f"{socket.gethostname()}-{os.getpid()}-{index}"
+    asyncio.run(work(name, parallel_requests, exit_when_empty))
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of worker processes",
+    )
+    parser.add_argument(
+        "--parallel-requests",
+        type=int,
+        default=config["PARALLEL_OPENAI_REQUESTS"],
+        help="maximum number of parallel requests per worker process",
+    )
+    parser.add_argument(
+        "--exit-when-empty",
+        action="store_true",
+        help="stop the workers once the queue is empty, instead of waiting for more prompts",
+    )
+    args = parser.parse_args(argv)
+    workers = [
+        multiprocessing.Process(
+            target=run_worker,
+            args=(i, args.parallel_requests, args.exit_when_empty),
+        )
+        for i in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == "__main__":
+    main()